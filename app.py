@@ -21,8 +21,12 @@ import subprocess
 import wan
 from wan.configs import SIZE_CONFIGS, SUPPORTED_SIZES, WAN_CONFIGS
 from wan.utils.utils import cache_image, cache_video, str2bool
+from src.audio_analysis.chunked_embedding import AudioEmbeddingStream, iter_streaming_embedding_chunks, stream_embedding
+from src.audio_analysis.embedding_cache import AudioEmbeddingCache
+from src.audio_analysis.tts_stream import SpeakerTracks
+from wan.utils.vram_planner import plan_placement, log_plan
 from wan.utils.multitalk_utils import save_video_ffmpeg
-from kokoro import KPipeline
+from kokoro import get_tts_service
 from transformers import Wav2Vec2FeatureExtractor
 from src.audio_analysis.wav2vec2 import Wav2Vec2Model
 
@@ -56,6 +60,9 @@ def _validate_args(args):
     assert args.size in SUPPORTED_SIZES[
         args.
         task], f"Unsupport size {args.size} for task {args.task}, supported sizes are: {', '.join(SUPPORTED_SIZES[args.task])}"
+    if args.vae_tile_size is not None:
+        assert args.vae_tile_size > args.vae_tile_overlap >= 8, \
+            "--vae_tile_overlap must be at least 8 and smaller than --vae_tile_size."
 
 
 def _parse_args():
@@ -183,6 +190,12 @@ def _parse_args():
         help="clip: generate one video chunk, streaming: long video generation")
     parser.add_argument(
         "--sample_steps", type=int, default=None, help="The sampling steps.")
+    parser.add_argument(
+        "--sample_solver",
+        type=str,
+        default='euler',
+        choices=['euler', 'unipc', 'dpm++'],
+        help="The solver used to sample. The multistep solvers reach the quality of 40 Euler steps with fewer --sample_steps.")
     parser.add_argument(
         "--sample_shift",
         type=float,
@@ -217,6 +230,106 @@ def _parse_args():
         default=0.2,
         help="Threshold for teacache."
     )
+    parser.add_argument(
+        "--teacache_coefficients",
+        type=str,
+        default=None,
+        help="JSON file of TeaCache coefficients written by tools/calibrate_teacache.py. "
+        "Defaults to the built-in ones, fitted for 40 Euler steps."
+    )
+    parser.add_argument(
+        "--batched_cfg",
+        action="store_true",
+        default=False,
+        help="Run the cond / drop-text / uncond DiT passes of each step as one batch. Needs extra VRAM for activations."
+    )
+    parser.add_argument(
+        "--cache_cond_kv",
+        action="store_true",
+        default=False,
+        help="Precompute the per-block text/image/audio cross-attention K/V once per clip. Needs extra VRAM."
+    )
+    parser.add_argument(
+        "--ref_attn_map_block",
+        type=int,
+        default=None,
+        help="Multi-person only: compute the speaker reference attention map up to this block and reuse it in later blocks."
+    )
+    parser.add_argument(
+        "--async_postprocess",
+        action="store_true",
+        default=False,
+        help="Copy, colour-correct and write each decoded clip in the background while the next clip is sampled."
+    )
+    parser.add_argument(
+        "--prefetch_offload",
+        action="store_true",
+        default=False,
+        help="With --num_persistent_param_in_dit, keep offloaded weights in pinned memory and copy the next block's weights on a side stream while the current block runs."
+    )
+    parser.add_argument(
+        "--auto_vram",
+        action="store_true",
+        default=False,
+        help="Choose offload_model, t5_cpu and num_persistent_param_in_dit from the VRAM budget, the size and frame_num."
+    )
+    parser.add_argument(
+        "--vram_budget",
+        type=float,
+        default=None,
+        help="VRAM budget in GiB for --auto_vram, defaults to the free memory of the GPU."
+    )
+    parser.add_argument(
+        "--audio_cache_dir",
+        type=str,
+        default=None,
+        help="Cache wav2vec2 embeddings in this directory, keyed by the audio content."
+    )
+    parser.add_argument(
+        "--audio_cache_size",
+        type=float,
+        default=10,
+        help="Size limit of --audio_cache_dir in GiB, least recently used entries are evicted."
+    )
+    parser.add_argument(
+        "--audio_chunk_seconds",
+        type=float,
+        default=None,
+        help="Encode the audio in windows of this many seconds, on the GPU, while the video is generated. "
+        "Bounds the wav2vec2 memory for long audio. By default the whole clip is encoded at once on the CPU."
+    )
+    parser.add_argument(
+        "--stream_tts",
+        action="store_true",
+        default=False,
+        help="In TTS mode, start generating the video as soon as the first sentences are synthesised and encoded, "
+        "instead of after the whole script."
+    )
+    parser.add_argument(
+        "--vae_tile_size",
+        type=int,
+        default=None,
+        help="Encode and decode with the VAE in overlapping spatial tiles of this many latent pixels (8 video pixels), "
+        "bounding its memory independently of the resolution. The output is not identical to the untiled encode and "
+        "decode: the tiles do not see each other's context, so pixels near the seams differ. 32 is a good start; by "
+        "default tiling is off."
+    )
+    parser.add_argument(
+        "--vae_tile_overlap",
+        type=int,
+        default=16,
+        help="Overlap of neighbouring --vae_tile_size tiles in latent pixels, blended linearly. The seam error falls "
+        "with the overlap, so at least 8 is required."
+    )
+    parser.add_argument(
+        "--memory_policy",
+        type=str,
+        default="pressure",
+        choices=["always", "clip", "pressure", "never"],
+        help="When to hand cached CUDA memory back: after every DiT forward (always, the old behaviour), "
+        "between clips, only above 90%% of the card (pressure) or never. The per-stage peaks and the "
+        "fastest policy that fits are logged after each run."
+    )
     parser.add_argument(
         "--use_apg",
         action="store_true",
@@ -298,7 +411,16 @@ def _init_logging(rank):
     else:
         logging.basicConfig(level=logging.ERROR)
 
-def get_embedding(speech_array, wav2vec_feature_extractor, audio_encoder, sr=16000, device='cpu'):
+def get_embedding(speech_array, wav2vec_feature_extractor, audio_encoder, sr=16000, device='cpu', audio_cache=None,
+                  chunk_seconds=None):
+    if chunk_seconds is not None:
+        return stream_embedding(speech_array, wav2vec_feature_extractor, audio_encoder, sr=sr,
+                                chunk_seconds=chunk_seconds, audio_cache=audio_cache)
+    if audio_cache is not None:
+        return audio_cache.get_or_compute(
+            speech_array, sr,
+            lambda: get_embedding(speech_array, wav2vec_feature_extractor, audio_encoder, sr=sr, device=device))
+
     audio_duration = len(speech_array) / sr
     video_length = audio_duration * 25 # Assume the video fps is 25
 
@@ -357,21 +479,8 @@ def audio_prepare_single(audio_path, sample_rate=16000):
         return human_speech_array
 
 def process_tts_single(text, save_dir, voice1):    
-    s1_sentences = []
-
-    pipeline = KPipeline(lang_code='a', repo_id='weights/Kokoro-82M')
-
-    voice_tensor = torch.load(voice1, weights_only=True)
-    generator = pipeline(
-        text, voice=voice_tensor, # <= change voice here
-        speed=1, split_pattern=r'\n+'
-    )
-    audios = []
-    for i, (gs, ps, audio) in enumerate(generator):
-        audios.append(audio)
-    audios = torch.concat(audios, dim=0)
-    s1_sentences.append(audios)
-    s1_sentences = torch.concat(s1_sentences, dim=0)
+    tts = get_tts_service('weights/Kokoro-82M')
+    s1_sentences = tts.synthesize([(text, voice1)])[0]
     save_path1 =f'{save_dir}/s1.wav'
     sf.write(save_path1, s1_sentences, 24000) # save each audio file
     s1, _ = librosa.load(save_path1, sr=16000)
@@ -382,34 +491,20 @@ def process_tts_single(text, save_dir, voice1):
 def process_tts_multi(text, save_dir, voice1, voice2):
     pattern = r'\(s(\d+)\)\s*(.*?)(?=\s*\(s\d+\)|$)'
     matches = re.findall(pattern, text, re.DOTALL)
+    matches = [(speaker, content) for speaker, content in matches if speaker in ('1', '2')]
     
     s1_sentences = []
     s2_sentences = []
 
-    pipeline = KPipeline(lang_code='a', repo_id='weights/Kokoro-82M')
-    for idx, (speaker, content) in enumerate(matches):
+    # all turns go through the shared model in one call
+    tts = get_tts_service('weights/Kokoro-82M')
+    voices = {'1': voice1, '2': voice2}
+    turn_audios = tts.synthesize([(content, voices[speaker]) for speaker, content in matches])
+    for (speaker, content), audios in zip(matches, turn_audios):
         if speaker == '1':
-            voice_tensor = torch.load(voice1, weights_only=True)
-            generator = pipeline(
-                content, voice=voice_tensor, # <= change voice here
-                speed=1, split_pattern=r'\n+'
-            )
-            audios = []
-            for i, (gs, ps, audio) in enumerate(generator):
-                audios.append(audio)
-            audios = torch.concat(audios, dim=0)
             s1_sentences.append(audios)
             s2_sentences.append(torch.zeros_like(audios))
         elif speaker == '2':
-            voice_tensor = torch.load(voice2, weights_only=True)
-            generator = pipeline(
-                content, voice=voice_tensor, # <= change voice here
-                speed=1, split_pattern=r'\n+'
-            )
-            audios = []
-            for i, (gs, ps, audio) in enumerate(generator):
-                audios.append(audio)
-            audios = torch.concat(audios, dim=0)
             s2_sentences.append(audios)
             s1_sentences.append(torch.zeros_like(audios))
     
@@ -428,6 +523,63 @@ def process_tts_multi(text, save_dir, voice1, voice2):
     # sum, _ = librosa.load(save_path_sum, sr=16000)
     return s1, s2, save_path_sum
 
+def process_tts_stream(text, voice1, voice2, wav2vec_feature_extractor, audio_encoder, chunk_seconds=5):
+    """
+    Streamed counterpart of process_tts_single/multi. Returns one lazily encoded embedding
+    per speaker and the SpeakerTracks feeding them: sentences are synthesised, resampled
+    to 16 kHz and encoded only as the video generation reaches them.
+    """
+    if voice2 is None:
+        turns = [(line, voice1) for line in re.split(r'\n+', text.strip()) if line.strip()]
+        speakers = [0] * len(turns)
+    else:
+        pattern = r'\(s(\d+)\)\s*(.*?)(?=\s*\(s\d+\)|$)'
+        matches = re.findall(pattern, text, re.DOTALL)
+        matches = [(speaker, content) for speaker, content in matches if speaker in ('1', '2')]
+        turns = [(content, voice1 if speaker == '1' else voice2) for speaker, content in matches]
+        speakers = [int(speaker) - 1 for speaker, _ in matches]
+    num_speakers = 1 if voice2 is None else 2
+
+    tts = get_tts_service('weights/Kokoro-82M')
+    tracks = SpeakerTracks(tts.stream(turns), speakers, num_speakers)
+    embeddings = [
+        AudioEmbeddingStream(iter_streaming_embedding_chunks(
+            tracks.track(speaker), wav2vec_feature_extractor, audio_encoder, window_frames=int(chunk_seconds * 25)))
+        for speaker in range(num_speakers)
+    ]
+    return embeddings, tracks
+
+def build_audio_cache(args):
+    if args.audio_cache_dir is None:
+        return None
+    return AudioEmbeddingCache(args.audio_cache_dir, args.wav2vec_dir,
+                               max_bytes=int(args.audio_cache_size * 1024 ** 3))
+
+
+def apply_vram_plan(args, device):
+    """Replace the hand-picked offload settings by a plan for the available VRAM."""
+    if int(os.getenv("WORLD_SIZE", 1)) > 1:
+        logging.warning("--auto_vram plans for a single GPU, ignored in multi-GPU runs.")
+        return
+    with open(os.path.join(args.ckpt_dir, "config.json"), 'r') as f:
+        wan_config = json.load(f)
+    plan = plan_placement(
+        wan_config,
+        size=args.size,
+        frame_num=args.frame_num,
+        budget=args.vram_budget,
+        device=device,
+        quant=args.quant,
+        num_branches=3 if args.batched_cfg else 1,
+        prefetch_offload=args.prefetch_offload,
+        vae_tile_size=args.vae_tile_size,
+    )
+    log_plan(plan)
+    args.offload_model = plan.offload_model
+    args.t5_cpu = plan.t5_cpu
+    args.num_persistent_param_in_dit = plan.num_persistent_param_in_dit
+
+
 def run_graio_demo(args):
     rank = int(os.getenv("RANK", 0))
     world_size = int(os.getenv("WORLD_SIZE", 1))
@@ -486,10 +638,17 @@ def run_graio_demo(args):
     
 
     
-    wav2vec_feature_extractor, audio_encoder= custom_init('cpu', args.wav2vec_dir)
+    # windowed extraction keeps the encoder's memory bounded, so it can share the GPU
+    streamed = args.audio_chunk_seconds is not None or args.stream_tts
+    audio_device = device if streamed and torch.cuda.is_available() else 'cpu'
+    wav2vec_feature_extractor, audio_encoder= custom_init(audio_device, args.wav2vec_dir)
+    audio_cache = build_audio_cache(args)
     os.makedirs(args.audio_save_dir,exist_ok=True)
 
 
+    if args.auto_vram:
+        apply_vram_plan(args, device)
+
     logging.info("Creating MultiTalk pipeline.")
     wan_i2v = wan.InfiniteTalkPipeline(
         config=cfg,
@@ -511,8 +670,11 @@ def run_graio_demo(args):
     if args.num_persistent_param_in_dit is not None:
         wan_i2v.vram_management = True
         wan_i2v.enable_vram_management(
-            num_persistent_param_in_dit=args.num_persistent_param_in_dit
+            num_persistent_param_in_dit=args.num_persistent_param_in_dit,
+            prefetch_offload=args.prefetch_offload,
         )
+    if args.vae_tile_size is not None:
+        wan_i2v.vae.enable_tiling(args.vae_tile_size, args.vae_tile_overlap)
 
 
     
@@ -552,44 +714,43 @@ def run_graio_demo(args):
         if 'Local File' in mode_selector:
             if len(input_data['cond_audio'])==2:
                 new_human_speech1, new_human_speech2, sum_human_speechs = audio_prepare_multi(input_data['cond_audio']['person1'], input_data['cond_audio']['person2'], input_data['audio_type'])
-                audio_embedding_1 = get_embedding(new_human_speech1, wav2vec_feature_extractor, audio_encoder)
-                audio_embedding_2 = get_embedding(new_human_speech2, wav2vec_feature_extractor, audio_encoder)
-                emb1_path = os.path.join(args.audio_save_dir, '1.pt')
-                emb2_path = os.path.join(args.audio_save_dir, '2.pt')
+                audio_embedding_1 = get_embedding(new_human_speech1, wav2vec_feature_extractor, audio_encoder, audio_cache=audio_cache, chunk_seconds=args.audio_chunk_seconds)
+                audio_embedding_2 = get_embedding(new_human_speech2, wav2vec_feature_extractor, audio_encoder, audio_cache=audio_cache, chunk_seconds=args.audio_chunk_seconds)
                 sum_audio = os.path.join(args.audio_save_dir, 'sum.wav')
                 sf.write(sum_audio, sum_human_speechs, 16000)
-                torch.save(audio_embedding_1, emb1_path)
-                torch.save(audio_embedding_2, emb2_path)
-                input_data['cond_audio']['person1'] = emb1_path
-                input_data['cond_audio']['person2'] = emb2_path
+                input_data['cond_audio']['person1'] = audio_embedding_1
+                input_data['cond_audio']['person2'] = audio_embedding_2
                 input_data['video_audio'] = sum_audio
             elif len(input_data['cond_audio'])==1:
                 human_speech = audio_prepare_single(input_data['cond_audio']['person1'])
-                audio_embedding = get_embedding(human_speech, wav2vec_feature_extractor, audio_encoder)
-                emb_path = os.path.join(args.audio_save_dir, '1.pt')
+                audio_embedding = get_embedding(human_speech, wav2vec_feature_extractor, audio_encoder, audio_cache=audio_cache, chunk_seconds=args.audio_chunk_seconds)
                 sum_audio = os.path.join(args.audio_save_dir, 'sum.wav')
                 sf.write(sum_audio, human_speech, 16000)
-                torch.save(audio_embedding, emb_path)
-                input_data['cond_audio']['person1'] = emb_path
+                input_data['cond_audio']['person1'] = audio_embedding
                 input_data['video_audio'] = sum_audio
+        elif 'TTS' in mode_selector and args.stream_tts:
+            tts_embeddings, tts_tracks = process_tts_stream(
+                input_data['tts_audio']['text'],
+                input_data['tts_audio']['human1_voice'],
+                input_data['tts_audio'].get('human2_voice'),
+                wav2vec_feature_extractor,
+                audio_encoder,
+                chunk_seconds=args.audio_chunk_seconds or 5,
+            )
+            for i, audio_embedding in enumerate(tts_embeddings):
+                input_data['cond_audio'][f'person{i + 1}'] = audio_embedding
         elif 'TTS' in mode_selector:
             if 'human2_voice' not in input_data['tts_audio'].keys():
                 new_human_speech1, sum_audio = process_tts_single(input_data['tts_audio']['text'], args.audio_save_dir, input_data['tts_audio']['human1_voice'])
-                audio_embedding_1 = get_embedding(new_human_speech1, wav2vec_feature_extractor, audio_encoder)
-                emb1_path = os.path.join(args.audio_save_dir, '1.pt')
-                torch.save(audio_embedding_1, emb1_path)
-                input_data['cond_audio']['person1'] = emb1_path
+                audio_embedding_1 = get_embedding(new_human_speech1, wav2vec_feature_extractor, audio_encoder, audio_cache=audio_cache, chunk_seconds=args.audio_chunk_seconds)
+                input_data['cond_audio']['person1'] = audio_embedding_1
                 input_data['video_audio'] = sum_audio
             else:
                 new_human_speech1, new_human_speech2, sum_audio = process_tts_multi(input_data['tts_audio']['text'], args.audio_save_dir, input_data['tts_audio']['human1_voice'], input_data['tts_audio']['human2_voice'])
-                audio_embedding_1 = get_embedding(new_human_speech1, wav2vec_feature_extractor, audio_encoder)
-                audio_embedding_2 = get_embedding(new_human_speech2, wav2vec_feature_extractor, audio_encoder)
-                emb1_path = os.path.join(args.audio_save_dir, '1.pt')
-                emb2_path = os.path.join(args.audio_save_dir, '2.pt')
-                torch.save(audio_embedding_1, emb1_path)
-                torch.save(audio_embedding_2, emb2_path)
-                input_data['cond_audio']['person1'] = emb1_path
-                input_data['cond_audio']['person2'] = emb2_path
+                audio_embedding_1 = get_embedding(new_human_speech1, wav2vec_feature_extractor, audio_encoder, audio_cache=audio_cache, chunk_seconds=args.audio_chunk_seconds)
+                audio_embedding_2 = get_embedding(new_human_speech2, wav2vec_feature_extractor, audio_encoder, audio_cache=audio_cache, chunk_seconds=args.audio_chunk_seconds)
+                input_data['cond_audio']['person1'] = audio_embedding_1
+                input_data['cond_audio']['person2'] = audio_embedding_2
                 input_data['video_audio'] = sum_audio
 
 
@@ -633,6 +794,12 @@ def run_graio_demo(args):
             color_correction_strength = args.color_correction_strength,
             extra_args=args,
             )
+
+        if 'TTS' in mode_selector and args.stream_tts:
+            # the soundtrack is complete only once the video has consumed it
+            sum_audio = os.path.join(args.audio_save_dir, 'sum.wav')
+            sf.write(sum_audio, tts_tracks.mix(), 16000)
+            input_data['video_audio'] = sum_audio
         
 
         if args.save_file is None:
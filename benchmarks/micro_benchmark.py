@@ -0,0 +1,460 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+CPU-runnable micro-benchmark suite on the tiny random-init models of
+`benchmarks.tiny_models`.
+
+Times the hot paths of the pipeline over a range of frame counts (and with them,
+sequence lengths) and checks that the optimised variants still match their
+reference paths:
+
+    rope        RopeCache against the float64 rope_apply
+    dit         DiT forward: plain, with a prepared cond_cache, batched CFG against
+                three sequential branches, two speakers
+    audio_proj  wav2vec window projection
+    t5          text encoder, padded+masked against unpadded
+    vae         causal VAE encode and decode, a clip prefix against the full clip, tiled
+                against untiled
+    attn_map    speaker reference attention map, split heads against all heads
+    color       match_and_blend_colors, cached reference stats and frame batching
+    save_video  save_video_ffmpeg with audio mux (needs ffmpeg)
+    kokoro      Kokoro per-item forward and the opt-in forward_batch
+
+Every timed entry also stores a fingerprint (mean, mean |x|, std) of its output from
+a seeded run. The JSON written with --output can be passed to --compare on another
+commit: the run then reports the speed ratio per entry and fails if a fingerprint
+drifted or an equivalence check failed. The approximate paths, the tiled VAE and the
+padded Kokoro batch, have no pass/fail tolerance: their max abs and relative L2 errors
+against the exact path are reported, and --compare fails if the relative error grew.
+
+    python -m benchmarks.micro_benchmark --output base.json
+    python -m benchmarks.micro_benchmark --compare base.json --cases dit vae
+
+The speaker attention map is compiled with torch.compile; without a C++ toolchain set
+TORCHDYNAMO_DISABLE=1.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import numpy as np
+import soundfile as sf
+import torch
+
+from wan.modules.multitalk_model import RopeCache, rope_apply
+from wan.utils.multitalk_utils import (
+    get_attn_map_with_target,
+    lab_color_stats,
+    match_and_blend_colors,
+    save_video_ffmpeg,
+)
+
+from .rope_benchmark import _sync, build_freqs
+from .tiny_models import (
+    TINY_T5_CONFIG,
+    TINY_WAN_CONFIG,
+    build_audio_proj,
+    build_dit_inputs,
+    build_kokoro,
+    build_t5_encoder,
+    build_vae,
+    build_wan_model,
+)
+
+CASES = ('rope', 'dit', 'audio_proj', 't5', 'vae', 'attn_map', 'color', 'save_video', 'kokoro')
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the pipeline on tiny random-init models")
+    parser.add_argument("--cases", type=str, nargs="+", default=list(CASES), choices=CASES)
+    parser.add_argument("--frame_nums", type=int, nargs="+", default=[5, 9, 17],
+                        help="Video frames per clip, 4n+1.")
+    parser.add_argument("--size", type=int, nargs=2, default=[128, 128], help="Video height and width.")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"],
+                        help="DiT, T5 and audio projection dtype, the VAE always runs in fp32.")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads, for stable CPU timings.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file.")
+    parser.add_argument("--compare", type=str, default=None, help="JSON of an earlier run to compare against.")
+    parser.add_argument("--drift_tol", type=float, default=1e-3,
+                        help="Relative fingerprint change that counts as an output drift.")
+    return parser.parse_args()
+
+
+def _git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+def _tensors(out):
+    if isinstance(out, torch.Tensor):
+        return [out]
+    if isinstance(out, (list, tuple)):
+        return [t for u in out for t in _tensors(u)]
+    if hasattr(out, 'audio'):
+        return [out.audio]
+    return []
+
+
+def fingerprint(out):
+    """Order-independent summary of an output, robust to reshapes and padding changes."""
+    tensors = _tensors(out)
+    if not tensors:
+        return None
+    x = torch.cat([t.detach().float().flatten().cpu() for t in tensors])
+    return dict(mean=x.mean().item(), abs_mean=x.abs().mean().item(), std=x.std().item(), numel=x.numel())
+
+
+def max_abs_error(ref, out):
+    return max((a.float() - b.float()).abs().max().item() for a, b in zip(_tensors(ref), _tensors(out)))
+
+
+def relative_l2_error(ref, out):
+    """||out - ref|| / ||ref|| over all tensors, each pair cut to its common length."""
+    err, norm = 0.0, 0.0
+    for a, b in zip(_tensors(ref), _tensors(out)):
+        a, b = a.detach().float().flatten().cpu(), b.detach().float().flatten().cpu()
+        n = min(a.numel(), b.numel())
+        err += (b[:n] - a[:n]).square().sum().item()
+        norm += a.square().sum().item()
+    return (err / max(norm, 1e-12)) ** 0.5
+
+
+class Report:
+    """Collects timings, fingerprints and equivalence checks of one run."""
+
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+        self.checks = []
+        self.errors = []
+
+    @torch.no_grad()
+    def time(self, case, name, fn, iters=None, **params):
+        """Time `fn`, returns its output of a seeded run."""
+        args = self.args
+        torch.manual_seed(args.seed)
+        out = fn()
+        for _ in range(args.warmup):
+            fn()
+        runs = []
+        for _ in range(iters or args.iters):
+            _sync(args.device)
+            start = time.perf_counter()
+            fn()
+            _sync(args.device)
+            runs.append(time.perf_counter() - start)
+        self.results.append(dict(
+            case=case,
+            name=name,
+            params=params,
+            mean_ms=float(np.mean(runs)) * 1e3,
+            min_ms=float(np.min(runs)) * 1e3,
+            iters=len(runs),
+            fingerprint=fingerprint(out),
+        ))
+        print(f"{case:<10} {name:<24} {json.dumps(params):<40} "
+              f"{self.results[-1]['mean_ms']:9.3f} ms  (min {self.results[-1]['min_ms']:.3f})")
+        return out
+
+    def check(self, case, name, ref, out, atol, **params):
+        """Record whether `out` matches the reference `ref` to within `atol`."""
+        err = max_abs_error(ref, out)
+        passed = err <= atol
+        self.checks.append(dict(case=case, name=name, params=params, max_abs_err=err, atol=atol, passed=passed))
+        print(f"{case:<10} check {name:<18} {json.dumps(params):<40} "
+              f"max abs err {err:.3e} (atol {atol:.0e})  {'ok' if passed else 'FAILED'}")
+
+    def measure(self, case, name, ref, out, **params):
+        """Record the error of an approximate path `out` against its exact reference `ref`."""
+        max_err, rel_err = max_abs_error(ref, out), relative_l2_error(ref, out)
+        self.errors.append(dict(case=case, name=name, params=params, max_abs_err=max_err, rel_l2_err=rel_err))
+        print(f"{case:<10} error {name:<18} {json.dumps(params):<40} "
+              f"max abs err {max_err:.3e}  rel l2 err {rel_err:.3e}")
+
+    def to_dict(self):
+        return dict(
+            meta=dict(
+                commit=_git_commit(),
+                torch=torch.__version__,
+                device=self.args.device,
+                dtype=self.args.dtype,
+                threads=torch.get_num_threads(),
+                frame_nums=self.args.frame_nums,
+                size=self.args.size,
+            ),
+            results=self.results,
+            checks=self.checks,
+            errors=self.errors,
+        )
+
+
+def _latent_grid(args, frame_num):
+    h, w = args.size
+    return (frame_num - 1) // 4 + 1, h // 8, w // 8
+
+
+def bench_rope(report, args, dtype):
+    freqs = build_freqs(TINY_WAN_CONFIG['dim'] // TINY_WAN_CONFIG['num_heads'])
+    rope_cache = RopeCache(freqs)
+    num_heads = TINY_WAN_CONFIG['num_heads']
+    for frame_num in args.frame_nums:
+        lat_t, lat_h, lat_w = _latent_grid(args, frame_num)
+        f, h, w = lat_t, lat_h // 2, lat_w // 2
+        x = torch.randn(1, f * h * w, num_heads, freqs.size(1) * 2, device=args.device, dtype=dtype)
+        grid_sizes = torch.tensor([[f, h, w]], dtype=torch.long)
+        params = dict(tokens=f * h * w)
+        ref = report.time('rope', 'rope_apply', lambda: rope_apply(x, grid_sizes, freqs), **params)
+        out = report.time('rope', 'RopeCache', lambda: rope_cache.apply(x, grid_sizes), **params)
+        report.check('rope', 'RopeCache', ref, out, atol=1e-4 if dtype == torch.float32 else 5e-2, **params)
+
+
+def bench_dit(report, args, dtype):
+    model = build_wan_model(args.device, dtype, seed=args.seed)
+    atol = 1e-4 if dtype == torch.float32 else 5e-2
+    for frame_num in args.frame_nums:
+        inputs = build_dit_inputs(frame_num, args.size, device=args.device, dtype=dtype, seed=args.seed)
+        params = dict(frames=frame_num, tokens=inputs['seq_len'])
+        cond_args = {k: v for k, v in inputs.items() if k not in ('x', 't', 'seq_len')}
+
+        ref = report.time('dit', 'forward', lambda: model(**inputs), **params)
+        cond_cache = model.prepare_conditioning(**cond_args, cache_kv=True)
+        out = report.time('dit', 'forward_cond_cache', lambda: model(**inputs, cond_cache=cond_cache), **params)
+        report.check('dit', 'cond_cache', ref, out, atol=atol, **params)
+
+        # CFG branches as the pipeline builds them: cond, drop text, drop text and audio
+        neg_context = torch.zeros_like(inputs['context'][0])
+        branches = [
+            dict(inputs, context=inputs['context']),
+            dict(inputs, context=[neg_context]),
+            dict(inputs, context=[neg_context], audio=torch.zeros_like(inputs['audio'])),
+        ]
+        batched = dict(inputs, context=[b['context'][0] for b in branches], audio=[b['audio'] for b in branches])
+        ref = report.time('dit', 'cfg_sequential', lambda: torch.cat([model(**b) for b in branches]), **params)
+        out = report.time('dit', 'cfg_batched', lambda: model(**batched), **params)
+        report.check('dit', 'cfg_batched', ref, out, atol=atol, **params)
+
+        inputs = build_dit_inputs(frame_num, args.size, human_num=2, device=args.device, dtype=dtype,
+                                  seed=args.seed)
+        report.time('dit', 'forward_2_speakers', lambda: model(**inputs), **params)
+
+
+def bench_audio_proj(report, args, dtype):
+    model = build_audio_proj(args.device, dtype, seed=args.seed)
+    for frame_num in args.frame_nums:
+        first = torch.randn(1, 1, 5, 12, 768, device=args.device, dtype=dtype)
+        latter = torch.randn(1, (frame_num - 1) // 4, 8, 12, 768, device=args.device, dtype=dtype)
+        report.time('audio_proj', 'forward', lambda: model(first, latter), frames=frame_num)
+
+
+def bench_t5(report, args, dtype):
+    model = build_t5_encoder(args.device, dtype, seed=args.seed)
+    for seq_len in (32, 128, 512):
+        ids = torch.randint(1, TINY_T5_CONFIG['vocab'], (1, seq_len), device=args.device)
+        mask = torch.ones_like(ids)
+        padded_ids = torch.cat([ids, torch.zeros_like(ids[:, :16])], dim=1)
+        padded_mask = torch.cat([mask, torch.zeros_like(mask[:, :16])], dim=1)
+        ref = report.time('t5', 'forward', lambda: model(ids, mask), tokens=seq_len)
+        out = model(padded_ids, padded_mask)[:, :seq_len]
+        report.check('t5', 'padding_mask', ref, out, atol=1e-4 if dtype == torch.float32 else 5e-2, tokens=seq_len)
+
+
+def bench_vae(report, args):
+    vae = build_vae(args.device, seed=args.seed)
+    model, scale = vae.model, vae.scale
+    h, w = args.size
+    # an overlap above the minimum of --vae_tile_overlap and a tile a quarter of the latent
+    # wider: two tiles per axis at the default size, so the seams are part of the measurement
+    tile_overlap = 10
+    tile_size = tile_overlap + max(max(h, w) // 32, 1)
+
+    for frame_num in args.frame_nums:
+        video = torch.rand(1, 3, frame_num, h, w, device=args.device) * 2 - 1
+        params = dict(frames=frame_num)
+        z = report.time('vae', 'encode', lambda: model.encode(video, scale), **params)
+        x = report.time('vae', 'decode', lambda: model.decode(z, scale), **params)
+        if frame_num > 5:
+            # causal: the latents of a clip prefix do not depend on the later frames
+            prefix = model.encode(video[:, :, :5], scale)
+            report.check('vae', 'causal_prefix', prefix, z[:, :, :prefix.size(2)], atol=1e-4, **params)
+
+        # spatial tiling (--vae_tile_size) against the untiled path
+        vae.enable_tiling(tile_size, tile_overlap)
+        try:
+            z_tiled = report.time('vae', 'tiled_encode', lambda: vae.encode([video[0]])[0],
+                                  tile_size=tile_size, tile_overlap=tile_overlap, **params)
+            x_tiled = report.time('vae', 'tiled_decode', lambda: vae.decode([z[0]])[0],
+                                  tile_size=tile_size, tile_overlap=tile_overlap, **params)
+        finally:
+            vae.tile_size = None
+        # tiling is approximate at the seams, measured rather than asserted
+        params.update(tile_size=tile_size, tile_overlap=tile_overlap)
+        report.measure('vae', 'tiled_encode', z[0], z_tiled, **params)
+        report.measure('vae', 'tiled_decode', x[0].clamp(-1, 1), x_tiled, **params)
+
+
+def bench_attn_map(report, args, dtype):
+    num_heads, head_dim = TINY_WAN_CONFIG['num_heads'], TINY_WAN_CONFIG['dim'] // TINY_WAN_CONFIG['num_heads']
+    for frame_num in args.frame_nums:
+        lat_t, lat_h, lat_w = _latent_grid(args, frame_num)
+        shape = (lat_t, lat_h // 2, lat_w // 2)
+        tokens = shape[0] * shape[1] * shape[2]
+        q = torch.randn(1, tokens, num_heads, head_dim, device=args.device, dtype=dtype)
+        k = torch.randn(1, tokens, num_heads, head_dim, device=args.device, dtype=dtype)
+        masks = torch.zeros(3, shape[1], shape[2], device=args.device)
+        masks[0, :, :shape[2] // 2] = 1
+        masks[1, :, shape[2] // 2:] = 1
+        masks[2] = 1
+        masks = masks.flatten(1)
+        params = dict(tokens=tokens)
+        out = report.time('attn_map', 'split_2', lambda: get_attn_map_with_target(
+            q, k, shape, ref_target_masks=masks, split_num=2), **params)
+        ref = get_attn_map_with_target(q, k, shape, ref_target_masks=masks, split_num=1)
+        report.check('attn_map', 'split_heads', ref, out, atol=1e-5 if dtype == torch.float32 else 1e-2, **params)
+
+
+def bench_color(report, args):
+    h, w = args.size
+    reference = torch.rand(1, 3, 1, h, w, device=args.device) * 2 - 1
+    reference_stats = lab_color_stats(reference)
+    for frame_num in args.frame_nums:
+        source = torch.rand(1, 3, frame_num, h, w, device=args.device) * 2 - 1
+        params = dict(frames=frame_num)
+        ref = report.time('color', 'reference_image', lambda: match_and_blend_colors(
+            source, reference, 1.0), **params)
+        out = report.time('color', 'reference_stats', lambda: match_and_blend_colors(
+            source, reference, 1.0, reference_stats=reference_stats), **params)
+        report.check('color', 'reference_stats', ref, out, atol=1e-6, **params)
+        out = match_and_blend_colors(source, reference, 1.0, reference_stats=reference_stats, frames_per_batch=4)
+        report.check('color', 'frames_per_batch', ref, out, atol=1e-6, **params)
+
+
+def bench_save_video(report, args, fps=25):
+    if shutil.which("ffmpeg") is None:
+        print("save_video: ffmpeg not found, skipped")
+        return
+    h, w = args.size
+    with tempfile.TemporaryDirectory() as tmp:
+        for frame_num in args.frame_nums:
+            audio_path = os.path.join(tmp, "audio.wav")
+            t = np.arange(int(16000 * (frame_num / fps + 1))) / 16000
+            sf.write(audio_path, 0.1 * np.sin(2 * np.pi * 440 * t), 16000)
+            video = torch.rand(3, frame_num, h, w) * 2 - 1
+            save_path = os.path.join(tmp, "video")
+            report.time('save_video', 'save_video_ffmpeg', lambda: save_video_ffmpeg(
+                video, save_path, [audio_path], fps=fps), iters=min(args.iters, 3), frames=frame_num)
+
+
+def bench_kokoro(report, args):
+    model = build_kokoro(args.device, seed=args.seed)
+    phonemes = ["hello world", "the quick brown fox jumps", "talk", "over the lazy dog"]
+    generator = torch.Generator().manual_seed(args.seed)
+    ref_s = torch.randn(len(phonemes), 256, generator=generator)
+    params = dict(items=len(phonemes))
+
+    def forward_sequential():
+        return [model(ps, ref_s[i:i + 1], return_output=True) for i, ps in enumerate(phonemes)]
+
+    ref = report.time('kokoro', 'forward_sequential', forward_sequential, **params)
+    out = report.time('kokoro', 'forward_batch', lambda: model.forward_batch(phonemes, ref_s), **params)
+    # a float reordering may round one token's duration to the neighbouring frame
+    report.check('kokoro', 'durations', [o.pred_dur for o in ref], [o.pred_dur for o in out], atol=1, **params)
+    # the harmonic source draws random phases and noise, zero them so that the audio of
+    # both paths is comparable; the padded batch is not exact at the item ends
+    with mock.patch.object(torch, 'rand', torch.zeros), mock.patch.object(torch, 'randn_like', torch.zeros_like):
+        ref, out = forward_sequential(), model.forward_batch(phonemes, ref_s)
+    report.measure('kokoro', 'forward_batch_audio', [o.audio for o in ref], [o.audio for o in out], **params)
+
+
+def compare(report, baseline, drift_tol):
+    """Print the speed ratio of every entry present in both runs, returns the drifted entries
+    and the approximate paths whose error grew."""
+    def key(entry):
+        return entry['case'], entry['name'], json.dumps(entry['params'], sort_keys=True)
+
+    base = {key(e): e for e in baseline['results']}
+    print(f"\ncompared with {baseline['meta'].get('commit')} (speedup = baseline mean / this mean)")
+    drifted = []
+    for entry in report.results:
+        old = base.get(key(entry))
+        if old is None:
+            continue
+        speedup = old['mean_ms'] / entry['mean_ms']
+        drift = 0.0
+        if old['fingerprint'] is not None and entry['fingerprint'] is not None:
+            drift = max(abs(entry['fingerprint'][k] - old['fingerprint'][k]) / (abs(old['fingerprint'][k]) + 1e-6)
+                        for k in ('mean', 'abs_mean', 'std'))
+            if old['fingerprint']['numel'] != entry['fingerprint']['numel']:
+                drift = float('inf')
+        if drift > drift_tol:
+            drifted.append(entry)
+        print(f"{entry['case']:<10} {entry['name']:<24} {key(entry)[2]:<40} "
+              f"{speedup:6.2f}x  drift {drift:.1e}{'  DRIFTED' if drift > drift_tol else ''}")
+
+    # errors of the approximate paths may shrink, not grow
+    base = {key(e): e for e in baseline.get('errors', [])}
+    for entry in report.errors:
+        old = base.get(key(entry))
+        if old is None:
+            continue
+        grew = entry['rel_l2_err'] > old['rel_l2_err'] * (1 + drift_tol) + 1e-6
+        if grew:
+            drifted.append(entry)
+        print(f"{entry['case']:<10} error {entry['name']:<18} {key(entry)[2]:<40} "
+              f"rel l2 err {old['rel_l2_err']:.3e} -> {entry['rel_l2_err']:.3e}{'  GREW' if grew else ''}")
+    return drifted
+
+
+def main(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    dtype = getattr(torch, args.dtype)
+    report = Report(args)
+    benches = dict(
+        rope=lambda: bench_rope(report, args, dtype),
+        dit=lambda: bench_dit(report, args, dtype),
+        audio_proj=lambda: bench_audio_proj(report, args, dtype),
+        t5=lambda: bench_t5(report, args, dtype),
+        vae=lambda: bench_vae(report, args),
+        attn_map=lambda: bench_attn_map(report, args, dtype),
+        color=lambda: bench_color(report, args),
+        save_video=lambda: bench_save_video(report, args),
+        kokoro=lambda: bench_kokoro(report, args),
+    )
+    with torch.no_grad():
+        for case in args.cases:
+            benches[case]()
+
+    result = report.to_dict()
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"results written to {args.output}")
+
+    failed = [c for c in report.checks if not c['passed']]
+    drifted = []
+    if args.compare is not None:
+        with open(args.compare) as f:
+            drifted = compare(report, json.load(f), args.drift_tol)
+    if failed or drifted:
+        print(f"{len(failed)} failed checks, {len(drifted)} drifted outputs")
+    return result, bool(failed or drifted)
+
+
+if __name__ == "__main__":
+    _, failed = main(_parse_args())
+    sys.exit(1 if failed else 0)
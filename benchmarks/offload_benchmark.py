@@ -0,0 +1,153 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+Per-step latency of the DiT in the low-VRAM preset (`--num_persistent_param_in_dit 0`,
+which predict.py uses for 480p).
+
+Builds a randomly initialised WanModel with the 14B block sizes, wraps it like
+`InfiniteTalkPipeline.enable_vram_management` and times one sampling step
+(`--cfg_branches` forwards) for each mode:
+
+    legacy    AutoWrappedModule deep-copies the module on every call (previous behaviour)
+    default   parameters are transferred and passed through torch.func.functional_call
+    prefetch  default plus OffloadPrefetcher (--prefetch_offload)
+
+The full model (--num_layers 40) needs about 30 GB of host memory.
+
+    python -m benchmarks.offload_benchmark --num_layers 8 --modes legacy default prefetch
+"""
+import argparse
+import copy
+
+import torch
+
+from src.vram_management import (
+    AutoWrappedLinear,
+    AutoWrappedModule,
+    OffloadPrefetcher,
+    enable_vram_management,
+)
+from wan.modules.multitalk_model import WanLayerNorm, WanModel, WanRMSNorm
+
+from .rope_benchmark import time_fn
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the DiT step latency with offloaded weights")
+    parser.add_argument("--num_layers", type=int, default=8, help="DiT blocks, 40 for the 14B model.")
+    parser.add_argument("--size", type=int, nargs=2, default=[640, 640], help="Video height and width.")
+    parser.add_argument("--frame_num", type=int, default=81)
+    parser.add_argument("--cfg_branches", type=int, default=3, help="Forwards per sampling step.")
+    parser.add_argument("--num_persistent_param_in_dit", type=int, default=0)
+    parser.add_argument("--modes", type=str, nargs="+", default=["legacy", "default", "prefetch"],
+                        choices=["legacy", "default", "prefetch"])
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--iters", type=int, default=3)
+    return parser.parse_args()
+
+
+def _legacy_forward(self, *args, **kwargs):
+    if (
+        self.onload_dtype == self.computation_dtype
+        and self.onload_device == self.computation_device
+    ):
+        module = self.module
+    else:
+        module = copy.deepcopy(self.module).to(
+            dtype=self.computation_dtype, device=self.computation_device
+        )
+    return module(*args, **kwargs)
+
+
+def build_model(args, dtype):
+    model = WanModel(
+        in_dim=36,
+        dim=5120,
+        ffn_dim=13824,
+        num_heads=40,
+        num_layers=args.num_layers,
+        weight_init=False,
+    ).to(dtype).eval().requires_grad_(False)
+    enable_vram_management(
+        model,
+        module_map={
+            torch.nn.Linear: AutoWrappedLinear,
+            torch.nn.Conv3d: AutoWrappedModule,
+            torch.nn.LayerNorm: AutoWrappedModule,
+            WanLayerNorm: AutoWrappedModule,
+            WanRMSNorm: AutoWrappedModule,
+        },
+        module_config=dict(
+            offload_dtype=dtype,
+            offload_device="cpu",
+            onload_dtype=dtype,
+            onload_device=args.device,
+            computation_dtype=dtype,
+            computation_device=args.device,
+        ),
+        max_num_param=args.num_persistent_param_in_dit,
+        overflow_module_config=dict(
+            offload_dtype=dtype,
+            offload_device="cpu",
+            onload_dtype=dtype,
+            onload_device="cpu",
+            computation_dtype=dtype,
+            computation_device=args.device,
+        ),
+    )
+    for module in model.modules():
+        if hasattr(module, "onload"):
+            module.onload()
+    return model
+
+
+def build_inputs(args, dtype):
+    h, w = args.size
+    lat_t, lat_h, lat_w = (args.frame_num - 1) // 4 + 1, h // 8, w // 8
+    device = args.device
+    return dict(
+        x=[torch.randn(16, lat_t, lat_h, lat_w, device=device)],
+        t=torch.tensor([999.0], device=device),
+        context=[torch.randn(512, 4096, device=device, dtype=dtype)],
+        seq_len=lat_t * lat_h * lat_w // 4,
+        clip_fea=torch.randn(1, 257, 1280, device=device, dtype=dtype),
+        y=torch.randn(1, 20, lat_t, lat_h, lat_w, device=device, dtype=dtype),
+        audio=torch.randn(1, args.frame_num, 5, 12, 768, device=device, dtype=dtype),
+        ref_target_masks=torch.ones(3, lat_h, lat_w, device=device),
+    )
+
+
+def main(args):
+    dtype = torch.bfloat16
+    model = build_model(args, dtype)
+    inputs = build_inputs(args, dtype)
+
+    def step():
+        with torch.no_grad():
+            for _ in range(args.cfg_branches):
+                model(**{**inputs, 'x': [u.clone() for u in inputs['x']]})
+
+    print(f"layers={args.num_layers} size={tuple(args.size)} frames={args.frame_num} "
+          f"persistent={args.num_persistent_param_in_dit} branches={args.cfg_branches}")
+    results = {}
+    default_forward = AutoWrappedModule.forward
+    for mode in args.modes:
+        prefetcher = None
+        if mode == "legacy":
+            AutoWrappedModule.forward = _legacy_forward
+        elif mode == "prefetch":
+            prefetcher = OffloadPrefetcher(model.blocks, args.device)
+        try:
+            results[mode] = time_fn(step, args.device, args.warmup, args.iters)
+        finally:
+            AutoWrappedModule.forward = default_forward
+            if prefetcher is not None:
+                prefetcher.remove()
+        print(f"{mode:9s}: {results[mode]:8.3f} s/step  "
+              f"peak {torch.cuda.max_memory_allocated(args.device) / 2**30:.2f} GiB")
+        torch.cuda.reset_peak_memory_stats(args.device)
+    return results
+
+
+if __name__ == "__main__":
+    main(_parse_args())
@@ -0,0 +1,82 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+Micro-benchmark for the DiT rotary embedding.
+
+Compares the reference float64 `rope_apply` with the cached fp32 `RopeCache`
+on random queries and reports the max deviation and the time per call.
+
+    python -m benchmarks.rope_benchmark --grid 21 30 52 --device cuda
+"""
+import argparse
+import time
+
+import torch
+
+from wan.modules.multitalk_model import RopeCache, rope_apply, rope_params
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark rope_apply against RopeCache")
+    parser.add_argument("--grid", type=int, nargs=3, default=[21, 30, 52], help="Token grid (f, h, w).")
+    parser.add_argument("--batch", type=int, default=1, help="Batch size, e.g. 3 for batched CFG.")
+    parser.add_argument("--num_heads", type=int, default=40)
+    parser.add_argument("--head_dim", type=int, default=128)
+    parser.add_argument("--dtype", type=str, default="bfloat16", choices=["float32", "bfloat16", "float16"])
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--iters", type=int, default=20)
+    return parser.parse_args()
+
+
+def build_freqs(head_dim):
+    d = head_dim
+    return torch.cat([
+        rope_params(1024, d - 4 * (d // 6)),
+        rope_params(1024, 2 * (d // 6)),
+        rope_params(1024, 2 * (d // 6))
+    ],
+                     dim=1)
+
+
+def _sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_fn(fn, device, warmup, iters):
+    for _ in range(warmup):
+        fn()
+    _sync(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    _sync(device)
+    return (time.perf_counter() - start) / iters
+
+
+def main(args):
+    f, h, w = args.grid
+    dtype = getattr(torch, args.dtype)
+    freqs = build_freqs(args.head_dim)
+    rope_cache = RopeCache(freqs)
+
+    x = torch.randn(args.batch, f * h * w, args.num_heads, args.head_dim, device=args.device, dtype=dtype)
+    grid_sizes = torch.tensor([[f, h, w]] * args.batch, dtype=torch.long)
+
+    ref = rope_apply(x, grid_sizes, freqs)
+    out = rope_cache.apply(x, grid_sizes)
+    max_err = (ref - out).abs().max().item()
+
+    t_ref = time_fn(lambda: rope_apply(x, grid_sizes, freqs), args.device, args.warmup, args.iters)
+    t_new = time_fn(lambda: rope_cache.apply(x, grid_sizes), args.device, args.warmup, args.iters)
+
+    print(f"grid={tuple(args.grid)} batch={args.batch} heads={args.num_heads} head_dim={args.head_dim} "
+          f"dtype={args.dtype} device={args.device}")
+    print(f"rope_apply (float64 complex): {t_ref * 1e3:8.3f} ms")
+    print(f"RopeCache  (fp32 cached)    : {t_new * 1e3:8.3f} ms  ({t_ref / t_new:.1f}x)")
+    print(f"max abs error: {max_err:.3e}")
+    return max_err
+
+
+if __name__ == "__main__":
+    main(_parse_args())
@@ -0,0 +1,162 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+Scaled-down, randomly initialised versions of the InfiniteTalk models.
+
+The layouts are the real ones, only the widths and depths are cut down, so every code
+path of the pipeline runs on a CPU in milliseconds. Sizes that are hard-coded in the
+modules are kept: 257 CLIP tokens of width 1280, wav2vec windows of 5 x 12 x 768, 36
+DiT input channels and the 128-dim Kokoro style halves.
+
+Every builder seeds torch, so two checkouts build bit-identical weights and the
+outputs of `benchmarks.micro_benchmark` are comparable between commits.
+"""
+import torch
+import torch.nn as nn
+
+from kokoro.model import KModel
+from wan.modules.multitalk_model import AudioProjModel, WanModel
+from wan.modules.t5 import T5Encoder
+from wan.modules.vae import WanVAE
+
+TINY_WAN_CONFIG = dict(
+    model_type='i2v',
+    text_len=32,
+    in_dim=36,
+    dim=128,
+    ffn_dim=256,
+    freq_dim=64,
+    text_dim=64,
+    out_dim=16,
+    num_heads=4,
+    num_layers=2,
+    intermediate_dim=64,
+    output_dim=128,
+    context_tokens=8,
+)
+
+# z_dim matches the 16-channel latent statistics of `WanVAE`
+TINY_VAE_CONFIG = dict(
+    dim=16,
+    z_dim=16,
+    dim_mult=[1, 2, 2, 2],
+    num_res_blocks=1,
+    attn_scales=[],
+    temperal_downsample=[False, True, True],
+)
+
+TINY_T5_CONFIG = dict(
+    vocab=256,
+    dim=64,
+    dim_attn=64,
+    dim_ffn=128,
+    num_heads=4,
+    num_layers=2,
+    num_buckets=32,
+    shared_pos=False,
+    dropout=0.0,
+)
+
+# decoder widths and the istft layout are fixed by the Kokoro modules
+TINY_KOKORO_CONFIG = dict(
+    vocab={c: i + 1 for i, c in enumerate('abcdefghijklmnopqrstuvwxyz ')},
+    n_token=32,
+    hidden_dim=512,
+    style_dim=128,
+    n_layer=1,
+    max_dur=8,
+    dropout=0.0,
+    text_encoder_kernel_size=5,
+    n_mels=80,
+    plbert=dict(
+        hidden_size=64,
+        num_attention_heads=4,
+        intermediate_size=128,
+        max_position_embeddings=64,
+        num_hidden_layers=2,
+        dropout=0.0,
+    ),
+    istftnet=dict(
+        upsample_kernel_sizes=[20, 12],
+        upsample_rates=[10, 6],
+        gen_istft_hop_size=5,
+        gen_istft_n_fft=20,
+        resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+        resblock_kernel_sizes=[3, 7, 11],
+        upsample_initial_channel=512,
+    ),
+)
+
+
+def _finish(model, device, dtype=None):
+    model = model.eval().requires_grad_(False)
+    if dtype is not None:
+        model = model.to(dtype)
+    return model.to(device)
+
+
+def build_wan_model(device='cpu', dtype=torch.float32, seed=0, **config):
+    torch.manual_seed(seed)
+    model = WanModel(**{**TINY_WAN_CONFIG, **config})
+    # the head is zero-initialised for training, which would make every output zero
+    nn.init.normal_(model.head.head.weight, std=0.02)
+    return _finish(model, device, dtype)
+
+
+def build_audio_proj(device='cpu', dtype=torch.float32, seed=0):
+    torch.manual_seed(seed)
+    c = TINY_WAN_CONFIG
+    model = AudioProjModel(
+        seq_len=5,
+        seq_len_vf=8,
+        intermediate_dim=c['intermediate_dim'],
+        output_dim=c['output_dim'],
+        context_tokens=c['context_tokens'],
+        norm_output_audio=True,
+    )
+    return _finish(model, device, dtype)
+
+
+def build_vae(device='cpu', seed=0):
+    """`WanVAE` wrapper, with its tiling, in fp32 like the pipeline."""
+    torch.manual_seed(seed)
+    return WanVAE(vae_pth=None, device=device, **TINY_VAE_CONFIG)
+
+
+def build_t5_encoder(device='cpu', dtype=torch.float32, seed=0):
+    torch.manual_seed(seed)
+    return _finish(T5Encoder(**TINY_T5_CONFIG), device, dtype)
+
+
+def build_kokoro(device='cpu', seed=0):
+    torch.manual_seed(seed)
+    model = KModel(repo_id='hexgrad/Kokoro-82M', config=TINY_KOKORO_CONFIG, model=False)
+    return _finish(model, device)
+
+
+def build_dit_inputs(frame_num=5, size=(64, 64), human_num=1, device='cpu', dtype=torch.float32, seed=0):
+    """
+    Inputs of one `WanModel` forward for a clip of `frame_num` video frames at `size`,
+    laid out like `InfiniteTalkPipeline.generate_infinitetalk` builds them.
+    """
+    c = TINY_WAN_CONFIG
+    generator = torch.Generator().manual_seed(seed)
+
+    def randn(*shape):
+        return torch.randn(*shape, generator=generator).to(device=device, dtype=dtype)
+
+    h, w = size
+    lat_t, lat_h, lat_w = (frame_num - 1) // 4 + 1, h // 8, w // 8
+    ref_target_masks = torch.zeros(human_num + 1, lat_h, lat_w, device=device)
+    for i in range(human_num):
+        ref_target_masks[i, :, i * lat_w // human_num:(i + 1) * lat_w // human_num] = 1
+    ref_target_masks[-1] = 1
+    return dict(
+        x=[randn(16, lat_t, lat_h, lat_w).float()],
+        t=torch.tensor([999.0], device=device),
+        context=[randn(c['text_len'] - 8, c['text_dim'])],
+        seq_len=lat_t * lat_h * lat_w // 4,
+        clip_fea=randn(1, 257, 1280),
+        y=randn(1, 20, lat_t, lat_h, lat_w),
+        audio=randn(human_num, frame_num, 5, 12, 768),
+        ref_target_masks=ref_target_masks,
+    )
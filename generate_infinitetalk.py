@@ -4,8 +4,12 @@ import logging
 import os
 import sys
 import json
+import copy
+import socket
+import uuid
 import warnings
 from datetime import datetime
+from functools import partial
 
 warnings.filterwarnings('ignore')
 
@@ -19,8 +23,12 @@ import subprocess
 import wan
 from wan.configs import SIZE_CONFIGS, SUPPORTED_SIZES, WAN_CONFIGS
 from wan.utils.utils import str2bool, is_video, split_wav_librosa
-from wan.utils.multitalk_utils import save_video_ffmpeg
-from kokoro import KPipeline
+from src.audio_analysis.chunked_embedding import stream_embedding
+from src.audio_analysis.embedding_cache import AudioEmbeddingCache
+from wan.utils.vram_planner import plan_placement, log_plan
+from wan.utils.multitalk_utils import save_video_ffmpeg, StreamingVideoWriter
+from wan.utils.tracer import NULL_TRACER, StageTracer
+from kokoro import get_tts_service
 from transformers import Wav2Vec2FeatureExtractor
 from src.audio_analysis.wav2vec2 import Wav2Vec2Model
 from wan.utils.segvideo import shot_detect
@@ -36,7 +44,7 @@ import re
 
 def _validate_args(args):
     # Basic check
-    assert args.ckpt_dir is not None, "Please specify the checkpoint directory."
+    assert args.submit or args.ckpt_dir is not None, "Please specify the checkpoint directory."
     assert args.task in WAN_CONFIGS, f"Unsupport task: {args.task}"
 
     # The default sampling steps are 40 for image-to-video tasks and 50 for text-to-video tasks.
@@ -57,6 +65,9 @@ def _validate_args(args):
     assert args.size in SUPPORTED_SIZES[
         args.
         task], f"Unsupport size {args.size} for task {args.task}, supported sizes are: {', '.join(SUPPORTED_SIZES[args.task])}"
+    if args.vae_tile_size is not None:
+        assert args.vae_tile_size > args.vae_tile_overlap >= 8, \
+            "--vae_tile_overlap must be at least 8 and smaller than --vae_tile_size."
 
 
 def _parse_args():
@@ -191,6 +202,12 @@ def _parse_args():
         help="clip: generate one video chunk, streaming: long video generation")
     parser.add_argument(
         "--sample_steps", type=int, default=None, help="The sampling steps.")
+    parser.add_argument(
+        "--sample_solver",
+        type=str,
+        default='euler',
+        choices=['euler', 'unipc', 'dpm++'],
+        help="The solver used to sample. The multistep solvers reach the quality of 40 Euler steps with fewer --sample_steps.")
     parser.add_argument(
         "--sample_shift",
         type=float,
@@ -231,6 +248,107 @@ def _parse_args():
         default=0.2,
         help="Threshold for teacache."
     )
+    parser.add_argument(
+        "--teacache_coefficients",
+        type=str,
+        default=None,
+        help="JSON file of TeaCache coefficients written by tools/calibrate_teacache.py. "
+        "Defaults to the built-in ones, fitted for 40 Euler steps."
+    )
+    parser.add_argument(
+        "--batched_cfg",
+        action="store_true",
+        default=False,
+        help="Run the cond / drop-text / uncond DiT passes of each step as one batch. Needs extra VRAM for activations."
+    )
+    parser.add_argument(
+        "--cache_cond_kv",
+        action="store_true",
+        default=False,
+        help="Precompute the per-block text/image/audio cross-attention K/V once per clip. Needs extra VRAM."
+    )
+    parser.add_argument(
+        "--ref_attn_map_block",
+        type=int,
+        default=None,
+        help="Multi-person only: compute the speaker reference attention map up to this block and reuse it in later blocks."
+    )
+    parser.add_argument(
+        "--async_postprocess",
+        action="store_true",
+        default=False,
+        help="Copy, colour-correct and write each decoded clip in the background while the next clip is sampled."
+    )
+    parser.add_argument(
+        "--prefetch_offload",
+        action="store_true",
+        default=False,
+        help="With --num_persistent_param_in_dit, keep offloaded weights in pinned memory and copy the next block's weights on a side stream while the current block runs."
+    )
+    parser.add_argument(
+        "--auto_vram",
+        action="store_true",
+        default=False,
+        help="Choose offload_model, t5_cpu and num_persistent_param_in_dit from the VRAM budget, the size and frame_num."
+    )
+    parser.add_argument(
+        "--vram_budget",
+        type=float,
+        default=None,
+        help="VRAM budget in GiB for --auto_vram, defaults to the free memory of the GPU."
+    )
+    parser.add_argument(
+        "--audio_cache_dir",
+        type=str,
+        default=None,
+        help="Cache wav2vec2 embeddings in this directory, keyed by the audio content."
+    )
+    parser.add_argument(
+        "--audio_cache_size",
+        type=float,
+        default=10,
+        help="Size limit of --audio_cache_dir in GiB, least recently used entries are evicted."
+    )
+    parser.add_argument(
+        "--audio_chunk_seconds",
+        type=float,
+        default=None,
+        help="Encode the audio in windows of this many seconds, on the GPU, while the video is generated. "
+        "Bounds the wav2vec2 memory for long audio. By default the whole clip is encoded at once on the CPU."
+    )
+    parser.add_argument(
+        "--vae_tile_size",
+        type=int,
+        default=None,
+        help="Encode and decode with the VAE in overlapping spatial tiles of this many latent pixels (8 video pixels), "
+        "bounding its memory independently of the resolution. The output is not identical to the untiled encode and "
+        "decode: the tiles do not see each other's context, so pixels near the seams differ. 32 is a good start; by "
+        "default tiling is off."
+    )
+    parser.add_argument(
+        "--vae_tile_overlap",
+        type=int,
+        default=16,
+        help="Overlap of neighbouring --vae_tile_size tiles in latent pixels, blended linearly. The seam error falls "
+        "with the overlap, so at least 8 is required."
+    )
+    parser.add_argument(
+        "--memory_policy",
+        type=str,
+        default="pressure",
+        choices=["always", "clip", "pressure", "never"],
+        help="When to hand cached CUDA memory back: after every DiT forward (always, the old behaviour), "
+        "between clips, only above 90%% of the card (pressure) or never. The per-stage peaks and the "
+        "fastest policy that fits are logged after each run."
+    )
+    parser.add_argument(
+        "--trace_file",
+        type=str,
+        default=None,
+        help="Time every stage of the job (audio, encoders, each DiT forward per CFG branch, VAE, "
+        "post-processing, ffmpeg) and write a Chrome trace JSON to this path. Waits for the GPU "
+        "at stage boundaries, so use it for profiling only."
+    )
     parser.add_argument(
         "--use_apg",
         action="store_true",
@@ -261,6 +379,36 @@ def _parse_args():
         default=False,
         help="Enable scene segmentation for input video."
     )
+    parser.add_argument(
+        "--stream_output",
+        action="store_true",
+        default=False,
+        help="Encode each finished clip right away instead of keeping the whole video in memory."
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        default=False,
+        help="Load the models once and serve generation jobs on --worker_host:--worker_port."
+    )
+    parser.add_argument(
+        "--submit",
+        action="store_true",
+        default=False,
+        help="Send --input_json to a running worker instead of loading the models."
+    )
+    parser.add_argument(
+        "--worker_host",
+        type=str,
+        default="127.0.0.1",
+        help="Address the worker listens on."
+    )
+    parser.add_argument(
+        "--worker_port",
+        type=int,
+        default=8765,
+        help="Port the worker listens on."
+    )
     parser.add_argument(
         "--quant",
         type=str,
@@ -288,16 +436,16 @@ def loudness_norm(audio_array, sr=16000, lufs=-23):
     normalized_audio = pyln.normalize.loudness(audio_array, loudness, lufs)
     return normalized_audio
 
-def audio_prepare_multi(left_path, right_path, audio_type, sample_rate=16000):
+def audio_prepare_multi(left_path, right_path, audio_type, sample_rate=16000, tracer=NULL_TRACER):
 
     if not (left_path=='None' or right_path=='None'):
-        human_speech_array1 = audio_prepare_single(left_path)
-        human_speech_array2 = audio_prepare_single(right_path)
+        human_speech_array1 = audio_prepare_single(left_path, tracer=tracer)
+        human_speech_array2 = audio_prepare_single(right_path, tracer=tracer)
     elif left_path=='None':
-        human_speech_array2 = audio_prepare_single(right_path)
+        human_speech_array2 = audio_prepare_single(right_path, tracer=tracer)
         human_speech_array1 = np.zeros(human_speech_array2.shape[0])
     elif right_path=='None':
-        human_speech_array1 = audio_prepare_single(left_path)
+        human_speech_array1 = audio_prepare_single(left_path, tracer=tracer)
         human_speech_array2 = np.zeros(human_speech_array1.shape[0])
 
     if audio_type=='para':
@@ -320,7 +468,16 @@ def _init_logging(rank):
     else:
         logging.basicConfig(level=logging.ERROR)
 
-def get_embedding(speech_array, wav2vec_feature_extractor, audio_encoder, sr=16000, device='cpu'):
+def get_embedding(speech_array, wav2vec_feature_extractor, audio_encoder, sr=16000, device='cpu', audio_cache=None,
+                  chunk_seconds=None):
+    if chunk_seconds is not None:
+        return stream_embedding(speech_array, wav2vec_feature_extractor, audio_encoder, sr=sr,
+                                chunk_seconds=chunk_seconds, audio_cache=audio_cache)
+    if audio_cache is not None:
+        return audio_cache.get_or_compute(
+            speech_array, sr,
+            lambda: get_embedding(speech_array, wav2vec_feature_extractor, audio_encoder, sr=sr, device=device))
+
     audio_duration = len(speech_array) / sr
     video_length = audio_duration * 25 # Assume the video fps is 25
 
@@ -345,7 +502,7 @@ def get_embedding(speech_array, wav2vec_feature_extractor, audio_encoder, sr=160
     audio_emb = audio_emb.cpu().detach()
     return audio_emb
 
-def extract_audio_from_video(filename, sample_rate):
+def extract_audio_from_video(filename, sample_rate, tracer=NULL_TRACER):
     raw_audio_path = filename.split('/')[-1].split('.')[0]+'.wav'
     ffmpeg_command = [
         "ffmpeg",
@@ -361,39 +518,30 @@ def extract_audio_from_video(filename, sample_rate):
         "2",
         str(raw_audio_path),
     ]
-    subprocess.run(ffmpeg_command, check=True)
-    human_speech_array, sr = librosa.load(raw_audio_path, sr=sample_rate)
-    human_speech_array = loudness_norm(human_speech_array, sr)
+    with tracer.span('audio_load', source='video'):
+        subprocess.run(ffmpeg_command, check=True)
+        human_speech_array, sr = librosa.load(raw_audio_path, sr=sample_rate)
+    with tracer.span('loudness_norm'):
+        human_speech_array = loudness_norm(human_speech_array, sr)
     os.remove(raw_audio_path)
 
     return human_speech_array
 
-def audio_prepare_single(audio_path, sample_rate=16000):
+def audio_prepare_single(audio_path, sample_rate=16000, tracer=NULL_TRACER):
     ext = os.path.splitext(audio_path)[1].lower()
     if ext in ['.mp4', '.mov', '.avi', '.mkv']:
-        human_speech_array = extract_audio_from_video(audio_path, sample_rate)
+        human_speech_array = extract_audio_from_video(audio_path, sample_rate, tracer=tracer)
         return human_speech_array
     else:
-        human_speech_array, sr = librosa.load(audio_path, sr=sample_rate)
-        human_speech_array = loudness_norm(human_speech_array, sr)
+        with tracer.span('audio_load'):
+            human_speech_array, sr = librosa.load(audio_path, sr=sample_rate)
+        with tracer.span('loudness_norm'):
+            human_speech_array = loudness_norm(human_speech_array, sr)
         return human_speech_array
 
 def process_tts_single(text, save_dir, voice1):    
-    s1_sentences = []
-
-    pipeline = KPipeline(lang_code='a', repo_id='weights/Kokoro-82M')
-
-    voice_tensor = torch.load(voice1, weights_only=True)
-    generator = pipeline(
-        text, voice=voice_tensor, # <= change voice here
-        speed=1, split_pattern=r'\n+'
-    )
-    audios = []
-    for i, (gs, ps, audio) in enumerate(generator):
-        audios.append(audio)
-    audios = torch.concat(audios, dim=0)
-    s1_sentences.append(audios)
-    s1_sentences = torch.concat(s1_sentences, dim=0)
+    tts = get_tts_service('weights/Kokoro-82M')
+    s1_sentences = tts.synthesize([(text, voice1)])[0]
     save_path1 =f'{save_dir}/s1.wav'
     sf.write(save_path1, s1_sentences, 24000) # save each audio file
     s1, _ = librosa.load(save_path1, sr=16000)
@@ -404,34 +552,20 @@ def process_tts_single(text, save_dir, voice1):
 def process_tts_multi(text, save_dir, voice1, voice2):
     pattern = r'\(s(\d+)\)\s*(.*?)(?=\s*\(s\d+\)|$)'
     matches = re.findall(pattern, text, re.DOTALL)
+    matches = [(speaker, content) for speaker, content in matches if speaker in ('1', '2')]
     
     s1_sentences = []
     s2_sentences = []
 
-    pipeline = KPipeline(lang_code='a', repo_id='weights/Kokoro-82M')
-    for idx, (speaker, content) in enumerate(matches):
+    # all turns go through the shared model in one call
+    tts = get_tts_service('weights/Kokoro-82M')
+    voices = {'1': voice1, '2': voice2}
+    turn_audios = tts.synthesize([(content, voices[speaker]) for speaker, content in matches])
+    for (speaker, content), audios in zip(matches, turn_audios):
         if speaker == '1':
-            voice_tensor = torch.load(voice1, weights_only=True)
-            generator = pipeline(
-                content, voice=voice_tensor, # <= change voice here
-                speed=1, split_pattern=r'\n+'
-            )
-            audios = []
-            for i, (gs, ps, audio) in enumerate(generator):
-                audios.append(audio)
-            audios = torch.concat(audios, dim=0)
             s1_sentences.append(audios)
             s2_sentences.append(torch.zeros_like(audios))
         elif speaker == '2':
-            voice_tensor = torch.load(voice2, weights_only=True)
-            generator = pipeline(
-                content, voice=voice_tensor, # <= change voice here
-                speed=1, split_pattern=r'\n+'
-            )
-            audios = []
-            for i, (gs, ps, audio) in enumerate(generator):
-                audios.append(audio)
-            audios = torch.concat(audios, dim=0)
             s2_sentences.append(audios)
             s1_sentences.append(torch.zeros_like(audios))
     
@@ -450,7 +584,7 @@ def process_tts_multi(text, save_dir, voice1, voice2):
     # sum, _ = librosa.load(save_path_sum, sr=16000)
     return s1, s2, save_path_sum
 
-def generate(args):
+def _init_distributed(args):
     rank = int(os.getenv("RANK", 0))
     world_size = int(os.getenv("WORLD_SIZE", 1))
     local_rank = int(os.getenv("LOCAL_RANK", 0))
@@ -519,11 +653,48 @@ def generate(args):
         args.base_seed = base_seed[0]
 
     assert args.task == "infinitetalk-14B", 'You should choose infinitetalk in args.task.'
-    
 
+    return rank, device
+
+
+def build_audio_cache(args):
+    if args.audio_cache_dir is None:
+        return None
+    return AudioEmbeddingCache(args.audio_cache_dir, args.wav2vec_dir,
+                               max_bytes=int(args.audio_cache_size * 1024 ** 3))
+
+
+def apply_vram_plan(args, device):
+    """Replace the hand-picked offload settings by a plan for the available VRAM."""
+    if int(os.getenv("WORLD_SIZE", 1)) > 1:
+        logging.warning("--auto_vram plans for a single GPU, ignored in multi-GPU runs.")
+        return
+    with open(os.path.join(args.ckpt_dir, "config.json"), 'r') as f:
+        wan_config = json.load(f)
+    plan = plan_placement(
+        wan_config,
+        size=args.size,
+        frame_num=args.frame_num,
+        budget=args.vram_budget,
+        device=device,
+        quant=args.quant,
+        num_branches=3 if args.batched_cfg else 1,
+        prefetch_offload=args.prefetch_offload,
+        vae_tile_size=args.vae_tile_size,
+    )
+    log_plan(plan)
+    args.offload_model = plan.offload_model
+    args.t5_cpu = plan.t5_cpu
+    args.num_persistent_param_in_dit = plan.num_persistent_param_in_dit
+
+
+def load_models(args, device, rank):
+    """Load the pipeline and the wav2vec2 audio encoder once, they are reused across jobs."""
+    if args.auto_vram:
+        apply_vram_plan(args, device)
     logging.info("Creating infinitetalk pipeline.")
     wan_i2v = wan.InfiniteTalkPipeline(
-        config=cfg,
+        config=WAN_CONFIGS[args.task],
         checkpoint_dir=args.ckpt_dir,
         quant_dir=args.quant_dir,
         device_id=device,
@@ -541,14 +712,30 @@ def generate(args):
     if args.num_persistent_param_in_dit is not None:
         wan_i2v.vram_management = True
         wan_i2v.enable_vram_management(
-            num_persistent_param_in_dit=args.num_persistent_param_in_dit
+            num_persistent_param_in_dit=args.num_persistent_param_in_dit,
+            prefetch_offload=args.prefetch_offload,
         )
-    
+    if args.vae_tile_size is not None:
+        wan_i2v.vae.enable_tiling(args.vae_tile_size, args.vae_tile_overlap)
+
+    # windowed extraction keeps the encoder's memory bounded, so it can share the GPU
+    audio_device = device if args.audio_chunk_seconds is not None and torch.cuda.is_available() else 'cpu'
+    wav2vec_feature_extractor, audio_encoder = custom_init(audio_device, args.wav2vec_dir)
+    return wan_i2v, wav2vec_feature_extractor, audio_encoder
+
+
+def run_job(args, input_data, wan_i2v, wav2vec_feature_extractor, audio_encoder, rank, report=None,
+            audio_cache=None, step_cache=None):
+    """
+    Generate one video for `input_data` (the `--input_json` schema) with already loaded models.
+    `report`, if given, receives progress messages as dicts; `audio_cache` is an optional
+    `AudioEmbeddingCache` and `step_cache` an optional TeaCache `StepCache` that replaces
+    the one of `--use_teacache`. Returns the path of the saved video.
+    """
+    report = report if report is not None else (lambda msg: None)
+    tracer = StageTracer() if args.trace_file is not None else NULL_TRACER
     generated_list = []
-    with open(args.input_json, 'r', encoding='utf-8') as f:
-        input_data = json.load(f)
-        
-    wav2vec_feature_extractor, audio_encoder= custom_init('cpu', args.wav2vec_dir)
+    args.save_file = input_data.get('save_file', args.save_file)
     args.audio_save_dir = os.path.join(args.audio_save_dir, input_data['cond_video'].split('/')[-1].split('.')[0])
     os.makedirs(args.audio_save_dir,exist_ok=True)
     
@@ -575,19 +762,29 @@ def generate(args):
             conds_list.append([input_data['cond_audio']['person2']])
 
     if len(input_data['cond_audio'])==2:
-        new_human_speech1, new_human_speech2, sum_human_speechs = audio_prepare_multi(input_data['cond_audio']['person1'], input_data['cond_audio']['person2'], input_data['audio_type'])
+        new_human_speech1, new_human_speech2, sum_human_speechs = audio_prepare_multi(input_data['cond_audio']['person1'], input_data['cond_audio']['person2'], input_data['audio_type'], tracer=tracer)
         sum_audio = os.path.join(args.audio_save_dir, 'sum_all.wav')
         sf.write(sum_audio, sum_human_speechs, 16000)
         input_data['video_audio'] = sum_audio
     else:
-        human_speech = audio_prepare_single(input_data['cond_audio']['person1'])
+        human_speech = audio_prepare_single(input_data['cond_audio']['person1'], tracer=tracer)
         sum_audio = os.path.join(args.audio_save_dir, 'sum_all.wav')
         sf.write(sum_audio, human_speech, 16000)
         input_data['video_audio'] = sum_audio
     logging.info("Generating video ...")
+
+    if args.save_file is None:
+        formatted_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+        formatted_prompt = input_data['prompt'].replace(" ", "_").replace("/",
+                                                                    "_")[:50]
+        args.save_file = f"{args.task}_{args.size.replace('*','x') if sys.platform=='win32' else args.size}_{args.ulysses_size}_{args.ring_size}_{formatted_prompt}_{formatted_time}"
+
+    video_writer = StreamingVideoWriter(args.save_file, tracer=tracer) if args.stream_output else None
+    num_segments = len(conds_list[0])
         
     for idx, items in enumerate(zip(*conds_list)):
         print(items)
+        report({'status': 'progress', 'segment': idx, 'num_segments': num_segments, 'stage': 'audio'})
         input_clip = {}
         input_clip['prompt'] = input_data['prompt']
         input_clip['cond_video'] = items[0]
@@ -599,27 +796,23 @@ def generate(args):
         cond_audio = {}
         if args.audio_mode=='localfile':
             if len(input_data['cond_audio'])==2:
-                new_human_speech1, new_human_speech2, sum_human_speechs = audio_prepare_multi(items[1], items[2], input_data['audio_type'])
-                audio_embedding_1 = get_embedding(new_human_speech1, wav2vec_feature_extractor, audio_encoder)
-                audio_embedding_2 = get_embedding(new_human_speech2, wav2vec_feature_extractor, audio_encoder)
-                emb1_path = os.path.join(args.audio_save_dir, '1.pt')
-                emb2_path = os.path.join(args.audio_save_dir, '2.pt')
+                new_human_speech1, new_human_speech2, sum_human_speechs = audio_prepare_multi(items[1], items[2], input_data['audio_type'], tracer=tracer)
+                with tracer.span('wav2vec_embed'):
+                    audio_embedding_1 = get_embedding(new_human_speech1, wav2vec_feature_extractor, audio_encoder, audio_cache=audio_cache, chunk_seconds=args.audio_chunk_seconds)
+                    audio_embedding_2 = get_embedding(new_human_speech2, wav2vec_feature_extractor, audio_encoder, audio_cache=audio_cache, chunk_seconds=args.audio_chunk_seconds)
                 sum_audio = os.path.join(args.audio_save_dir, 'sum.wav')
                 sf.write(sum_audio, sum_human_speechs, 16000)
-                torch.save(audio_embedding_1, emb1_path)
-                torch.save(audio_embedding_2, emb2_path)
-                cond_audio['person1'] = emb1_path
-                cond_audio['person2'] = emb2_path
+                cond_audio['person1'] = audio_embedding_1
+                cond_audio['person2'] = audio_embedding_2
                 input_clip['video_audio'] = sum_audio
                 v_length = audio_embedding_1.shape[0]
             elif len(input_data['cond_audio'])==1:
-                human_speech = audio_prepare_single(items[1])
-                audio_embedding = get_embedding(human_speech, wav2vec_feature_extractor, audio_encoder)
-                emb_path = os.path.join(args.audio_save_dir, '1.pt')
+                human_speech = audio_prepare_single(items[1], tracer=tracer)
+                with tracer.span('wav2vec_embed'):
+                    audio_embedding = get_embedding(human_speech, wav2vec_feature_extractor, audio_encoder, audio_cache=audio_cache, chunk_seconds=args.audio_chunk_seconds)
                 sum_audio = os.path.join(args.audio_save_dir, 'sum.wav')
                 sf.write(sum_audio, human_speech, 16000)
-                torch.save(audio_embedding, emb_path)
-                cond_audio['person1'] = emb_path
+                cond_audio['person1'] = audio_embedding
                 input_clip['video_audio'] = sum_audio
                 v_length = audio_embedding.shape[0]
         
@@ -638,26 +831,132 @@ def generate(args):
             offload_model=args.offload_model,
             max_frames_num=args.frame_num if args.mode == 'clip' else args.max_frame_num,
             color_correction_strength = args.color_correction_strength,
+            video_writer=video_writer,
+            progress_callback=lambda done, total: report({
+                'status': 'progress', 'segment': idx, 'num_segments': num_segments,
+                'stage': 'video', 'frames': done, 'total_frames': total}),
+            step_cache=step_cache,
+            tracer=tracer,
             extra_args=args,
             )
         
         generated_list.append(video)
 
     if rank == 0:
-        
-        if args.save_file is None:
-            formatted_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-            formatted_prompt = input_clip['prompt'].replace(" ", "_").replace("/",
-                                                                        "_")[:50]
-            args.save_file = f"{args.task}_{args.size.replace('*','x') if sys.platform=='win32' else args.size}_{args.ulysses_size}_{args.ring_size}_{formatted_prompt}_{formatted_time}"
-        
-        sum_video = torch.cat(generated_list, dim=1)
-        save_video_ffmpeg(sum_video, args.save_file, [input_data['video_audio']], high_quality_save=False)
+        if video_writer is not None:
+            video_writer.mux(input_data['video_audio'])
+        else:
+            sum_video = torch.cat(generated_list, dim=1)
+            save_video_ffmpeg(sum_video, args.save_file, [input_data['video_audio']], high_quality_save=False,
+                              tracer=tracer)
    
     logging.info(f"Saving generated video to {args.save_file}.mp4")  
+    if tracer.enabled and rank == 0:
+        tracer.log_summary()
+        tracer.save_chrome_trace(args.trace_file)
+        logging.info(f"Saved the stage trace to {args.trace_file}, open it in chrome://tracing or ui.perfetto.dev.")
     logging.info("Finished.")
+    return f"{args.save_file}.mp4"
+
+
+def generate(args):
+    rank, device = _init_distributed(args)
+    models = load_models(args, device, rank)
+    with open(args.input_json, 'r', encoding='utf-8') as f:
+        input_data = json.load(f)
+    run_job(args, input_data, *models, rank, audio_cache=build_audio_cache(args))
+
+
+def _send(conn, msg):
+    try:
+        conn.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+    except OSError:
+        # the client went away, keep the job running
+        pass
+
+
+def serve(args):
+    """
+    Worker mode: load the models once, then take jobs from a local socket one at a time.
+
+    A job is one line of JSON in the `--input_json` schema, optionally with `save_file`.
+    Without one, the output is named after the worker's `--save_file` plus a unique suffix,
+    or with the timestamped default.
+    Progress and the final output path are streamed back as JSON lines; `{"command": "shutdown"}`
+    stops the worker. Under torchrun, rank 0 accepts jobs and broadcasts them to the other ranks.
+    """
+    rank, device = _init_distributed(args)
+    models = load_models(args, device, rank)
+
+    audio_cache = build_audio_cache(args)
+    server = None
+    if rank == 0:
+        server = socket.create_server((args.worker_host, args.worker_port))
+        logging.info(f"Worker ready on {args.worker_host}:{args.worker_port}.")
+
+    while True:
+        conn, job = None, None
+        if rank == 0:
+            conn, _ = server.accept()
+            try:
+                job = json.loads(conn.makefile('r', encoding='utf-8').readline())
+                if not isinstance(job, dict):
+                    raise ValueError(f"expected a JSON object, got {type(job).__name__}")
+            except ValueError as e:
+                _send(conn, {'status': 'error', 'message': f"Invalid job: {e}"})
+                conn.close()
+                continue
+            if 'save_file' not in job and args.save_file is not None:
+                # the worker's --save_file is a prefix, concurrent clients must not share one output
+                job['save_file'] = f"{args.save_file}_{uuid.uuid4().hex[:8]}"
+        if dist.is_initialized():
+            job = [job]
+            dist.broadcast_object_list(job, src=0)
+            job = job[0]
+
+        if job.get('command') == 'shutdown':
+            if conn is not None:
+                _send(conn, {'status': 'shutdown'})
+                conn.close()
+            break
+
+        report = partial(_send, conn) if conn is not None else None
+        try:
+            save_path = run_job(copy.copy(args), job, *models, rank, report=report, audio_cache=audio_cache)
+            if conn is not None:
+                _send(conn, {'status': 'done', 'output': save_path})
+        except Exception as e:
+            logging.exception("Job failed.")
+            if conn is not None:
+                _send(conn, {'status': 'error', 'message': str(e)})
+        finally:
+            if conn is not None:
+                conn.close()
+
+    if server is not None:
+        server.close()
+
+
+def submit(args):
+    """Send `--input_json` to a running worker and print its progress."""
+    with open(args.input_json, 'r', encoding='utf-8') as f:
+        job = json.load(f)
+    if args.save_file is not None:
+        job['save_file'] = args.save_file
+    with socket.create_connection((args.worker_host, args.worker_port)) as conn:
+        conn.sendall((json.dumps(job) + '\n').encode('utf-8'))
+        for line in conn.makefile('r', encoding='utf-8'):
+            msg = json.loads(line)
+            print(msg)
+            if msg['status'] == 'error':
+                sys.exit(1)
 
 
 if __name__ == "__main__":
     args = _parse_args()
-    generate(args)
+    if args.submit:
+        submit(args)
+    elif args.serve:
+        serve(args)
+    else:
+        generate(args)
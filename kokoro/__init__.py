@@ -21,3 +21,4 @@ logger.disable("kokoro")
 
 from .model import KModel
 from .pipeline import KPipeline
+from .service import TTSService, get_tts_service
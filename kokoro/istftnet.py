@@ -23,12 +23,27 @@ class AdaIN1d(nn.Module):
         # affine should be False, however there's a bug in the old torch.onnx.export (not newer dynamo) that causes the channel dimension to be lost if affine=False. When affine is true, there's additional learnably parameters. This shouldn't really matter setting it to True, since we're in inference mode
         self.norm = nn.InstanceNorm1d(num_features, affine=True)
         self.fc = nn.Linear(style_dim, num_features*2)
+        # set by KModel for padded batches: valid fraction of the time axis per item
+        self.valid_ratio = None
+
+    def masked_norm(self, x):
+        lengths = torch.round(self.valid_ratio * x.shape[-1]).clamp(min=1)
+        mask = (torch.arange(x.shape[-1], device=x.device)[None] < lengths[:, None]).to(x.dtype)[:, None]
+        count = mask.sum(-1, keepdim=True)
+        mean = (x * mask).sum(-1, keepdim=True) / count
+        var = ((x - mean) ** 2 * mask).sum(-1, keepdim=True) / count
+        x = (x - mean) * torch.rsqrt(var + self.norm.eps)
+        return x * self.norm.weight[None, :, None] + self.norm.bias[None, :, None], mask
 
     def forward(self, x, s):
         h = self.fc(s)
         h = h.view(h.size(0), h.size(1), 1)
         gamma, beta = torch.chunk(h, chunks=2, dim=1)
-        return (1 + gamma) * self.norm(x) + beta
+        if self.valid_ratio is None:
+            return (1 + gamma) * self.norm(x) + beta
+        # statistics over the valid frames only, padding is zeroed
+        x, mask = self.masked_norm(x)
+        return ((1 + gamma) * x + beta) * mask
 
 
 class AdaINResBlock1(nn.Module):
@@ -1,10 +1,11 @@
-from .istftnet import Decoder
+from .istftnet import AdaIN1d, Decoder
 from .modules import CustomAlbert, ProsodyPredictor, TextEncoder
+from contextlib import contextmanager
 from dataclasses import dataclass
 from huggingface_hub import hf_hub_download
 from loguru import logger
 from transformers import AlbertConfig
-from typing import Dict, Optional, Union
+from typing import Dict, List, Optional, Union
 import json
 import torch
 import os
@@ -33,7 +34,7 @@ class KModel(torch.nn.Module):
         self,
         repo_id: Optional[str] = None,
         config: Union[Dict, str, None] = None,
-        model: Optional[str] = None,
+        model: Union[str, bool, None] = None,
         disable_complex: bool = False
     ):
         super().__init__()
@@ -64,6 +65,9 @@ class KModel(torch.nn.Module):
             dim_in=config['hidden_dim'], style_dim=config['style_dim'],
             dim_out=config['n_mels'], disable_complex=disable_complex, **config['istftnet']
         )
+        if model is False:
+            # keep the random initialisation, e.g. for benchmarks
+            return
         if not model:
             try:
                 model = hf_hub_download(repo_id=repo_id, filename=KModel.MODEL_NAMES[repo_id])
@@ -122,6 +126,101 @@ class KModel(torch.nn.Module):
         audio = self.decoder(asr, F0_pred, N_pred, ref_s[:, :128]).squeeze()
         return audio, pred_dur
 
+    @contextmanager
+    def masked_norms(self, valid_ratio: torch.FloatTensor):
+        norms = [m for m in self.modules() if isinstance(m, AdaIN1d)]
+        for m in norms:
+            m.valid_ratio = valid_ratio
+        try:
+            yield
+        finally:
+            for m in norms:
+                m.valid_ratio = None
+
+    @torch.no_grad()
+    def forward_batch_with_tokens(
+        self,
+        input_ids: torch.LongTensor,
+        input_lengths: torch.LongTensor,
+        ref_s: torch.FloatTensor,
+        speed: float = 1
+    ) -> tuple[torch.FloatTensor, torch.LongTensor, torch.LongTensor]:
+        """Padded-batch counterpart of forward_with_tokens.
+
+        Not identical to running each item through forward_with_tokens: the AdaIN norms
+        only see the valid frames, but the decoder convolutions, upsampling and harmonic
+        source still read the padding, so the end of every shorter item differs. Opt-in
+        for throughput on GPU; TTSService uses the per-item forward.
+
+        Args:
+            input_ids: (B, T) token ids, padded with 0
+            input_lengths: (B,) number of valid tokens per item
+            ref_s: (B, 256) reference style per item
+        Returns:
+            audio (B, S) padded, audio lengths (B,) and pred_dur (B, T), 0 past the input length
+        """
+        batch_size, num_tokens = input_ids.shape
+        text_mask = torch.arange(num_tokens, device=self.device)[None] >= input_lengths[:, None]
+        bert_dur = self.bert(input_ids, attention_mask=(~text_mask).int())
+        d_en = self.bert_encoder(bert_dur).transpose(-1, -2)
+        s = ref_s[:, 128:]
+        d = self.predictor.text_encoder(d_en, s, input_lengths, text_mask)
+        x = torch.nn.utils.rnn.pack_padded_sequence(d, input_lengths.cpu(), batch_first=True, enforce_sorted=False)
+        x, _ = self.predictor.lstm(x)
+        x, _ = torch.nn.utils.rnn.pad_packed_sequence(x, batch_first=True, total_length=num_tokens)
+        duration = self.predictor.duration_proj(x)
+        duration = torch.sigmoid(duration).sum(axis=-1) / speed
+        pred_dur = torch.round(duration).clamp(min=1).long().masked_fill(text_mask, 0)
+
+        # frame -> token index from the cumulative durations, gathered instead of
+        # multiplied with a dense (tokens x frames) one-hot alignment
+        frame_lengths = pred_dur.sum(-1)
+        num_frames = int(frame_lengths.max())
+        frames = torch.arange(num_frames, device=self.device)
+        token_index = torch.searchsorted(pred_dur.cumsum(-1), frames.expand(batch_size, -1).contiguous(), right=True)
+        token_index = token_index.clamp(max=num_tokens - 1)
+        frame_mask = (frames[None] < frame_lengths[:, None]).unsqueeze(1)
+
+        def expand(h):
+            h = h.gather(2, token_index.unsqueeze(1).expand(-1, h.shape[1], -1))
+            return h.masked_fill(~frame_mask, 0)
+
+        en = expand(d.transpose(-1, -2))
+        t_en = self.text_encoder(input_ids, input_lengths, text_mask)
+        asr = expand(t_en)
+        with self.masked_norms(frame_lengths.float() / num_frames):
+            F0_pred, N_pred = self.predictor.F0Ntrain(en, s, frame_lengths)
+            audio = self.decoder(asr, F0_pred, N_pred, ref_s[:, :128])
+        audio = audio.reshape(batch_size, -1)
+        audio_lengths = frame_lengths * audio.shape[-1] // num_frames
+        return audio, audio_lengths, pred_dur
+
+    def forward_batch(
+        self,
+        phonemes: List[str],
+        ref_s: torch.FloatTensor,
+        speed: float = 1
+    ) -> List['KModel.Output']:
+        """Synthesize many phoneme strings in one padded batch, ref_s is (B, 256).
+        Approximates per-item forward, see forward_batch_with_tokens."""
+        batch = []
+        for ps in phonemes:
+            input_ids = list(filter(lambda i: i is not None, map(lambda p: self.vocab.get(p), ps)))
+            assert len(input_ids)+2 <= self.context_length, (len(input_ids)+2, self.context_length)
+            batch.append([0, *input_ids, 0])
+        input_lengths = torch.LongTensor([len(ids) for ids in batch])
+        input_ids = torch.zeros((len(batch), int(input_lengths.max())), dtype=torch.long)
+        for i, ids in enumerate(batch):
+            input_ids[i, :len(ids)] = torch.LongTensor(ids)
+        audio, audio_lengths, pred_dur = self.forward_batch_with_tokens(
+            input_ids.to(self.device), input_lengths.to(self.device), ref_s.to(self.device), speed
+        )
+        audio, audio_lengths, pred_dur = audio.cpu(), audio_lengths.cpu(), pred_dur.cpu()
+        return [
+            self.Output(audio=audio[i, :audio_lengths[i]], pred_dur=pred_dur[i, :input_lengths[i]])
+            for i in range(len(batch))
+        ]
+
     def forward(
         self,
         phonemes: str,
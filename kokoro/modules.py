@@ -121,8 +121,15 @@ class ProsodyPredictor(nn.Module):
         en = (d.transpose(-1, -2) @ alignment)
         return duration.squeeze(-1), en
 
-    def F0Ntrain(self, x, s):
-        x, _ = self.shared(x.transpose(-1, -2))
+    def F0Ntrain(self, x, s, lengths=None):
+        if lengths is None:
+            x, _ = self.shared(x.transpose(-1, -2))
+        else:
+            # padded batch: keep the backward direction from reading the padding
+            total_length = x.shape[-1]
+            x = nn.utils.rnn.pack_padded_sequence(x.transpose(-1, -2), lengths.cpu(), batch_first=True, enforce_sorted=False)
+            x, _ = self.shared(x)
+            x, _ = nn.utils.rnn.pad_packed_sequence(x, batch_first=True, total_length=total_length)
         F0 = x.transpose(-1, -2)
         for block in self.F0:
             F0 = block(F0, s)
@@ -244,6 +244,16 @@ class KPipeline:
             speed = speed(len(ps))
         return model(ps, pack[len(ps)-1], speed, return_output=True)
 
+    @staticmethod
+    def infer_batch(
+        model: KModel,
+        ps: List[str],
+        packs: List[torch.FloatTensor],
+        speed: float = 1
+    ) -> List[KModel.Output]:
+        ref_s = torch.cat([pack[len(p)-1] for p, pack in zip(ps, packs)], dim=0)
+        return model.forward_batch(ps, ref_s, speed)
+
     def generate_from_tokens(
         self,
         tokens: Union[str, List[en.MToken]],
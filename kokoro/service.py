@@ -0,0 +1,77 @@
+from .model import KModel
+from .pipeline import KPipeline
+from loguru import logger
+from typing import Iterator, List, Optional, Tuple
+import os
+import threading
+import torch
+
+class TTSService:
+    '''
+    TTSService keeps one KModel and one G2P per process and serves every TTS request
+    with them, instead of building a KPipeline (and reloading the weights) per request.
+
+    Voice packs are loaded once per path and kept on the model's device.
+
+    synthesize() takes all turns of a dialogue at once: every turn is phonemized and
+    chunked first, then the chunks are run through the model together.
+    '''
+    def __init__(
+        self,
+        repo_id: str,
+        lang_code: str = 'a',
+        device: Optional[str] = None
+    ):
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.pipeline = KPipeline(lang_code=lang_code, repo_id=repo_id, model=False)
+        self.model = KModel(repo_id=repo_id, config=os.path.join(repo_id, 'config.json')).to(device).eval()
+        self.voices = {}
+        # Gradio may serve requests from several threads
+        self.lock = threading.Lock()
+
+    def load_voice(self, voice: str) -> torch.FloatTensor:
+        if voice not in self.voices:
+            logger.debug(f"Caching voice: {voice}")
+            self.voices[voice] = self.pipeline.load_voice(voice).to(self.model.device)
+        return self.voices[voice]
+
+    def phonemize(self, text: str, split_pattern: Optional[str] = r'\n+') -> List[str]:
+        return [result.phonemes for result in self.pipeline(text, split_pattern=split_pattern)]
+
+    def synthesize(
+        self,
+        turns: List[Tuple[str, str]],
+        speed: float = 1,
+        split_pattern: Optional[str] = r'\n+'
+    ) -> List[torch.FloatTensor]:
+        """Synthesize (text, voice) turns, returns one 24 kHz waveform per turn."""
+        with self.lock:
+            items = []
+            for turn_index, (text, voice) in enumerate(turns):
+                pack = self.load_voice(voice)
+                for ps in self.phonemize(text, split_pattern):
+                    items.append((turn_index, ps, pack))
+            audios = [[] for _ in turns]
+            for turn_index, ps, pack in items:
+                audios[turn_index].append(KPipeline.infer(self.model, ps, pack, speed).audio)
+        return [torch.cat(a, dim=0) if a else torch.zeros(0) for a in audios]
+
+    def stream(
+        self,
+        turns: List[Tuple[str, str]],
+        speed: float = 1,
+        split_pattern: Optional[str] = r'\n+'
+    ) -> Iterator[Tuple[int, torch.FloatTensor]]:
+        """Yields (turn index, 24 kHz waveform) in order, each turn as soon as it is synthesized."""
+        for turn_index, turn in enumerate(turns):
+            yield turn_index, self.synthesize([turn], speed, split_pattern)[0]
+
+_services = {}
+
+def get_tts_service(repo_id: str, lang_code: str = 'a', device: Optional[str] = None) -> TTSService:
+    '''Returns the process-wide TTSService for (repo_id, lang_code), creating it on first use.'''
+    key = (repo_id, lang_code)
+    if key not in _services:
+        _services[key] = TTSService(repo_id, lang_code=lang_code, device=device)
+    return _services[key]
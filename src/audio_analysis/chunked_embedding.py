@@ -0,0 +1,194 @@
+from functools import partial
+
+import numpy as np
+import torch
+from einops import rearrange
+
+
+def _encode_window(audio_encoder, input_values, seq_len):
+    device = next(audio_encoder.parameters()).device
+    embeddings = audio_encoder(input_values.unsqueeze(0).to(device), seq_len=seq_len, output_hidden_states=True)
+    emb = torch.stack(embeddings.hidden_states[1:], dim=1).squeeze(0)
+    return rearrange(emb, "b s d -> s b d").float().cpu()
+
+
+def _crossfade(tail, emb):
+    if tail is not None:
+        n = tail.shape[0]
+        weight = torch.linspace(0, 1, n + 2)[1:-1].view(-1, 1, 1)
+        emb[:n] = tail * (1 - weight) + emb[:n] * weight
+    return emb
+
+
+@torch.no_grad()
+def iter_embedding_chunks(input_values, audio_encoder, num_frames, window_frames=500,
+                          context_frames=50, crossfade_frames=10):
+    """
+    Encode normalised wav2vec2 input values window by window.
+
+    Every window of `window_frames` video frames is encoded together with `context_frames`
+    of audio on both sides, and the first `crossfade_frames` frames of a window are blended
+    linearly with the end of the previous one. Yields (T, 12, 768) chunks on the CPU that
+    concatenate to `num_frames` frames, the layout of the whole-clip extraction.
+    """
+    assert window_frames > crossfade_frames, "The window must be longer than the crossfade."
+    samples_per_frame = input_values.shape[-1] / num_frames
+    tail = None
+    for start in range(0, num_frames, window_frames):
+        end = min(start + window_frames, num_frames)
+        keep_end = min(end + crossfade_frames, num_frames)
+        lo, hi = max(start - context_frames, 0), min(keep_end + context_frames, num_frames)
+        segment = input_values[..., int(round(lo * samples_per_frame)):int(round(hi * samples_per_frame))]
+
+        emb = _crossfade(tail, _encode_window(audio_encoder, segment, hi - lo)[start - lo:keep_end - lo])
+        tail = emb[end - start:]
+        yield emb[:end - start]
+
+
+@torch.no_grad()
+def iter_streaming_embedding_chunks(segments, wav2vec_feature_extractor, audio_encoder, sr=16000, fps=25,
+                                    window_frames=125, context_frames=50, crossfade_frames=10):
+    """
+    Like `iter_embedding_chunks`, for audio that arrives as a stream of `sr` numpy segments
+    of unknown total length. A window is encoded as soon as its right context has arrived;
+    each window is normalised on its own since the whole clip is not known yet.
+    """
+    assert window_frames > crossfade_frames, "The window must be longer than the crossfade."
+    samples_per_frame = sr / fps
+    segments = iter(segments)
+    buffer, exhausted = np.zeros(0, dtype=np.float32), False
+    num_frames = None
+    tail = None
+    start = 0
+    while True:
+        end = start + window_frames
+        keep_end = end + crossfade_frames
+        hi = keep_end + context_frames
+        while not exhausted and len(buffer) < hi * samples_per_frame:
+            try:
+                buffer = np.concatenate([buffer, next(segments)])
+            except StopIteration:
+                exhausted = True
+                num_frames = int(len(buffer) / sr * fps)
+        if num_frames is not None:
+            end, keep_end, hi = min(end, num_frames), min(keep_end, num_frames), min(hi, num_frames)
+            if start >= num_frames:
+                return
+        lo = max(start - context_frames, 0)
+        segment = buffer[int(round(lo * samples_per_frame)):int(round(hi * samples_per_frame))]
+        input_values = np.squeeze(wav2vec_feature_extractor(segment, sampling_rate=sr).input_values)
+        input_values = torch.from_numpy(input_values).float()
+
+        emb = _crossfade(tail, _encode_window(audio_encoder, input_values, hi - lo)[start - lo:keep_end - lo])
+        tail = emb[end - start:]
+        yield emb[:end - start]
+        start = end
+
+
+class AudioEmbeddingStream:
+    """
+    Audio embedding that is encoded chunk by chunk on demand.
+
+    Indexing it like the (T, 12, 768) tensor encodes just enough chunks to answer, so
+    video generation can start before the whole audio is encoded. `num_frames` may be
+    None when the length is only known once `chunks` is exhausted (streamed audio); use
+    `embedding_length` to ask for the length without encoding everything. `on_complete`
+    receives the full tensor once the last chunk is in, e.g. to store it in a cache.
+    """
+
+    def __init__(self, chunks, num_frames=None, on_complete=None):
+        self.chunks = iter(chunks)
+        self.num_frames = num_frames
+        self.on_complete = on_complete
+        self.parts = []
+        self.num_encoded = 0
+        self.exhausted = False
+        self._frames = None
+
+    def ensure(self, n):
+        if self.num_frames is not None:
+            n = min(n, self.num_frames)
+        while self.num_encoded < n and not self.exhausted:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self._complete()
+                break
+            self.parts.append(chunk)
+            self.num_encoded += chunk.shape[0]
+            self._frames = None
+            if self.num_frames is not None and self.num_encoded >= self.num_frames:
+                self._complete()
+
+    def _complete(self):
+        self.exhausted = True
+        self.num_frames = self.num_encoded
+        if self.on_complete is not None:
+            self.on_complete(self.frames)
+
+    @property
+    def frames(self):
+        if self._frames is None:
+            self._frames = torch.cat(self.parts, dim=0)
+            self.parts = [self._frames]
+        return self._frames
+
+    @property
+    def shape(self):
+        num_frames = len(self)
+        self.ensure(1)
+        return torch.Size([num_frames, *self.frames.shape[1:]])
+
+    def __len__(self):
+        if self.num_frames is None:
+            self.ensure(float("inf"))
+        return self.num_frames
+
+    def __getitem__(self, idx):
+        if isinstance(idx, torch.Tensor) and idx.numel() > 0 and idx.min() >= 0:
+            self.ensure(int(idx.max()) + 1)
+        elif isinstance(idx, slice) and idx.stop is not None and idx.stop >= 0 and (idx.start or 0) >= 0:
+            self.ensure(idx.stop)
+        else:
+            self.ensure(float("inf"))
+        return self.frames[idx]
+
+
+def embedding_length(emb, upto):
+    """
+    min(len(emb), upto) for a tensor or an `AudioEmbeddingStream`, encoding a stream only
+    as far as needed to answer.
+    """
+    if isinstance(emb, AudioEmbeddingStream):
+        emb.ensure(upto)
+        return min(emb.num_encoded, upto)
+    return min(emb.shape[0], upto)
+
+
+def stream_embedding(speech_array, wav2vec_feature_extractor, audio_encoder, sr=16000, fps=25,
+                     chunk_seconds=20, context_seconds=2, crossfade_frames=10, audio_cache=None):
+    """
+    Windowed counterpart of `get_embedding` returning an `AudioEmbeddingStream`, or the
+    cached tensor if `audio_cache` already holds it.
+    """
+    num_frames = int(len(speech_array) / sr * fps)
+    key = None
+    if audio_cache is not None:
+        key = audio_cache.key(speech_array, sr, variant=f"chunk:{chunk_seconds}:{context_seconds}:{crossfade_frames}")
+        emb = audio_cache.get(key)
+        if emb is not None:
+            return emb
+
+    # normalise over the whole clip, like the whole-clip extraction does
+    input_values = np.squeeze(wav2vec_feature_extractor(speech_array, sampling_rate=sr).input_values)
+    input_values = torch.from_numpy(input_values).float()
+    chunks = iter_embedding_chunks(
+        input_values,
+        audio_encoder,
+        num_frames,
+        window_frames=int(chunk_seconds * fps),
+        context_frames=int(context_seconds * fps),
+        crossfade_frames=crossfade_frames,
+    )
+    on_complete = partial(audio_cache.put, key) if audio_cache is not None else None
+    return AudioEmbeddingStream(chunks, num_frames, on_complete=on_complete)
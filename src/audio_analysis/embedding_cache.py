@@ -0,0 +1,94 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+
+class AudioEmbeddingCache:
+    """
+    Content-addressed on-disk cache of wav2vec2 embeddings.
+
+    Entries are keyed by the waveform fed to the encoder, its sample rate and the encoder
+    checkpoint. The waveform is the loudness-normalised one, so a different normalisation
+    gives a different key. Embeddings are stored as .npy files and memory-mapped on load.
+    The least recently used entries are evicted once the cache grows beyond `max_bytes`.
+    """
+
+    VERSION = 1
+
+    def __init__(self, cache_dir, checkpoint, max_bytes=10 * 1024 ** 3):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.checkpoint_id = self._checkpoint_id(checkpoint)
+
+    @staticmethod
+    def _checkpoint_id(checkpoint):
+        # path, size and mtime of the checkpoint files: cheap, and changes with the weights
+        digest = hashlib.sha256(os.path.abspath(checkpoint).encode())
+        if os.path.isdir(checkpoint):
+            for name in sorted(os.listdir(checkpoint)):
+                stat = os.stat(os.path.join(checkpoint, name))
+                digest.update(f"{name}:{stat.st_size}:{int(stat.st_mtime)}".encode())
+        return digest.hexdigest()[:16]
+
+    def key(self, speech_array, sr, variant=""):
+        """`variant` tells apart embeddings of the same audio made in different ways."""
+        speech_array = np.ascontiguousarray(speech_array)
+        digest = hashlib.sha256(
+            f"v{self.VERSION}:{self.checkpoint_id}:{sr}:{variant}:{speech_array.dtype.str}:".encode())
+        digest.update(speech_array.tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            # copy-on-write mapping: pages are read lazily and the tensor stays writable
+            emb = torch.from_numpy(np.load(path, mmap_mode="c"))
+        except (OSError, ValueError):
+            os.remove(path)
+            return None
+        os.utime(path)
+        return emb
+
+    def put(self, key, emb):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, emb.detach().cpu().numpy())
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def get_or_compute(self, speech_array, sr, compute):
+        """
+        Return the cached embedding of `speech_array`, or `compute()` and cache it.
+        """
+        key = self.key(speech_array, sr)
+        emb = self.get(key)
+        if emb is None:
+            emb = compute()
+            if emb is not None:
+                self.put(key, emb)
+        return emb
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npy"):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        # always keep the most recent entry
+        for _, size, name in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
@@ -0,0 +1,46 @@
+from collections import deque
+
+import librosa
+import numpy as np
+
+
+class SpeakerTracks:
+    """
+    Splits streamed TTS turns into one track per speaker, resampled in memory.
+
+    `turn_audio` yields (turn index, waveform at `orig_sr`) in order and `speakers[i]` is the
+    speaker of turn i. `track(k)` is a generator of `sr` numpy segments for speaker k, with
+    silence while another speaker talks; pulling from any track synthesises the next turn
+    only when that track has run dry. Everything pulled so far is kept for `mix()`.
+    """
+
+    def __init__(self, turn_audio, speakers, num_speakers, orig_sr=24000, sr=16000):
+        self.turn_audio = iter(turn_audio)
+        self.speakers = speakers
+        self.orig_sr = orig_sr
+        self.sr = sr
+        self.pending = [deque() for _ in range(num_speakers)]
+        self.history = [[] for _ in range(num_speakers)]
+
+    def _pull(self):
+        turn_index, audio = next(self.turn_audio)
+        audio = np.asarray(audio, dtype=np.float32)
+        audio = librosa.resample(audio, orig_sr=self.orig_sr, target_sr=self.sr)
+        for speaker, pending in enumerate(self.pending):
+            segment = audio if speaker == self.speakers[turn_index] else np.zeros_like(audio)
+            pending.append(segment)
+            self.history[speaker].append(segment)
+
+    def track(self, speaker):
+        while True:
+            if not self.pending[speaker]:
+                try:
+                    self._pull()
+                except StopIteration:
+                    return
+            yield self.pending[speaker].popleft()
+
+    def mix(self):
+        """Sum of the speaker tracks synthesised so far."""
+        tracks = [np.concatenate(h) if h else np.zeros(0, dtype=np.float32) for h in self.history]
+        return np.sum(tracks, axis=0)
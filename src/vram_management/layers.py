@@ -1,4 +1,4 @@
-import copy
+import itertools
 
 import torch
 
@@ -38,6 +38,8 @@ class AutoWrappedModule(torch.nn.Module):
         self.computation_dtype = computation_dtype
         self.computation_device = computation_device
         self.state = 0
+        # device copies of the parameters and buffers, filled by OffloadPrefetcher
+        self.prefetched = {}
 
     def offload(self):
         if self.state == 1 and (
@@ -60,12 +62,25 @@ class AutoWrappedModule(torch.nn.Module):
             self.onload_dtype == self.computation_dtype
             and self.onload_device == self.computation_device
         ):
-            module = self.module
+            return self.module(*args, **kwargs)
+        elif self.prefetched:
+            params = {
+                name: tensor.to(self.computation_dtype if tensor.is_floating_point() else tensor.dtype)
+                for name, tensor in self.prefetched.items()
+            }
         else:
-            module = copy.deepcopy(self.module).to(
-                dtype=self.computation_dtype, device=self.computation_device
-            )
-        return module(*args, **kwargs)
+            # transfer the tensors only, instead of deep-copying the module on every call
+            params = {
+                name: cast_to(
+                    tensor,
+                    self.computation_dtype if tensor.is_floating_point() else tensor.dtype,
+                    self.computation_device,
+                )
+                for name, tensor in itertools.chain(
+                    self.module.named_parameters(), self.module.named_buffers()
+                )
+            }
+        return torch.func.functional_call(self.module, params, args, kwargs)
 
 
 
@@ -153,6 +168,8 @@ class AutoWrappedLinear(torch.nn.Linear):
         self.computation_dtype = computation_dtype
         self.computation_device = computation_device
         self.state = 0
+        # device copies of the parameters, filled by OffloadPrefetcher
+        self.prefetched = {}
 
     def offload(self):
         if self.state == 1 and (
@@ -176,6 +193,10 @@ class AutoWrappedLinear(torch.nn.Linear):
             and self.onload_device == self.computation_device
         ):
             weight, bias = self.weight, self.bias
+        elif self.prefetched:
+            weight = self.prefetched["weight"].to(self.computation_dtype)
+            bias = self.prefetched.get("bias")
+            bias = None if bias is None else bias.to(self.computation_dtype)
         else:
             weight = cast_to(
                 self.weight, self.computation_dtype, self.computation_device
@@ -195,8 +216,14 @@ def enable_vram_management_recursively(
     max_num_param=None,
     overflow_module_config: dict = None,
     total_num_param=0,
+    module_order=None,
 ):
-    for name, module in model.named_children():
+    children = list(model.named_children())
+    if module_order is not None:
+        # wrap (and keep resident) the children listed first, unlisted ones last
+        rank = {name: i for i, name in enumerate(module_order)}
+        children.sort(key=lambda item: rank.get(item[0], len(rank)))
+    for name, module in children:
         for source_module, target_module in module_map.items():
             if isinstance(module, source_module):
                 num_param = sum(p.numel() for p in module.parameters())
@@ -231,6 +258,7 @@ def enable_vram_management(
     module_config: dict,
     max_num_param=None,
     overflow_module_config: dict = None,
+    module_order=None,
 ):
     enable_vram_management_recursively(
         model,
@@ -239,5 +267,6 @@ def enable_vram_management(
         max_num_param,
         overflow_module_config,
         total_num_param=0,
+        module_order=module_order,
     )
     model.vram_management_enabled = True
@@ -0,0 +1,125 @@
+import itertools
+from functools import partial
+
+import torch
+
+from .layers import AutoWrappedModule, AutoWrappedLinear
+
+
+def _streamed_tensors(layer):
+    # buffers too, like the synchronous path of AutoWrappedModule.forward
+    target = layer.module if isinstance(layer, AutoWrappedModule) else layer
+    return list(itertools.chain(target.named_parameters(), target.named_buffers()))
+
+
+def _is_streamed(layer):
+    return (
+        isinstance(layer, (AutoWrappedModule, AutoWrappedLinear))
+        and layer.onload_device != layer.computation_device
+        and len(_streamed_tensors(layer)) > 0
+    )
+
+
+class _Slot:
+    def __init__(self, numels, device):
+        self.buffers = {
+            dtype: torch.empty(numel, dtype=dtype, device=device)
+            for dtype, numel in numels.items()
+        }
+        self.ready = torch.cuda.Event()
+        self.free = torch.cuda.Event()
+
+
+class OffloadPrefetcher:
+    """
+    Streams the weights of offloaded layers to the GPU one group (e.g. one DiT block) ahead.
+
+    The parameters and buffers of every overflow layer (onload device != computation
+    device) inside a group are moved into one pinned host buffer per dtype. While group N
+    runs, the weights of group N+1 are copied on a side stream into one of `num_slots`
+    reusable device buffers; the last group prefetches the first one for the next forward
+    pass. Layers read their weights from `layer.prefetched` and fall back to the
+    synchronous copy outside of the groups.
+
+    Quantized layers (`AutoWrappedQLinear`) keep the synchronous path.
+    """
+
+    def __init__(self, groups, device, num_slots=2):
+        assert num_slots >= 2, "Prefetching needs at least two slots."
+        self.device = torch.device(device)
+        self.copy_stream = torch.cuda.Stream(self.device)
+        self.groups = []
+        max_numels = {}
+        for group in groups:
+            entries, numels = [], {}
+            for layer in group.modules():
+                if not _is_streamed(layer):
+                    continue
+                for name, tensor in _streamed_tensors(layer):
+                    offset = numels.get(tensor.dtype, 0)
+                    entries.append((layer, name, tensor, offset))
+                    numels[tensor.dtype] = offset + tensor.numel()
+            host = {
+                dtype: torch.empty(numel, dtype=dtype, pin_memory=True)
+                for dtype, numel in numels.items()
+            }
+            layout = []
+            for layer, name, tensor, offset in entries:
+                # the module keeps its CPU weights, now as views into the pinned buffer
+                view = host[tensor.dtype][offset:offset + tensor.numel()].view(tensor.shape)
+                view.copy_(tensor.data)
+                tensor.data = view
+                layout.append((layer, name, tensor.dtype, offset, tensor.shape))
+            for dtype, numel in numels.items():
+                max_numels[dtype] = max(max_numels.get(dtype, 0), numel)
+            self.groups.append((host, layout))
+
+        self.slots = [_Slot(max_numels, self.device) for _ in range(num_slots)]
+        self.free_slots = list(self.slots)
+        self.loaded = {}
+        self.handles = []
+        for idx, group in enumerate(groups):
+            self.handles.append(group.register_forward_pre_hook(partial(self._pre_hook, idx)))
+            self.handles.append(group.register_forward_hook(partial(self._post_hook, idx)))
+
+    def _prefetch(self, idx):
+        if idx in self.loaded or not self.free_slots:
+            return
+        slot = self.free_slots.pop(0)
+        host, _ = self.groups[idx]
+        # do not overwrite a slot the compute stream may still be reading
+        self.copy_stream.wait_event(slot.free)
+        with torch.cuda.stream(self.copy_stream):
+            for dtype, flat in host.items():
+                slot.buffers[dtype][:flat.numel()].copy_(flat, non_blocking=True)
+            slot.ready.record()
+        self.loaded[idx] = slot
+
+    def _release(self, idx):
+        slot = self.loaded.pop(idx)
+        slot.free.record(torch.cuda.current_stream(self.device))
+        for layer, name, *_ in self.groups[idx][1]:
+            layer.prefetched.pop(name, None)
+        self.free_slots.append(slot)
+
+    def _pre_hook(self, idx, module, args):
+        if idx not in self.loaded and not self.free_slots:
+            # a previous forward was interrupted, take its slots back
+            for other in list(self.loaded):
+                self._release(other)
+        self._prefetch(idx)
+        slot = self.loaded[idx]
+        torch.cuda.current_stream(self.device).wait_event(slot.ready)
+        for layer, name, dtype, offset, shape in self.groups[idx][1]:
+            layer.prefetched[name] = slot.buffers[dtype][offset:offset + shape.numel()].view(shape)
+        self._prefetch((idx + 1) % len(self.groups))
+
+    def _post_hook(self, idx, module, args, output):
+        self._release(idx)
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        for idx in list(self.loaded):
+            self._release(idx)
@@ -0,0 +1,90 @@
+"""
+Fit TeaCache coefficients for a resolution, step count and solver.
+
+Runs reference generations with every step computed, records per step the relative L1
+change of the timestep modulation and of the DiT block residual, fits a polynomial
+from the first to the second and stores it in a coefficients file for
+`--teacache_coefficients`. All options other than the ones below are those of
+generate_infinitetalk.py, e.g.:
+
+    python tools/calibrate_teacache.py \
+        --ckpt_dir weights/Wan2.1-I2V-14B-480P \
+        --wav2vec_dir 'weights/chinese-wav2vec2-base' \
+        --infinitetalk_dir weights/InfiniteTalk/single/infinitetalk.safetensors \
+        --inputs examples/single_example_image.json examples/single_example_video.json \
+        --size infinitetalk-480 --sample_steps 20 --sample_solver unipc --mode clip \
+        --output teacache_coefficients.json
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate_infinitetalk import _init_distributed, _parse_args, build_audio_cache, load_models, run_job
+from wan.utils.teacache import StepCache
+
+
+def fit_coefficients(pairs, degree=4):
+    x, y = np.array(pairs, dtype=np.float64).T
+    coefficients = np.polyfit(x, y, degree)
+    error = np.abs(np.polyval(coefficients, x) - y).mean() / np.abs(y).mean()
+    return coefficients.tolist(), error
+
+
+def save_coefficients(path, entry):
+    """Add `entry` to the coefficients file at `path`, replacing one for the same setting."""
+    entries = []
+    if os.path.exists(path):
+        with open(path) as f:
+            entries = json.load(f)
+    setting = ('size', 'sample_steps', 'sample_solver', 'use_ret_steps')
+    entries = [e for e in entries if any(e[k] != entry[k] for k in setting)]
+    entries.append(entry)
+    with open(path, 'w') as f:
+        json.dump(entries, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit TeaCache coefficients from reference generations")
+    parser.add_argument("--inputs", type=str, nargs="+", required=True,
+                        help="--input_json files of the reference generations.")
+    parser.add_argument("--output", type=str, default="teacache_coefficients.json",
+                        help="Coefficients file to add the fit to.")
+    parser.add_argument("--degree", type=int, default=4, help="Degree of the polynomial.")
+    calib_args, rest = parser.parse_known_args()
+    sys.argv = [sys.argv[0], "--input_json", calib_args.inputs[0]] + rest
+    args = _parse_args()
+
+    rank, device = _init_distributed(args)
+    models = load_models(args, device, rank)
+    audio_cache = build_audio_cache(args)
+    step_cache = StepCache(calibrate=True)
+    for input_json in calib_args.inputs:
+        with open(input_json, 'r', encoding='utf-8') as f:
+            input_data = json.load(f)
+        # run_job rewrites the output paths on its args
+        run_job(copy.copy(args), input_data, *models, rank, audio_cache=audio_cache, step_cache=step_cache)
+
+    if rank != 0:
+        return
+    pairs = step_cache.calibration_pairs()
+    coefficients, error = fit_coefficients(pairs, calib_args.degree)
+    logging.info(f"Fitted on {len(pairs)} steps, mean relative error {error:.3f}: {coefficients}")
+    save_coefficients(calib_args.output, dict(
+        size=args.size,
+        sample_steps=args.sample_steps,
+        sample_solver=args.sample_solver,
+        use_ret_steps=step_cache.use_ret_steps,
+        coefficients=coefficients,
+    ))
+    logging.info(f"Saved to {calib_args.output}, use it with --use_teacache --teacache_coefficients {calib_args.output}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.cuda.amp as amp
@@ -239,11 +238,13 @@ def usp_dit_forward_multitalk(
     y=None,
     audio=None,
     ref_target_masks=None,
+    step_cache=None,
 ):
     """
     x:              A list of videos each with shape [C, T, H, W].
     t:              [B].
     context:        A list of text embeddings each with shape [L, C].
+    step_cache:     TeaCache state of this CFG branch, see `wan.utils.teacache.StepCache`.
     """
     
     assert clip_fea is not None and y is not None
@@ -319,49 +320,6 @@ def usp_dit_forward_multitalk(
         token_ref_target_masks = token_ref_target_masks.view(token_ref_target_masks.shape[0], -1) 
         token_ref_target_masks = token_ref_target_masks.to(x.dtype)
     
-    if self.enable_teacache:
-        modulated_inp = e0 if self.use_ret_steps else e
-        if self.cnt%3==0: # cond
-            if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
-                should_calc_cond = True
-                self.accumulated_rel_l1_distance_cond = 0
-            else:
-                rescale_func = np.poly1d(self.coefficients)
-                self.accumulated_rel_l1_distance_cond += rescale_func(((modulated_inp-self.previous_e0_cond).abs().mean() / self.previous_e0_cond.abs().mean()).cpu().item())
-                # print("accumulated_rel_l1_distance_even", self.accumulated_rel_l1_distance_even)
-                if self.accumulated_rel_l1_distance_cond < self.teacache_thresh:
-                    should_calc_cond = False
-                else:
-                    should_calc_cond = True
-                    self.accumulated_rel_l1_distance_cond = 0
-            self.previous_e0_cond = modulated_inp.clone()
-        elif self.cnt%3==1: # drop_text
-            if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
-                should_calc_drop_text = True
-                self.accumulated_rel_l1_distance_drop_text = 0
-            else:
-                rescale_func = np.poly1d(self.coefficients)
-                self.accumulated_rel_l1_distance_drop_text += rescale_func(((modulated_inp-self.previous_e0_drop_text).abs().mean() / self.previous_e0_drop_text.abs().mean()).cpu().item())
-                if self.accumulated_rel_l1_distance_drop_text < self.teacache_thresh:
-                    should_calc_drop_text = False
-                else:
-                    should_calc_drop_text = True
-                    self.accumulated_rel_l1_distance_drop_text = 0
-            self.previous_e0_drop_text = modulated_inp.clone()
-        else: # uncond
-            if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
-                should_calc_uncond = True
-                self.accumulated_rel_l1_distance_uncond = 0
-            else:
-                rescale_func = np.poly1d(self.coefficients)
-                self.accumulated_rel_l1_distance_uncond += rescale_func(((modulated_inp-self.previous_e0_uncond).abs().mean() / self.previous_e0_uncond.abs().mean()).cpu().item())
-                if self.accumulated_rel_l1_distance_uncond < self.teacache_thresh:
-                    should_calc_uncond = False
-                else:
-                    should_calc_uncond = True
-                    self.accumulated_rel_l1_distance_uncond = 0
-            self.previous_e0_uncond = modulated_inp.clone()
-
     # Context Parallel
     x = torch.chunk(
         x, get_sequence_parallel_world_size(),
@@ -380,34 +338,11 @@ def usp_dit_forward_multitalk(
         human_num=human_num,
         )
 
-    if self.enable_teacache:
-        if self.cnt%3==0:
-            if not should_calc_cond:
-                x +=  self.previous_residual_cond
-            else:
-                ori_x = x.clone()
-                for block in self.blocks:
-                    x = block(x, **kwargs)
-                self.previous_residual_cond = x - ori_x
-        elif self.cnt%3==1:
-            if not should_calc_drop_text:
-                x +=  self.previous_residual_drop_text
-            else:
-                ori_x = x.clone()
-                for block in self.blocks:
-                    x = block(x, **kwargs)
-                self.previous_residual_drop_text = x - ori_x
-        else:
-            if not should_calc_uncond:
-                x +=  self.previous_residual_uncond
-            else:
-                ori_x = x.clone()
-                for block in self.blocks:
-                    x = block(x, **kwargs)
-                self.previous_residual_uncond = x - ori_x
+    if step_cache is not None:
+        # residuals of the local sequence shard
+        x = step_cache.run(x, lambda x: self.forward_blocks(x, **kwargs), self.time_modulation)
     else:
-        for block in self.blocks:
-            x = block(x, **kwargs)
+        x = self.forward_blocks(x, **kwargs)
 
     # head
     x = self.head(x, e)
@@ -417,11 +352,7 @@ def usp_dit_forward_multitalk(
 
     # unpatchify
     x = self.unpatchify(x, grid_sizes)
-    if self.enable_teacache:
-        self.cnt += 1
-        if self.cnt >= self.num_steps:
-            self.cnt = 0
-        
+
     return torch.stack(x).float()
 
 
@@ -431,7 +362,8 @@ def usp_attn_forward_multitalk(self,
                      grid_sizes,
                      freqs,
                      dtype=torch.bfloat16,
-                     ref_target_masks=None):
+                     ref_target_masks=None,
+                     compute_attn_map=True):
     b, s, n, d = *x.shape[:2], self.num_heads, self.head_dim
     half_dtypes = (torch.float16, torch.bfloat16)
 
@@ -462,6 +394,9 @@ def usp_attn_forward_multitalk(self,
     x = x.flatten(2)
     x = self.o(x)
 
+    if not compute_attn_map:
+        return x, None
+
     with torch.no_grad():
         x_ref_attn_map = get_attn_map_with_target(q.type_as(x), k.type_as(x), grid_sizes[0], 
                                             ref_target_masks=ref_target_masks, enable_sp=True) 
@@ -60,7 +60,12 @@ def flash_attention(
     """
     half_dtypes = (torch.float16, torch.bfloat16)
     assert dtype in half_dtypes
-    assert q.device.type == 'cuda' and q.size(-1) <= 256
+    if q.device.type != 'cuda':
+        # reference path, lets the tiny benchmark models run on the CPU
+        assert window_size == (-1, -1)
+        return sdpa_attention(q, k, v, k_lens=k_lens, softmax_scale=softmax_scale,
+                              q_scale=q_scale, causal=causal)
+    assert q.size(-1) <= 256
 
     # params
     b, lq, lk, out_dtype = q.size(0), q.size(1), k.size(1), q.dtype
@@ -139,6 +144,34 @@ def flash_attention(
     return x.type(out_dtype)
 
 
+def sdpa_attention(q, k, v, k_lens=None, softmax_scale=None, q_scale=None, causal=False):
+    """
+    `flash_attention` with torch's scaled_dot_product_attention, for tensors off the GPU.
+    q/k/v are [B, L, N, C]; `k_lens` masks the padded keys, all queries are kept.
+    """
+    out_dtype = q.dtype
+    if q_scale is not None:
+        q = q * q_scale
+    attn_mask = None
+    if k_lens is not None:
+        attn_mask = torch.arange(k.size(1), device=k.device)[None, :] < k_lens.to(k.device)[:, None]
+        attn_mask = attn_mask[:, None, None, :]
+    x = torch.nn.functional.scaled_dot_product_attention(
+        q.transpose(1, 2), k.transpose(1, 2).to(q.dtype), v.transpose(1, 2).to(q.dtype),
+        attn_mask=attn_mask, is_causal=causal, scale=softmax_scale)
+    return x.transpose(1, 2).type(out_dtype)
+
+
+def memory_efficient_attention(q, k, v, attn_bias=None):
+    """
+    xformers attention on the GPU, `sdpa_attention` elsewhere. q/k/v are [B, M, H, K].
+    """
+    if q.is_cuda:
+        return xformers.ops.memory_efficient_attention(q, k, v, attn_bias=attn_bias, op=None,)
+    assert attn_bias is None, "block-diagonal masks need xformers on the GPU."
+    return sdpa_attention(q, k, v)
+
+
 def attention(
     q,
     k,
@@ -224,7 +257,11 @@ class SingleStreamAttention(nn.Module):
         self.add_q_norm = norm_layer(self.head_dim) if qk_norm else nn.Identity()
         self.add_k_norm = norm_layer(self.head_dim) if qk_norm else nn.Identity()
 
-    def forward(self, x: torch.Tensor, encoder_hidden_states: torch.Tensor, shape=None, enable_sp=False, kv_seq=None) -> torch.Tensor:
+    def prepare_kv(self, encoder_hidden_states: torch.Tensor) -> torch.Tensor:
+        """Project (step-invariant) audio tokens to the packed K/V used by `forward`."""
+        return self.kv_linear(encoder_hidden_states.squeeze(0))
+
+    def forward(self, x: torch.Tensor, encoder_hidden_states: torch.Tensor, shape=None, enable_sp=False, kv_seq=None, encoder_kv=None) -> torch.Tensor:
        
         N_t, N_h, N_w = shape
         if not enable_sp:
@@ -241,7 +278,8 @@ class SingleStreamAttention(nn.Module):
         
         # get kv from encoder_hidden_states
         _, N_a, _ = encoder_hidden_states.shape
-        encoder_kv = self.kv_linear(encoder_hidden_states)
+        if encoder_kv is None:
+            encoder_kv = self.kv_linear(encoder_hidden_states)
         encoder_kv_shape = (B, N_a, 2, self.num_heads, self.head_dim)
         encoder_kv = encoder_kv.view(encoder_kv_shape).permute((2, 0, 3, 1, 4)) 
         encoder_k, encoder_v = encoder_kv.unbind(0)
@@ -263,7 +301,7 @@ class SingleStreamAttention(nn.Module):
             attn_bias = xformers.ops.fmha.attn_bias.BlockDiagonalMask.from_seqlens(visual_seqlen, kv_seq)
         else:
             attn_bias = None
-        x = xformers.ops.memory_efficient_attention(q, encoder_k, encoder_v, attn_bias=attn_bias, op=None,)
+        x = memory_efficient_attention(q, encoder_k, encoder_v, attn_bias=attn_bias)
         x = rearrange(x, "B M H K -> B H M K") 
 
         # linear transform
@@ -318,11 +356,12 @@ class SingleStreamMutiAttention(SingleStreamAttention):
                 encoder_hidden_states: torch.Tensor, 
                 shape=None, 
                 x_ref_attn_map=None,
-                human_num=None) -> torch.Tensor:
+                human_num=None,
+                encoder_kv=None) -> torch.Tensor:
         
         encoder_hidden_states = encoder_hidden_states.squeeze(0)
         if human_num == 1:
-            return super().forward(x, encoder_hidden_states, shape)
+            return super().forward(x, encoder_hidden_states, shape, encoder_kv=encoder_kv)
 
         N_t, _, _ = shape 
         x = rearrange(x, "B (N_t S) C -> (B N_t) S C", N_t=N_t) 
@@ -356,7 +395,8 @@ class SingleStreamMutiAttention(SingleStreamAttention):
         q = rearrange(q, "B H (N_t S) C -> (B N_t) H S C", N_t=N_t)
 
         _, N_a, _ = encoder_hidden_states.shape 
-        encoder_kv = self.kv_linear(encoder_hidden_states) 
+        if encoder_kv is None:
+            encoder_kv = self.kv_linear(encoder_hidden_states) 
         encoder_kv_shape = (B, N_a, 2, self.num_heads, self.head_dim)
         encoder_kv = encoder_kv.view(encoder_kv_shape).permute((2, 0, 3, 1, 4)) 
         encoder_k, encoder_v = encoder_kv.unbind(0) 
@@ -377,7 +417,7 @@ class SingleStreamMutiAttention(SingleStreamAttention):
         q = rearrange(q, "B H M K -> B M H K")
         encoder_k = rearrange(encoder_k, "B H M K -> B M H K")
         encoder_v = rearrange(encoder_v, "B H M K -> B M H K")
-        x = xformers.ops.memory_efficient_attention(q, encoder_k, encoder_v, attn_bias=None, op=None,)
+        x = memory_efficient_attention(q, encoder_k, encoder_v)
         x = rearrange(x, "B M H K -> B H M K")
 
         # linear transform
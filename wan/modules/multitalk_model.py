@@ -1,6 +1,5 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import math
-import numpy as np
 import os
 import torch
 import torch.cuda.amp as amp
@@ -76,6 +75,66 @@ def rope_apply(x, grid_sizes, freqs):
     return torch.stack(output).float()
 
 
+class RopeCache:
+    r"""
+    Per-grid RoPE tables for `rope_apply`.
+
+    Keeps fp32 cos/sin tables on device, keyed by `(f, h, w)`, and rotates in
+    fp32 with real arithmetic instead of rebuilding the complex float64 table
+    on every call.
+
+    Args:
+        freqs (Tensor): Complex table from `rope_params`, shape [M, C // 2]
+    """
+
+    def __init__(self, freqs):
+        self.freqs = freqs
+        self.tables = {}
+
+    def get(self, f, h, w, device):
+        key = (f, h, w, str(device))
+        if key not in self.tables:
+            c = self.freqs.size(1)
+            freqs = self.freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
+            freqs_i = torch.cat([
+                freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
+                freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
+                freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
+            ],
+                                dim=-1).reshape(f * h * w, 1, -1)
+            self.tables[key] = (
+                freqs_i.real.to(device=device, dtype=torch.float32).contiguous(),
+                freqs_i.imag.to(device=device, dtype=torch.float32).contiguous())
+        return self.tables[key]
+
+    def clear(self):
+        self.tables.clear()
+
+    @amp.autocast(enabled=False)
+    def apply(self, x, grid_sizes):
+        r"""
+        Args:
+            x(Tensor): Shape [B, L, N, C]
+            grid_sizes(Tensor): Shape [B, 3]
+        """
+        out = x.to(torch.float32, copy=True)
+        grids = grid_sizes.tolist()
+        if all(g == grids[0] for g in grids):
+            # batched CFG branches share one grid, rotate them together
+            groups = [(slice(None), grids[0])]
+        else:
+            groups = [(slice(i, i + 1), g) for i, g in enumerate(grids)]
+
+        for rows, (f, h, w) in groups:
+            seq_len = f * h * w
+            cos, sin = self.get(f, h, w, x.device)
+            x_i = out[rows, :seq_len].unflatten(-1, (-1, 2))
+            x_r, x_c = x_i.unbind(-1)
+            out[rows, :seq_len] = torch.stack(
+                [x_r * cos - x_c * sin, x_r * sin + x_c * cos], dim=-1).flatten(-2)
+        return out
+
+
 class WanRMSNorm(nn.Module):
 
     def __init__(self, dim, eps=1e-5):
@@ -137,7 +196,7 @@ class WanSelfAttention(nn.Module):
         self.norm_q = WanRMSNorm(dim, eps=eps) if qk_norm else nn.Identity()
         self.norm_k = WanRMSNorm(dim, eps=eps) if qk_norm else nn.Identity()
 
-    def forward(self, x, seq_lens, grid_sizes, freqs, ref_target_masks=None):
+    def forward(self, x, seq_lens, grid_sizes, freqs, ref_target_masks=None, compute_attn_map=True):
         b, s, n, d = *x.shape[:2], self.num_heads, self.head_dim
 
         # query, key, value function
@@ -148,8 +207,12 @@ class WanSelfAttention(nn.Module):
             return q, k, v
         q, k, v = qkv_fn(x)
 
-        q = rope_apply(q, grid_sizes, freqs)
-        k = rope_apply(k, grid_sizes, freqs)
+        if isinstance(freqs, RopeCache):
+            q = freqs.apply(q, grid_sizes)
+            k = freqs.apply(k, grid_sizes)
+        else:
+            q = rope_apply(q, grid_sizes, freqs)
+            k = rope_apply(k, grid_sizes, freqs)
 
         if USE_SAGEATTN:
             x = sageattn(q.to(torch.bfloat16), k.to(torch.bfloat16), v, tensor_layout='NHD')
@@ -165,9 +228,19 @@ class WanSelfAttention(nn.Module):
         # output
         x = x.flatten(2)
         x = self.o(x)
+        if not compute_attn_map:
+            return x, None
         with torch.no_grad():
-            x_ref_attn_map = get_attn_map_with_target(q.type_as(x), k.type_as(x), grid_sizes[0], 
-                                                    ref_target_masks=ref_target_masks)
+            if b == 1:
+                x_ref_attn_map = get_attn_map_with_target(q.type_as(x), k.type_as(x), grid_sizes[0], 
+                                                        ref_target_masks=ref_target_masks)
+            else:
+                # batched CFG: one reference map per guidance branch
+                x_ref_attn_map = [
+                    get_attn_map_with_target(q[i:i+1].type_as(x), k[i:i+1].type_as(x), grid_sizes[0],
+                                             ref_target_masks=ref_target_masks)
+                    for i in range(b)
+                ]
 
         return x, x_ref_attn_map
 
@@ -186,17 +259,31 @@ class WanI2VCrossAttention(WanSelfAttention):
         self.v_img = nn.Linear(dim, dim)
         self.norm_k_img = WanRMSNorm(dim, eps=eps) if qk_norm else nn.Identity()
 
-    def forward(self, x, context, context_lens):
+    def prepare_kv(self, context):
+        r"""
+        Project the (step-invariant) context to keys and values.
+
+        Args:
+            context(Tensor): Shape [B, 257 + L, C]
+        """
         context_img = context[:, :257]
         context = context[:, 257:]
-        b, n, d = x.size(0), self.num_heads, self.head_dim
+        b, n, d = context.size(0), self.num_heads, self.head_dim
 
-        # compute query, key, value
-        q = self.norm_q(self.q(x)).view(b, -1, n, d)
         k = self.norm_k(self.k(context)).view(b, -1, n, d)
         v = self.v(context).view(b, -1, n, d)
         k_img = self.norm_k_img(self.k_img(context_img)).view(b, -1, n, d)
         v_img = self.v_img(context_img).view(b, -1, n, d)
+        return k, v, k_img, v_img
+
+    def forward(self, x, context, context_lens, kv=None):
+        b, n, d = x.size(0), self.num_heads, self.head_dim
+
+        # compute query, key, value
+        q = self.norm_q(self.q(x)).view(b, -1, n, d)
+        if kv is None:
+            kv = self.prepare_kv(context)
+        k, v, k_img, v_img = kv
         if USE_SAGEATTN:
             img_x = sageattn(q, k_img, v_img, tensor_layout='NHD')
             x = sageattn(q, k, v, tensor_layout='NHD')
@@ -283,7 +370,17 @@ class WanAttentionBlock(nn.Module):
         audio_embedding=None,
         ref_target_masks=None,
         human_num=None,
+        kv_cache=None,
+        x_ref_attn_map=None,
+        return_ref_attn_map=False,
     ):
+        r"""
+        Args:
+            x_ref_attn_map (Tensor or List[Tensor], *optional*):
+                Reference attention map of an earlier block to reuse instead of computing one here
+            return_ref_attn_map (`bool`, *optional*, defaults to False):
+                Also return the reference attention map used by this block
+        """
 
         dtype = x.dtype
         assert e.dtype == torch.float32
@@ -291,21 +388,49 @@ class WanAttentionBlock(nn.Module):
             e = (self.modulation.to(e.device) + e).chunk(6, dim=1)
         assert e[0].dtype == torch.float32
 
+        # the reference map only routes audio between speakers, single-speaker runs never read it
+        if isinstance(human_num, (list, tuple)):
+            multi_person = max(human_num) > 1
+        else:
+            multi_person = human_num is None or human_num > 1
+
         # self-attention
-        y, x_ref_attn_map = self.self_attn(
+        y, attn_map = self.self_attn(
             (self.norm1(x).float() * (1 + e[1]) + e[0]).type_as(x), seq_lens, grid_sizes,
-            freqs, ref_target_masks=ref_target_masks)
+            freqs, ref_target_masks=ref_target_masks,
+            compute_attn_map=multi_person and x_ref_attn_map is None)
+        if x_ref_attn_map is None:
+            x_ref_attn_map = attn_map
         with amp.autocast(dtype=torch.float32):
             x = x + y * e[2]
         
         x = x.to(dtype)
 
         # cross-attention of text
-        x = x + self.cross_attn(self.norm3(x), context, context_lens)
+        if kv_cache is None:
+            x = x + self.cross_attn(self.norm3(x), context, context_lens)
+        else:
+            x = x + self.cross_attn(self.norm3(x), context, context_lens, kv=kv_cache['context_kv'])
 
         # cross attn of audio
-        x_a = self.audio_cross_attn(self.norm_x(x), encoder_hidden_states=audio_embedding,
-                                        shape=grid_sizes[0], x_ref_attn_map=x_ref_attn_map, human_num=human_num)
+        audio_kwargs = {}
+        if isinstance(audio_embedding, (list, tuple)):
+            # batched CFG with a different speaker count per branch
+            norm_x = self.norm_x(x)
+            x_a = []
+            for i in range(len(audio_embedding)):
+                if kv_cache is not None:
+                    audio_kwargs = dict(encoder_kv=kv_cache['audio_kv'][i])
+                x_a.append(self.audio_cross_attn(norm_x[i:i+1], encoder_hidden_states=audio_embedding[i],
+                                                 shape=grid_sizes[0], x_ref_attn_map=x_ref_attn_map[i],
+                                                 human_num=human_num[i], **audio_kwargs))
+            x_a = torch.cat(x_a)
+        else:
+            if kv_cache is not None:
+                audio_kwargs = dict(encoder_kv=kv_cache['audio_kv'])
+            x_a = self.audio_cross_attn(self.norm_x(x), encoder_hidden_states=audio_embedding,
+                                            shape=grid_sizes[0], x_ref_attn_map=x_ref_attn_map, human_num=human_num,
+                                            **audio_kwargs)
         x = x + x_a
 
         y = self.ffn((self.norm2(x).float() * (1 + e[4]) + e[3]).to(dtype))
@@ -315,6 +440,8 @@ class WanAttentionBlock(nn.Module):
 
         x = x.to(dtype)
 
+        if return_ref_attn_map:
+            return x, x_ref_attn_map
         return x
 
 
@@ -524,6 +651,7 @@ class WanModel(ModelMixin, ConfigMixin):
             rope_params(1024, 2 * (d // 6))
         ],
                                dim=1)
+        self.rope_cache = RopeCache(self.freqs)
 
         if model_type == 'i2v':
             self.img_emb = MLPProj(1280, dim)
@@ -541,6 +669,9 @@ class WanModel(ModelMixin, ConfigMixin):
                 )
 
 
+        # block whose reference attention map is shared with all later blocks, None computes it per block
+        self.ref_attn_map_block = None
+
         # initialize weights
         if weight_init:
             self.init_weights()
@@ -553,47 +684,161 @@ class WanModel(ModelMixin, ConfigMixin):
             rope_params(1024, 2 * (d // 6))
         ],
                                dim=1)
+        self.rope_cache = RopeCache(self.freqs)
 
-    def teacache_init(
-        self,
-        use_ret_steps=True,
-        teacache_thresh=0.2,
-        sample_steps=40,
-        model_scale='infinitetalk-480',
-    ):
-        print("teacache_init")
-        self.enable_teacache = True
-        
-        self.__class__.cnt = 0
-        self.__class__.num_steps = sample_steps*3
-        self.__class__.teacache_thresh = teacache_thresh
-        self.__class__.accumulated_rel_l1_distance_even = 0
-        self.__class__.accumulated_rel_l1_distance_odd = 0
-        self.__class__.previous_e0_even = None
-        self.__class__.previous_e0_odd = None
-        self.__class__.previous_residual_even = None
-        self.__class__.previous_residual_odd = None
-        self.__class__.use_ret_steps = use_ret_steps
-
-        if use_ret_steps:
-            if model_scale == 'infinitetalk-480':
-                self.__class__.coefficients = [ 2.57151496e+05, -3.54229917e+04,  1.40286849e+03, -1.35890334e+01, 1.32517977e-01]
-            if model_scale == 'infinitetalk-720':
-                self.__class__.coefficients = [ 8.10705460e+03,  2.13393892e+03, -3.72934672e+02,  1.66203073e+01, -4.17769401e-02]
-            self.__class__.ret_steps = 5*3
-            self.__class__.cutoff_steps = sample_steps*3
+    def time_modulation(self, t):
+        r"""
+        Time embedding `e` [B, C] and block modulation `e0` [B, 6, C] of timesteps `t` [B].
+        """
+        e = self.time_embedding(
+            sinusoidal_embedding_1d(self.freq_dim, t).float())
+        e0 = self.time_projection(e).unflatten(1, (6, self.dim))
+        return e, e0
+
+    def set_ref_attn_map_block(self, block_idx=None):
+        r"""
+        Compute the multi-person reference attention map only up to `block_idx` and reuse
+        that block's map in all later blocks. `None` restores the per-block map.
+        """
+        assert block_idx is None or 0 <= block_idx < self.num_layers
+        self.ref_attn_map_block = block_idx
+
+    def forward_blocks(self, x, block_kv=None, **kwargs):
+        r"""
+        Run all transformer blocks, sharing the reference attention map if requested.
+        """
+        if block_kv is None:
+            block_kv = [None] * len(self.blocks)
+        x_ref_attn_map = None
+        for i, (block, kv_cache) in enumerate(zip(self.blocks, block_kv)):
+            if self.ref_attn_map_block is not None and i == self.ref_attn_map_block:
+                x, x_ref_attn_map = block(x, kv_cache=kv_cache, return_ref_attn_map=True, **kwargs)
+            else:
+                x = block(x, kv_cache=kv_cache, x_ref_attn_map=x_ref_attn_map, **kwargs)
+        return x
+
+    def get_audio_embedding(self, audio, dtype, device):
+        r"""
+        Project windowed wav2vec features into audio context tokens.
+
+        Args:
+            audio (Tensor):
+                Shape [human_num, F, audio_window, blocks, channels]
+
+        Returns:
+            Tuple[Tensor, int]:
+                Audio tokens with shape [1, N_t, human_num * context_tokens, C] and the speaker count
+        """
+        audio_cond = audio.to(device=device, dtype=dtype)
+        first_frame_audio_emb_s = audio_cond[:, :1, ...] 
+        latter_frame_audio_emb = audio_cond[:, 1:, ...] 
+        latter_frame_audio_emb = rearrange(latter_frame_audio_emb, "b (n_t n) w s c -> b n_t n w s c", n=self.vae_scale) 
+        middle_index = self.audio_window // 2
+        latter_first_frame_audio_emb = latter_frame_audio_emb[:, :, :1, :middle_index+1, ...] 
+        latter_first_frame_audio_emb = rearrange(latter_first_frame_audio_emb, "b n_t n w s c -> b n_t (n w) s c") 
+        latter_last_frame_audio_emb = latter_frame_audio_emb[:, :, -1:, middle_index:, ...] 
+        latter_last_frame_audio_emb = rearrange(latter_last_frame_audio_emb, "b n_t n w s c -> b n_t (n w) s c") 
+        latter_middle_frame_audio_emb = latter_frame_audio_emb[:, :, 1:-1, middle_index:middle_index+1, ...] 
+        latter_middle_frame_audio_emb = rearrange(latter_middle_frame_audio_emb, "b n_t n w s c -> b n_t (n w) s c") 
+        latter_frame_audio_emb_s = torch.concat([latter_first_frame_audio_emb, latter_middle_frame_audio_emb, latter_last_frame_audio_emb], dim=2) 
+        audio_embedding = self.audio_proj(first_frame_audio_emb_s, latter_frame_audio_emb_s) 
+        human_num = len(audio_embedding)
+        audio_embedding = torch.concat(audio_embedding.split(1), dim=2).to(dtype)
+        return audio_embedding, human_num
+
+    @torch.no_grad()
+    def prepare_conditioning(
+            self,
+            context,
+            seq_len=None,
+            clip_fea=None,
+            y=None,
+            audio=None,
+            ref_target_masks=None,
+            cache_kv=False,
+        ):
+        r"""
+        Compute the conditioning that stays fixed over all sampling steps of a clip.
+
+        Takes the same keyword arguments as `forward`, so a CFG branch can be prepared
+        with `model.prepare_conditioning(**arg_c)` and reused via `cond_cache`.
+
+        Args:
+            cache_kv (`bool`, *optional*, defaults to False):
+                Also precompute the text/image cross-attention K/V and the audio K/V
+                projection of every block. Costs extra VRAM per branch.
+
+        Returns:
+            dict: embedded context, audio tokens, token-level reference masks and
+            optionally the per-block K/V projections
+        """
+        dtype, device = context[0].dtype, context[0].device
+
+        num_branches = len(context)
+        if isinstance(audio, (list, tuple)):
+            assert len(audio) == num_branches, 'batched CFG needs one audio tensor per context.'
         else:
-            if model_scale == 'infinitetalk-480':
-                self.__class__.coefficients = [-3.02331670e+02,  2.23948934e+02, -5.25463970e+01,  5.87348440e+00, -2.01973289e-01]
-        
-            if model_scale == 'infinitetalk-720':
-                self.__class__.coefficients = [-114.36346466,   65.26524496,  -18.82220707,    4.91518089,   -0.23412683]
-            self.__class__.ret_steps = 1*3
-            self.__class__.cutoff_steps = sample_steps*3 - 3
-        print("teacache_init done")
-    
-    def disable_teacache(self):
-        self.enable_teacache = False
+            audio = [audio]
+
+        # text embedding
+        context = self.text_embedding(
+            torch.stack([
+                torch.cat(
+                    [u, u.new_zeros(self.text_len - u.size(0), u.size(1))])
+                for u in context
+            ]))
+
+        # clip embedding
+        if clip_fea is not None:
+            context_clip = self.img_emb(clip_fea) 
+            context_clip = context_clip.expand(context.size(0), -1, -1)
+            context = torch.concat([context_clip, context], dim=1).to(dtype)
+
+        # audio embedding, one per branch
+        audio_embeddings, human_nums = zip(*[
+            self.get_audio_embedding(u, dtype, device) for u in audio])
+        if num_branches == 1:
+            audio_embedding, human_num = audio_embeddings[0], human_nums[0]
+        elif all(n == 1 for n in human_nums):
+            # same token layout in every branch, fold branches into the frame batch
+            audio_embedding, human_num = torch.cat(audio_embeddings).flatten(0, 1), 1
+        else:
+            audio_embedding, human_num = list(audio_embeddings), list(human_nums)
+
+        # convert ref_target_masks to token_ref_target_masks
+        token_ref_target_masks = None
+        if ref_target_masks is not None:
+            _, _, H, W = y[0].shape
+            N_h, N_w = H // self.patch_size[1], W // self.patch_size[2]
+            ref_target_masks = ref_target_masks.unsqueeze(0).to(torch.float32) 
+            token_ref_target_masks = nn.functional.interpolate(ref_target_masks, size=(N_h, N_w), mode='nearest') 
+            token_ref_target_masks = token_ref_target_masks.squeeze(0)
+            token_ref_target_masks = (token_ref_target_masks > 0)
+            token_ref_target_masks = token_ref_target_masks.view(token_ref_target_masks.shape[0], -1) 
+            token_ref_target_masks = token_ref_target_masks.to(dtype)
+
+        # per-block K/V projections of the conditions
+        block_kv = None
+        if cache_kv:
+            block_kv = []
+            for block in self.blocks:
+                if isinstance(audio_embedding, (list, tuple)):
+                    audio_kv = [block.audio_cross_attn.prepare_kv(u) for u in audio_embedding]
+                else:
+                    audio_kv = block.audio_cross_attn.prepare_kv(audio_embedding)
+                block_kv.append(dict(
+                    context_kv=block.cross_attn.prepare_kv(context),
+                    audio_kv=audio_kv,
+                ))
+
+        return dict(
+            num_branches=num_branches,
+            context=context,
+            audio_embedding=audio_embedding,
+            human_num=human_num,
+            ref_target_masks=token_ref_target_masks,
+            block_kv=block_kv,
+        )
 
     def forward(
             self,
@@ -605,13 +850,38 @@ class WanModel(ModelMixin, ConfigMixin):
             y=None,
             audio=None,
             ref_target_masks=None,
+            cond_cache=None,
+            step_cache=None,
         ):
+        r"""
+        Forward pass through the diffusion model.
+
+        Args:
+            x (List[Tensor]):
+                List of input video latents, each with shape [C_in, F, H, W]
+            t (Tensor):
+                Diffusion timesteps tensor of shape [1]
+            context (List[Tensor]):
+                List of text embeddings, one per guidance branch, each with shape [L, C]
+            audio (Tensor or List[Tensor]):
+                Windowed audio features. Pass a list with one tensor per entry of `context`
+                to evaluate several CFG branches in a single batched pass.
+            cond_cache (dict, *optional*):
+                Output of `prepare_conditioning` for the same inputs. Skips re-embedding
+                text, CLIP and audio conditions on every sampling step.
+            step_cache (BranchCache, *optional*):
+                TeaCache state of this CFG branch, see `wan.utils.teacache.StepCache`.
+
+        Returns:
+            Tensor:
+                Denoised video latents with shape [B, C_out, F, H, W], one entry per branch
+        """
         assert clip_fea is not None and y is not None
 
-        _, T, H, W = x[0].shape
-        N_t = T // self.patch_size[0]
-        N_h = H // self.patch_size[1]
-        N_w = W // self.patch_size[2]
+        if cond_cache is None:
+            cond_cache = self.prepare_conditioning(
+                context, clip_fea=clip_fea, y=y, audio=audio, ref_target_masks=ref_target_masks)
+        num_branches = cond_cache['num_branches']
 
         if y is not None:
             x = [torch.cat([u, v], dim=0) for u, v in zip(x, y)]
@@ -628,148 +898,48 @@ class WanModel(ModelMixin, ConfigMixin):
             torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))],
                       dim=1) for u in x
         ])
+        if num_branches > 1 and x.size(0) == 1:
+            # all CFG branches share the same noisy latent
+            x = x.repeat(num_branches, 1, 1)
+            grid_sizes = grid_sizes.repeat(num_branches, 1)
+            seq_lens = seq_lens.repeat(num_branches)
 
         # time embeddings
         with amp.autocast(dtype=torch.float32):
-            e = self.time_embedding(
-                sinusoidal_embedding_1d(self.freq_dim, t).float())
-            e0 = self.time_projection(e).unflatten(1, (6, self.dim))
+            e, e0 = self.time_modulation(t)
             assert e.dtype == torch.float32 and e0.dtype == torch.float32
 
-        # text embedding
+        # step-invariant conditioning
         context_lens = None
-        context = self.text_embedding(
-            torch.stack([
-                torch.cat(
-                    [u, u.new_zeros(self.text_len - u.size(0), u.size(1))])
-                for u in context
-            ]))
-
-        # clip embedding
-        if clip_fea is not None:
-            context_clip = self.img_emb(clip_fea) 
-            context = torch.concat([context_clip, context], dim=1).to(x.dtype)
-
-        
-        audio_cond = audio.to(device=x.device, dtype=x.dtype)
-        first_frame_audio_emb_s = audio_cond[:, :1, ...] 
-        latter_frame_audio_emb = audio_cond[:, 1:, ...] 
-        latter_frame_audio_emb = rearrange(latter_frame_audio_emb, "b (n_t n) w s c -> b n_t n w s c", n=self.vae_scale) 
-        middle_index = self.audio_window // 2
-        latter_first_frame_audio_emb = latter_frame_audio_emb[:, :, :1, :middle_index+1, ...] 
-        latter_first_frame_audio_emb = rearrange(latter_first_frame_audio_emb, "b n_t n w s c -> b n_t (n w) s c") 
-        latter_last_frame_audio_emb = latter_frame_audio_emb[:, :, -1:, middle_index:, ...] 
-        latter_last_frame_audio_emb = rearrange(latter_last_frame_audio_emb, "b n_t n w s c -> b n_t (n w) s c") 
-        latter_middle_frame_audio_emb = latter_frame_audio_emb[:, :, 1:-1, middle_index:middle_index+1, ...] 
-        latter_middle_frame_audio_emb = rearrange(latter_middle_frame_audio_emb, "b n_t n w s c -> b n_t (n w) s c") 
-        latter_frame_audio_emb_s = torch.concat([latter_first_frame_audio_emb, latter_middle_frame_audio_emb, latter_last_frame_audio_emb], dim=2) 
-        audio_embedding = self.audio_proj(first_frame_audio_emb_s, latter_frame_audio_emb_s) 
-        human_num = len(audio_embedding)
-        audio_embedding = torch.concat(audio_embedding.split(1), dim=2).to(x.dtype)
-
-
-        # convert ref_target_masks to token_ref_target_masks
-        if ref_target_masks is not None:
-            ref_target_masks = ref_target_masks.unsqueeze(0).to(torch.float32) 
-            token_ref_target_masks = nn.functional.interpolate(ref_target_masks, size=(N_h, N_w), mode='nearest') 
-            token_ref_target_masks = token_ref_target_masks.squeeze(0)
-            token_ref_target_masks = (token_ref_target_masks > 0)
-            token_ref_target_masks = token_ref_target_masks.view(token_ref_target_masks.shape[0], -1) 
-            token_ref_target_masks = token_ref_target_masks.to(x.dtype)
-
-        # teacache
-        if self.enable_teacache:
-            modulated_inp = e0 if self.use_ret_steps else e
-            if self.cnt%3==0: # cond
-                if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
-                    should_calc_cond = True
-                    self.accumulated_rel_l1_distance_cond = 0
-                else:
-                    rescale_func = np.poly1d(self.coefficients)
-                    self.accumulated_rel_l1_distance_cond += rescale_func(((modulated_inp-self.previous_e0_cond).abs().mean() / self.previous_e0_cond.abs().mean()).cpu().item())
-                    if self.accumulated_rel_l1_distance_cond < self.teacache_thresh:
-                        should_calc_cond = False
-                    else:
-                        should_calc_cond = True
-                        self.accumulated_rel_l1_distance_cond = 0
-                self.previous_e0_cond = modulated_inp.clone()
-            elif self.cnt%3==1: # drop_text
-                if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
-                    should_calc_drop_text = True
-                    self.accumulated_rel_l1_distance_drop_text = 0
-                else:
-                    rescale_func = np.poly1d(self.coefficients)
-                    self.accumulated_rel_l1_distance_drop_text += rescale_func(((modulated_inp-self.previous_e0_drop_text).abs().mean() / self.previous_e0_drop_text.abs().mean()).cpu().item())
-                    if self.accumulated_rel_l1_distance_drop_text < self.teacache_thresh:
-                        should_calc_drop_text = False
-                    else:
-                        should_calc_drop_text = True
-                        self.accumulated_rel_l1_distance_drop_text = 0
-                self.previous_e0_drop_text = modulated_inp.clone()
-            else: # uncond
-                if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
-                    should_calc_uncond = True
-                    self.accumulated_rel_l1_distance_uncond = 0
-                else:
-                    rescale_func = np.poly1d(self.coefficients)
-                    self.accumulated_rel_l1_distance_uncond += rescale_func(((modulated_inp-self.previous_e0_uncond).abs().mean() / self.previous_e0_uncond.abs().mean()).cpu().item())
-                    if self.accumulated_rel_l1_distance_uncond < self.teacache_thresh:
-                        should_calc_uncond = False
-                    else:
-                        should_calc_uncond = True
-                        self.accumulated_rel_l1_distance_uncond = 0
-                self.previous_e0_uncond = modulated_inp.clone()
+        context = cond_cache['context']
+        audio_embedding = cond_cache['audio_embedding']
+        human_num = cond_cache['human_num']
+        token_ref_target_masks = cond_cache['ref_target_masks']
+        block_kv = cond_cache['block_kv']
 
         # arguments
         kwargs = dict(
             e=e0,
             seq_lens=seq_lens,
             grid_sizes=grid_sizes,
-            freqs=self.freqs,
+            freqs=self.rope_cache,
             context=context,
             context_lens=context_lens,
             audio_embedding=audio_embedding,
             ref_target_masks=token_ref_target_masks,
             human_num=human_num,
             )
-        if self.enable_teacache:
-            if self.cnt%3==0:
-                if not should_calc_cond:
-                    x +=  self.previous_residual_cond
-                else:
-                    ori_x = x.clone()
-                    for block in self.blocks:
-                        x = block(x, **kwargs)
-                    self.previous_residual_cond = x - ori_x
-            elif self.cnt%3==1:
-                if not should_calc_drop_text:
-                    x +=  self.previous_residual_drop_text
-                else:
-                    ori_x = x.clone()
-                    for block in self.blocks:
-                        x = block(x, **kwargs)
-                    self.previous_residual_drop_text = x - ori_x
-            else:
-                if not should_calc_uncond:
-                    x +=  self.previous_residual_uncond
-                else:
-                    ori_x = x.clone()
-                    for block in self.blocks:
-                        x = block(x, **kwargs)
-                    self.previous_residual_uncond = x - ori_x
+        if step_cache is not None:
+            # a batched CFG pass keeps the per-branch residuals stacked along the batch
+            x = step_cache.run(x, lambda x: self.forward_blocks(x, block_kv, **kwargs), self.time_modulation)
         else:
-            for block in self.blocks:
-                x = block(x, **kwargs)
+            x = self.forward_blocks(x, block_kv, **kwargs)
 
         # head
         x = self.head(x, e)
 
         # unpatchify
         x = self.unpatchify(x, grid_sizes)
-        if self.enable_teacache:
-            self.cnt += 1
-            if self.cnt >= self.num_steps:
-                self.cnt = 0
 
         return torch.stack(x).float()
 
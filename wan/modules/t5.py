@@ -480,7 +480,7 @@ class T5EncoderModel:
         self,
         text_len,
         dtype=torch.bfloat16,
-        device=torch.cuda.current_device(),
+        device=None,
         checkpoint_path=None,
         tokenizer_path=None,
         shard_fn=None,
@@ -488,6 +488,9 @@ class T5EncoderModel:
         quant_dir=None
     ):
         assert quant is None or quant in ("int8", "fp8")
+        if device is None:
+            # resolved on use, importing the module must not need a GPU
+            device = torch.cuda.current_device()
         self.text_len = text_len
         self.dtype = dtype
         self.device = device
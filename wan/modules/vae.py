@@ -480,6 +480,56 @@ def count_conv3d(model):
     return count
 
 
+def _tile_starts(size, tile, stride):
+    if size <= tile:
+        return [0]
+    return list(range(0, size - tile, stride)) + [size - tile]
+
+
+def _feather(length, overlap_lo, overlap_hi, device):
+    """Weights of one tile along one axis, linear ramps where it overlaps its neighbours."""
+    weight = torch.ones(length, device=device)
+    if overlap_lo > 0:
+        weight[:overlap_lo] = torch.linspace(0, 1, overlap_lo + 2, device=device)[1:-1]
+    if overlap_hi > 0:
+        weight[-overlap_hi:] = torch.linspace(1, 0, overlap_hi + 2, device=device)[1:-1]
+    return weight
+
+
+def _tiled(fn, x, tile_size, tile_overlap, factor):
+    """
+    Apply `fn` to overlapping spatial tiles of x [B, C, T, H, W] and feather-blend the
+    results. `tile_size` and `tile_overlap` are in units of x; `fn` scales H and W by
+    `factor` (8 for decode, 1/8 for encode).
+    """
+    h, w = x.shape[-2:]
+    stride = tile_size - tile_overlap
+    ys, xs = _tile_starts(h, tile_size, stride), _tile_starts(w, tile_size, stride)
+    # tile edges in output units
+    y_edges = [(int(y * factor), int(min(y + tile_size, h) * factor)) for y in ys]
+    x_edges = [(int(x0 * factor), int(min(x0 + tile_size, w) * factor)) for x0 in xs]
+
+    out, weight = None, None
+    for i, y in enumerate(ys):
+        for j, x0 in enumerate(xs):
+            tile = fn(x[..., y:y + tile_size, x0:x0 + tile_size])
+            if out is None:
+                out = tile.new_zeros(*tile.shape[:3], int(h * factor), int(w * factor))
+                weight = tile.new_zeros(1, 1, 1, *out.shape[-2:])
+            (y_lo, y_hi), (x_lo, x_hi) = y_edges[i], x_edges[j]
+            wy = _feather(y_hi - y_lo,
+                          y_edges[i - 1][1] - y_lo if i > 0 else 0,
+                          y_hi - y_edges[i + 1][0] if i + 1 < len(ys) else 0, tile.device)
+            wx = _feather(x_hi - x_lo,
+                          x_edges[j - 1][1] - x_lo if j > 0 else 0,
+                          x_hi - x_edges[j + 1][0] if j + 1 < len(xs) else 0, tile.device)
+            mask = (wy[:, None] * wx[None, :]).to(tile.dtype)
+            out[..., y_lo:y_hi, x_lo:x_hi] += tile * mask
+            weight[..., y_lo:y_hi, x_lo:x_hi] += mask
+            del tile
+    return out / weight
+
+
 class WanVAE_(nn.Module):
 
     def __init__(self,
@@ -519,19 +569,22 @@ class WanVAE_(nn.Module):
         t = x.shape[2]
         iter_ = 1 + (t - 1) // 4
         ## 对encode输入的x，按时间拆分为1、4、4、4....
+        # every chunk yields one latent frame, written in place into the preallocated output
+        out = None
         for i in range(iter_):
             self._enc_conv_idx = [0]
             if i == 0:
-                out = self.encoder(
-                    x[:, :, :1, :, :],
-                    feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx)
+                chunk = x[:, :, :1, :, :]
             else:
-                out_ = self.encoder(
-                    x[:, :, 1 + 4 * (i - 1):1 + 4 * i, :, :],
-                    feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx)
-                out = torch.cat([out, out_], 2)
+                chunk = x[:, :, 1 + 4 * (i - 1):1 + 4 * i, :, :]
+            out_ = self.encoder(
+                chunk,
+                feat_cache=self._enc_feat_map,
+                feat_idx=self._enc_conv_idx)
+            if out is None:
+                out = out_.new_empty(*out_.shape[:2], iter_, *out_.shape[3:])
+            out[:, :, i:i + 1] = out_
+            del out_
         mu, log_var = self.conv1(out).chunk(2, dim=1)
         if isinstance(scale[0], torch.Tensor):
             mu = (mu - scale[0].view(1, self.z_dim, 1, 1, 1)) * scale[1].view(
@@ -551,21 +604,38 @@ class WanVAE_(nn.Module):
             z = z / scale[1] + scale[0]
         iter_ = z.shape[2]
         x = self.conv2(z)
+        # the first latent frame decodes to one frame, every later one to four
+        out = None
+        num_frames = 1 + 4 * (iter_ - 1)
+        start = 0
         for i in range(iter_):
             self._conv_idx = [0]
-            if i == 0:
-                out = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx)
-            else:
-                out_ = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx)
-                out = torch.cat([out, out_], 2)
+            out_ = self.decoder(
+                x[:, :, i:i + 1, :, :],
+                feat_cache=self._feat_map,
+                feat_idx=self._conv_idx)
+            if out is None:
+                out = out_.new_empty(*out_.shape[:2], num_frames, *out_.shape[3:])
+            out[:, :, start:start + out_.shape[2]] = out_
+            start += out_.shape[2]
+            del out_
         self.clear_cache()
-        return out
+        return out[:, :, :start]
+
+    def tiled_encode(self, x, scale, tile_size=32, tile_overlap=16):
+        """
+        `encode` over overlapping spatial tiles; `tile_size` and `tile_overlap` are in latent
+        pixels (8 video pixels). Every tile runs the whole clip with its own causal cache.
+        """
+        return _tiled(lambda u: self.encode(u, scale), x, tile_size * 8, tile_overlap * 8, 1 / 8)
+
+    def tiled_decode(self, z, scale, tile_size=32, tile_overlap=16):
+        """
+        `decode` over overlapping latent tiles of `tile_size` latent pixels, blended with
+        linear ramps across the `tile_overlap` seams. Decoder activations are bounded by the
+        tile size instead of the resolution.
+        """
+        return _tiled(lambda u: self.decode(u, scale), z, tile_size, tile_overlap, 8)
 
     def reparameterize(self, mu, log_var):
         std = torch.exp(0.5 * log_var)
@@ -580,13 +650,17 @@ class WanVAE_(nn.Module):
         return mu + std * torch.randn_like(std)
 
     def clear_cache(self):
-        self._conv_num = count_conv3d(self.decoder)
+        # the module tree is fixed, count the causal convs once and reuse the cache lists
+        if not hasattr(self, '_conv_num'):
+            self._conv_num = count_conv3d(self.decoder)
+            self._enc_conv_num = count_conv3d(self.encoder)
+            self._feat_map = [None] * self._conv_num
+            self._enc_feat_map = [None] * self._enc_conv_num
         self._conv_idx = [0]
-        self._feat_map = [None] * self._conv_num
+        self._feat_map[:] = [None] * self._conv_num
         #cache encode
-        self._enc_conv_num = count_conv3d(self.encoder)
         self._enc_conv_idx = [0]
-        self._enc_feat_map = [None] * self._enc_conv_num
+        self._enc_feat_map[:] = [None] * self._enc_conv_num
 
 
 def _video_vae(pretrained_path=None, z_dim=None, device='cpu', **kwargs):
@@ -604,6 +678,10 @@ def _video_vae(pretrained_path=None, z_dim=None, device='cpu', **kwargs):
         dropout=0.0)
     cfg.update(**kwargs)
 
+    # random weights without a checkpoint, e.g. for benchmarks
+    if pretrained_path is None:
+        return WanVAE_(**cfg).to(device)
+
     # init model
     with torch.device('meta'):
         model = WanVAE_(**cfg)
@@ -622,7 +700,8 @@ class WanVAE:
                  z_dim=16,
                  vae_pth='cache/vae_step_411000.pth',
                  dtype=torch.float,
-                 device="cuda"):
+                 device="cuda",
+                 **kwargs):
         self.dtype = dtype
         self.device = device
 
@@ -638,26 +717,50 @@ class WanVAE:
         self.std = torch.tensor(std, dtype=dtype, device=device)
         self.scale = [self.mean, 1.0 / self.std]
 
-        # init model
+        # init model, kwargs override the architecture and vae_pth=None keeps random weights
         self.model = _video_vae(
             pretrained_path=vae_pth,
             z_dim=z_dim,
+            **kwargs,
         ).eval().requires_grad_(False).to(device)
 
+        # spatial tiling, see `enable_tiling`
+        self.tile_size = None
+        self.tile_overlap = 16
+
+    def enable_tiling(self, tile_size=32, tile_overlap=16):
+        """
+        Encode and decode in overlapping spatial tiles of `tile_size` latent pixels. Not
+        exact: the tiles miss each other's context, the error near the seams shrinks as
+        `tile_overlap` grows.
+        """
+        assert tile_size > tile_overlap >= 0, "The tile must be larger than its overlap."
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+
+    def _encode(self, x):
+        if self.tile_size is None:
+            return self.model.encode(x, self.scale)
+        return self.model.tiled_encode(x, self.scale, self.tile_size, self.tile_overlap)
+
+    def _decode(self, z):
+        if self.tile_size is None:
+            return self.model.decode(z, self.scale)
+        return self.model.tiled_decode(z, self.scale, self.tile_size, self.tile_overlap)
+
     def encode(self, videos):
         """
         videos: A list of videos each with shape [C, T, H, W].
         """
         with amp.autocast(dtype=self.dtype):
             return [
-                self.model.encode(u.unsqueeze(0), self.scale).float().squeeze(0)
+                self._encode(u.unsqueeze(0)).float().squeeze(0)
                 for u in videos
             ]
 
     def decode(self, zs):
         with amp.autocast(dtype=self.dtype):
             return [
-                self.model.decode(u.unsqueeze(0),
-                                  self.scale).float().clamp_(-1, 1).squeeze(0)
+                self._decode(u.unsqueeze(0)).float().clamp_(-1, 1).squeeze(0)
                 for u in zs
             ]
@@ -29,9 +29,16 @@ from .modules.clip import CLIPModel
 from .modules.multitalk_model import WanModel, WanLayerNorm, WanRMSNorm
 from .modules.t5 import T5EncoderModel, T5LayerNorm, T5RelativeEmbedding
 from .modules.vae import WanVAE, CausalConv3d, RMS_norm, Upsample
-from .utils.multitalk_utils import MomentumBuffer, adaptive_projected_guidance, match_and_blend_colors
-from src.vram_management import AutoWrappedQLinear, AutoWrappedLinear, AutoWrappedModule, enable_vram_management
-from wan.utils.utils import convert_video_to_h264, extract_specific_frames, get_video_codec
+from .utils.multitalk_utils import MomentumBuffer, adaptive_projected_guidance, ClipPostprocessor
+from .utils.vram_planner import DIT_MODULE_ORDER
+from .utils.teacache import StepCache, load_coefficients
+from .utils.memory_policy import MemoryPolicy
+from .utils.tracer import NULL_TRACER
+from .utils.fm_solvers import FlowDPMSolverMultistepScheduler, get_sampling_sigmas, retrieve_timesteps
+from .utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
+from src.vram_management import AutoWrappedQLinear, AutoWrappedLinear, AutoWrappedModule, enable_vram_management, OffloadPrefetcher
+from wan.utils.utils import convert_video_to_h264, get_video_codec, CondFrameReader
+from src.audio_analysis.chunked_embedding import AudioEmbeddingStream, embedding_length
 from wan.wan_lora import WanLoraWrapper
 
 from safetensors.torch import load_file
@@ -92,6 +99,16 @@ def resize_and_centercrop(cond_image, target_size):
         return cropped_tensor
 
 
+def prepare_cond_frame(cond_image, target_size):
+    """
+    Resize, center-crop and normalize a condition frame to [-1, 1], shape 1 C 1 H W.
+    """
+    cond_image = resize_and_centercrop(cond_image, target_size)
+    cond_image = cond_image / 255
+    cond_image = (cond_image - 0.5) * 2 # normalization
+    return cond_image
+
+
 def timestep_transform(
     t,
     shift=5.0,
@@ -104,6 +121,16 @@ def timestep_transform(
     return new_t
 
 
+def merge_cfg_args(*branch_args):
+    """
+    Stack the model kwargs of several CFG branches into one batched call.
+    """
+    merged = dict(branch_args[0])
+    merged['context'] = [u for arg in branch_args for u in arg['context']]
+    merged['audio'] = [arg['audio'] for arg in branch_args]
+    return merged
+
+
 
 class InfiniteTalkPipeline:
 
@@ -297,7 +324,7 @@ class InfiniteTalkPipeline:
 
         return (1 - timesteps) * original_samples + timesteps * noise
 
-    def enable_vram_management(self, num_persistent_param_in_dit=None):
+    def enable_vram_management(self, num_persistent_param_in_dit=None, prefetch_offload=False):
         dtype = next(iter(self.model.parameters())).dtype
         enable_vram_management(
             self.model,
@@ -326,7 +353,11 @@ class InfiniteTalkPipeline:
                 computation_dtype=self.param_dtype,
                 computation_device=self.device,
             ),
+            module_order=DIT_MODULE_ORDER,
         )
+        if prefetch_offload:
+            # copy the offloaded weights of the next block while the current one runs
+            self.offload_prefetcher = OffloadPrefetcher(self.model.blocks, self.device)
         self.enable_cpu_offload()
 
     def enable_cpu_offload(self):
@@ -373,6 +404,34 @@ class InfiniteTalkPipeline:
         torch.cuda.empty_cache()
 
    
+    def _build_scheduler(self, sample_solver, sampling_steps, shift):
+        """
+        Multistep flow solver for one clip. Returns the scheduler and its timesteps as
+        [1]-shaped tensors with a trailing 0, the layout of the Euler loop.
+        """
+        if sample_solver == 'unipc':
+            sample_scheduler = FlowUniPCMultistepScheduler(
+                num_train_timesteps=self.num_train_timesteps,
+                shift=1,
+                use_dynamic_shifting=False)
+            sample_scheduler.set_timesteps(
+                sampling_steps, device=self.device, shift=shift)
+            timesteps = sample_scheduler.timesteps
+        elif sample_solver == 'dpm++':
+            sample_scheduler = FlowDPMSolverMultistepScheduler(
+                num_train_timesteps=self.num_train_timesteps,
+                shift=1,
+                use_dynamic_shifting=False)
+            sampling_sigmas = get_sampling_sigmas(sampling_steps, shift)
+            timesteps, _ = retrieve_timesteps(
+                sample_scheduler,
+                device=self.device,
+                sigmas=sampling_sigmas)
+        else:
+            raise NotImplementedError("Unsupported solver.")
+        timesteps = [t.view(1) for t in timesteps] + [torch.zeros(1, device=self.device)]
+        return sample_scheduler, timesteps
+
     def generate_infinitetalk(self,
                  input_data,
                  size_buckget='infinitetalk-480',
@@ -389,6 +448,10 @@ class InfiniteTalkPipeline:
                  face_scale=0.05,
                  progress=True,
                  color_correction_strength=0.0,
+                 video_writer=None,
+                 progress_callback=None,
+                 step_cache=None,
+                 tracer=NULL_TRACER,
                  extra_args=None):
         r"""
         Generates video frames from input image and text prompt using diffusion process.
@@ -407,17 +470,37 @@ class InfiniteTalkPipeline:
                 Random seed for noise generation. If -1, use random seed
             offload_model (`bool`, *optional*, defaults to True):
                 If True, offloads models to CPU during generation to save VRAM
+            video_writer (`StreamingVideoWriter`, *optional*, defaults to None):
+                If given, every finished clip is written to it right away and nothing is returned,
+                instead of keeping all clips in memory and returning the whole video
+            progress_callback (`callable`, *optional*, defaults to None):
+                Called after every clip as `progress_callback(frames_done, total_frames)`
+            step_cache (`StepCache`, *optional*, defaults to None):
+                TeaCache state to use instead of the one built from `extra_args.use_teacache`,
+                e.g. a calibrating one
+            tracer (`StageTracer`, *optional*, defaults to NULL_TRACER):
+                Records the time spent in every stage, down to each DiT forward per CFG branch
         """
 
-        # init teacache
-        if extra_args.use_teacache:
-            self.model.teacache_init(
+        # batched CFG is not wired into the sequence-parallel forward
+        batched_cfg = extra_args.batched_cfg
+        if batched_cfg and self.use_usp:
+            logging.warning("batched_cfg is not supported with sequence parallel, falling back to sequential CFG.")
+            batched_cfg = False
+
+        # when cached CUDA memory is released, and the per-stage peaks of this request
+        memory = MemoryPolicy(getattr(extra_args, 'memory_policy', 'pressure'), self.device)
+
+        # teacache state of this request
+        if step_cache is None and extra_args.use_teacache:
+            coefficients = load_coefficients(
+                extra_args.size,
                 sample_steps=sampling_steps,
-                teacache_thresh=extra_args.teacache_thresh,
-                model_scale=extra_args.size,
+                sample_solver=getattr(extra_args, 'sample_solver', 'euler'),
+                path=getattr(extra_args, 'teacache_coefficients', None),
             )
-        else:
-            self.model.disable_teacache()
+            step_cache = StepCache(coefficients, thresh=extra_args.teacache_thresh)
+        self.model.set_ref_attn_map_block(extra_args.ref_attn_map_block)
 
         input_prompt = input_data['prompt']
         cond_file_path = input_data['cond_video']
@@ -430,424 +513,535 @@ class InfiniteTalkPipeline:
             cond_file_path = output_video_path
         else:
             print("No conversion needed.")
-        cond_image = extract_specific_frames(cond_file_path, 0)
-        # cond_image = Image.fromarray(cond_image)
+        frame_reader = CondFrameReader(cond_file_path)
+        postprocessor = None
+        # the reader and the post-processor own worker threads, release them on failure too
+        try:
+            with tracer.span('frame_read'):
+                cond_image = frame_reader.get(0)
+            # cond_image = Image.fromarray(cond_image)
         
         
-        # decide a proper size
-        bucket_config_module = importlib.import_module("wan.utils.multitalk_utils")
-        if size_buckget == 'infinitetalk-480':
-            bucket_config = getattr(bucket_config_module, 'ASPECT_RATIO_627')
-        elif size_buckget == 'infinitetalk-720':
-            bucket_config = getattr(bucket_config_module, 'ASPECT_RATIO_960')
-
-        src_h, src_w = cond_image.height, cond_image.width
-        ratio = src_h / src_w
-        closest_bucket = sorted(list(bucket_config.keys()), key=lambda x: abs(float(x)-ratio))[0]
-        target_h, target_w = bucket_config[closest_bucket][0]
-        cond_image = resize_and_centercrop(cond_image, (target_h, target_w))
-        cond_image = cond_image / 255
-        cond_image = (cond_image - 0.5) * 2 # normalization
-        cond_image = cond_image.to(self.device)  # 1 C 1 H W
-
-        # Store the original image for color reference if strength > 0
-        original_color_reference = None
-        if color_correction_strength > 0.0:
-            original_color_reference = cond_image.clone()
-
-
-        # read audio embeddings
-        audio_embedding_path_1 = input_data['cond_audio']['person1']
-        if len(input_data['cond_audio']) == 1:
-            HUMAN_NUMBER = 1
-            audio_embedding_path_2 = None
-        else:
-            HUMAN_NUMBER = 2
-            audio_embedding_path_2 = input_data['cond_audio']['person2']
+            # decide a proper size
+            bucket_config_module = importlib.import_module("wan.utils.multitalk_utils")
+            if size_buckget == 'infinitetalk-480':
+                bucket_config = getattr(bucket_config_module, 'ASPECT_RATIO_627')
+            elif size_buckget == 'infinitetalk-720':
+                bucket_config = getattr(bucket_config_module, 'ASPECT_RATIO_960')
+
+            src_h, src_w = cond_image.height, cond_image.width
+            ratio = src_h / src_w
+            closest_bucket = sorted(list(bucket_config.keys()), key=lambda x: abs(float(x)-ratio))[0]
+            target_h, target_w = bucket_config[closest_bucket][0]
+            frame_reader.transform = partial(prepare_cond_frame, target_size=(target_h, target_w))
+            cond_image = frame_reader.transform(cond_image)
+            cond_image = cond_image.to(self.device)  # 1 C 1 H W
+            # decode the next clip's condition frame while this one is sampled
+            clip_stride = frame_num - motion_frame
+            frame_reader.prefetch(clip_stride)
 
-        
-        full_audio_embs = []        
-        audio_embedding_paths = [audio_embedding_path_1, audio_embedding_path_2]
-        for human_idx in range(HUMAN_NUMBER):   
-            audio_embedding_path = audio_embedding_paths[human_idx]
-            if not os.path.exists(audio_embedding_path):
-                continue
-            full_audio_emb = torch.load(audio_embedding_path)
-            if torch.isnan(full_audio_emb).any():
-                continue
-            if full_audio_emb.shape[0] <= frame_num:
-                continue
-            full_audio_embs.append(full_audio_emb) 
-        
-        assert len(full_audio_embs) == HUMAN_NUMBER, f"Aduio file not exists or length not satisfies frame nums."
-
-        # preprocess text embedding
-        if n_prompt == "":
-            n_prompt = self.sample_neg_prompt
-        if not self.t5_cpu:
-            self.text_encoder.model.to(self.device)
-            context, context_null = self.text_encoder([input_prompt, n_prompt], self.device)
-            if offload_model:
-                self.text_encoder.model.cpu()
-        else:
-            context = self.text_encoder([input_prompt], torch.device('cpu'))
-            context_null = self.text_encoder([n_prompt], torch.device('cpu'))
-            context = [t.to(self.device) for t in context]
-            context_null = [t.to(self.device) for t in context_null]
-
-        torch_gc()
-        # prepare params for video generation
-        indices = (torch.arange(2 * 2 + 1) - 2) * 1 
-        clip_length = frame_num
-        is_first_clip = True
-        arrive_last_frame = False
-        cur_motion_frames_num = 1
-        audio_start_idx = 0
-        audio_end_idx = audio_start_idx + clip_length
-        gen_video_list = []
-        torch_gc()
-
-        # set random seed and init noise
-        seed = seed if seed >= 0 else random.randint(0, 99999999)
-        torch.manual_seed(seed)
-        torch.cuda.manual_seed_all(seed)
-        np.random.seed(seed)
-        random.seed(seed)
-        torch.backends.cudnn.deterministic = True
-
-        # start video generation iteratively
-        while True:
-            audio_embs = []
-            # split audio with window size
-            for human_idx in range(HUMAN_NUMBER):   
-                center_indices = torch.arange(
-                    audio_start_idx,
-                    audio_end_idx,
-                    1,
-                ).unsqueeze(
-                    1
-                ) + indices.unsqueeze(0)
-                center_indices = torch.clamp(center_indices, min=0, max=full_audio_embs[human_idx].shape[0]-1)
-                audio_emb = full_audio_embs[human_idx][center_indices][None,...].to(self.device)
-                audio_embs.append(audio_emb)
-            audio_embs = torch.concat(audio_embs, dim=0).to(self.param_dtype)
-            torch_gc()
-
-            h, w = cond_image.shape[-2], cond_image.shape[-1]
-            lat_h, lat_w = h // self.vae_stride[1], w // self.vae_stride[2]
-            max_seq_len = ((frame_num - 1) // self.vae_stride[0] + 1) * lat_h * lat_w // (
-                self.patch_size[1] * self.patch_size[2])
-            max_seq_len = int(math.ceil(max_seq_len / self.sp_size)) * self.sp_size
-
-
-
-            noise = torch.randn(
-                16, (frame_num - 1) // 4 + 1,
-                lat_h,
-                lat_w,
-                dtype=torch.float32,
-                device=self.device) 
-
-            # get mask
-            msk = torch.ones(1, frame_num, lat_h, lat_w, device=self.device)
-            msk[:, 1:] = 0
-            msk = torch.concat([
-                torch.repeat_interleave(msk[:, 0:1], repeats=4, dim=1), msk[:, 1:]
-            ],
-                            dim=1)
-            msk = msk.view(1, msk.shape[1] // 4, 4, lat_h, lat_w)
-            msk = msk.transpose(1, 2).to(self.param_dtype) # B 4 T H W
-
-            with torch.no_grad():
-                # get clip embedding
-                self.clip.model.to(self.device)
-                clip_context = self.clip.visual(cond_image[:, :, -1:, :, :]).to(self.param_dtype) 
-                if offload_model:
-                    self.clip.model.cpu()
-                torch_gc()
+            # Store the original image for color reference if strength > 0
+            original_color_reference = None
+            if color_correction_strength > 0.0:
+                original_color_reference = cond_image.clone()
 
-                # zero padding and vae encode
-                video_frames = torch.zeros(1, cond_image.shape[1], frame_num-cond_image.shape[2], target_h, target_w).to(self.device)
-                padding_frames_pixels_values = torch.concat([cond_image, video_frames], dim=2)
-                y = self.vae.encode(padding_frames_pixels_values) 
-                y = torch.stack(y).to(self.param_dtype) # B C T H W
-                cur_motion_frames_latent_num = int(1 + (cur_motion_frames_num-1) // 4)
 
-                if is_first_clip:
-                    latent_motion_frames = self.vae.encode(cond_image)[0]
+            # read audio embeddings
+            audio_embedding_path_1 = input_data['cond_audio']['person1']
+            if len(input_data['cond_audio']) == 1:
+                HUMAN_NUMBER = 1
+                audio_embedding_path_2 = None
+            else:
+                HUMAN_NUMBER = 2
+                audio_embedding_path_2 = input_data['cond_audio']['person2']
+
+        
+            full_audio_embs = []        
+            audio_embedding_paths = [audio_embedding_path_1, audio_embedding_path_2]
+            for human_idx in range(HUMAN_NUMBER):   
+                audio_embedding_path = audio_embedding_paths[human_idx]
+                # embeddings may be passed in memory instead of as .pt files
+                if isinstance(audio_embedding_path, AudioEmbeddingStream):
+                    # encoded lazily as the clips reach it
+                    full_audio_emb = audio_embedding_path
+                elif isinstance(audio_embedding_path, torch.Tensor):
+                    full_audio_emb = audio_embedding_path
+                elif not os.path.exists(audio_embedding_path):
+                    continue
+                else:
+                    full_audio_emb = torch.load(audio_embedding_path)
+                if isinstance(full_audio_emb, torch.Tensor) and torch.isnan(full_audio_emb).any():
+                    continue
+                if embedding_length(full_audio_emb, frame_num + 1) <= frame_num:
+                    continue
+                full_audio_embs.append(full_audio_emb) 
+        
+            assert len(full_audio_embs) == HUMAN_NUMBER, f"Aduio file not exists or length not satisfies frame nums."
+            # a streamed embedding of unknown length reports progress against max_frames_num
+            first_emb = full_audio_embs[0]
+            known_frames = first_emb.num_frames if isinstance(first_emb, AudioEmbeddingStream) else first_emb.shape[0]
+            total_frames = int(min(max_frames_num, known_frames if known_frames is not None else max_frames_num))
+
+            # preprocess text embedding
+            if n_prompt == "":
+                n_prompt = self.sample_neg_prompt
+            with tracer.span('t5'), memory.stage('t5'):
+                if not self.t5_cpu:
+                    self.text_encoder.model.to(self.device)
+                    context, context_null = self.text_encoder([input_prompt, n_prompt], self.device)
+                    if offload_model:
+                        self.text_encoder.model.cpu()
                 else:
-                    latent_motion_frames = self.vae.encode(cond_frame)[0]
+                    context = self.text_encoder([input_prompt], torch.device('cpu'))
+                    context_null = self.text_encoder([n_prompt], torch.device('cpu'))
+                    context = [t.to(self.device) for t in context]
+                    context_null = [t.to(self.device) for t in context_null]
+
+            memory.release('stage')
+            # prepare params for video generation
+            indices = (torch.arange(2 * 2 + 1) - 2) * 1 
+            clip_length = frame_num
+            is_first_clip = True
+            arrive_last_frame = False
+            cur_motion_frames_num = 1
+            audio_start_idx = 0
+            audio_end_idx = audio_start_idx + clip_length
+            postprocessor = ClipPostprocessor(
+                video_writer=video_writer,
+                color_reference=original_color_reference,
+                color_correction_strength=color_correction_strength,
+                async_mode=extra_args.async_postprocess,
+                tracer=tracer,
+            )
+            memory.release('stage')
+
+            # set random seed and init noise
+            seed = seed if seed >= 0 else random.randint(0, 99999999)
+            torch.manual_seed(seed)
+            torch.cuda.manual_seed_all(seed)
+            np.random.seed(seed)
+            random.seed(seed)
+            torch.backends.cudnn.deterministic = True
+
+            # start video generation iteratively
+            while True:
+                audio_embs = []
+                # split audio with window size
+                for human_idx in range(HUMAN_NUMBER):   
+                    center_indices = torch.arange(
+                        audio_start_idx,
+                        audio_end_idx,
+                        1,
+                    ).unsqueeze(
+                        1
+                    ) + indices.unsqueeze(0)
+                    num_audio_frames = embedding_length(full_audio_embs[human_idx], int(center_indices.max()) + 1)
+                    center_indices = torch.clamp(center_indices, min=0, max=num_audio_frames-1)
+                    audio_emb = full_audio_embs[human_idx][center_indices][None,...].to(self.device)
+                    audio_embs.append(audio_emb)
+                audio_embs = torch.concat(audio_embs, dim=0).to(self.param_dtype)
+                memory.release('stage')
+
+                h, w = cond_image.shape[-2], cond_image.shape[-1]
+                lat_h, lat_w = h // self.vae_stride[1], w // self.vae_stride[2]
+                max_seq_len = ((frame_num - 1) // self.vae_stride[0] + 1) * lat_h * lat_w // (
+                    self.patch_size[1] * self.patch_size[2])
+                max_seq_len = int(math.ceil(max_seq_len / self.sp_size)) * self.sp_size
+
+
+
+                noise = torch.randn(
+                    16, (frame_num - 1) // 4 + 1,
+                    lat_h,
+                    lat_w,
+                    dtype=torch.float32,
+                    device=self.device) 
+
+                # get mask
+                msk = torch.ones(1, frame_num, lat_h, lat_w, device=self.device)
+                msk[:, 1:] = 0
+                msk = torch.concat([
+                    torch.repeat_interleave(msk[:, 0:1], repeats=4, dim=1), msk[:, 1:]
+                ],
+                                dim=1)
+                msk = msk.view(1, msk.shape[1] // 4, 4, lat_h, lat_w)
+                msk = msk.transpose(1, 2).to(self.param_dtype) # B 4 T H W
+
+                with torch.no_grad():
+                    # get clip embedding
+                    with tracer.span('clip_visual'), memory.stage('clip_visual'):
+                        self.clip.model.to(self.device)
+                        clip_context = self.clip.visual(cond_image[:, :, -1:, :, :]).to(self.param_dtype) 
+                        if offload_model:
+                            self.clip.model.cpu()
+                    memory.release('stage')
+
+                    # zero padding and vae encode
+                    with tracer.span('vae_encode'), memory.stage('vae_encode'):
+                        video_frames = torch.zeros(1, cond_image.shape[1], frame_num-cond_image.shape[2], target_h, target_w).to(self.device)
+                        padding_frames_pixels_values = torch.concat([cond_image, video_frames], dim=2)
+                        y = self.vae.encode(padding_frames_pixels_values) 
+                        cur_motion_frames_latent_num = int(1 + (cur_motion_frames_num-1) // 4)
+
+                        if is_first_clip:
+                            # the causal VAE encodes the first frame on its own, reuse its latent
+                            latent_motion_frames = y[0][:, :1]
+                        else:
+                            latent_motion_frames = self.vae.encode(cond_frame)[0]
+                    y = torch.stack(y).to(self.param_dtype) # B C T H W
 
-                y = torch.concat([msk, y], dim=1) # B 4+C T H W
-                torch_gc()
+                    y = torch.concat([msk, y], dim=1) # B 4+C T H W
+                    memory.release('stage')
             
 
-            # construct human mask
-            human_masks = []
-            if HUMAN_NUMBER==1:
-                background_mask = torch.ones([src_h, src_w])
-                human_mask1 = torch.ones([src_h, src_w])
-                human_mask2 = torch.ones([src_h, src_w])
-                human_masks = [human_mask1, human_mask2, background_mask]
-            elif HUMAN_NUMBER==2:
-                if 'bbox' in input_data:
-                    assert len(input_data['bbox']) == len(input_data['cond_audio']), f"The number of target bbox should be the same with cond_audio"
-                    background_mask = torch.zeros([src_h, src_w])
-                    for _, person_bbox in input_data['bbox'].items():
-                        x_min, y_min, x_max, y_max = person_bbox
-                        human_mask = torch.zeros([src_h, src_w])
-                        human_mask[int(x_min):int(x_max), int(y_min):int(y_max)] = 1
-                        background_mask += human_mask
-                        human_masks.append(human_mask)
-                else:
-                    x_min, x_max = int(src_h * face_scale), int(src_h * (1 - face_scale))
-                    background_mask = torch.zeros([src_h, src_w])
-                    background_mask = torch.zeros([src_h, src_w])
-                    human_mask1 = torch.zeros([src_h, src_w])
-                    human_mask2 = torch.zeros([src_h, src_w])
-                    lefty_min, lefty_max = int((src_w//2) * face_scale), int((src_w//2) * (1 - face_scale))
-                    righty_min, righty_max = int((src_w//2) * face_scale + (src_w//2)), int((src_w//2) * (1 - face_scale) + (src_w//2))
-                    human_mask1[x_min:x_max, lefty_min:lefty_max] = 1
-                    human_mask2[x_min:x_max, righty_min:righty_max] = 1
-                    background_mask += human_mask1
-                    background_mask += human_mask2
-                    human_masks = [human_mask1, human_mask2]
-                background_mask = torch.where(background_mask > 0, torch.tensor(0), torch.tensor(1))
-                human_masks.append(background_mask)
-
-            ref_target_masks = torch.stack(human_masks, dim=0).to(self.device)
-            # resize and centercrop for ref_target_masks 
-            ref_target_masks = resize_and_centercrop(ref_target_masks, (target_h, target_w))
-
-            _, _, _,lat_h, lat_w = y.shape
-            ref_target_masks = F.interpolate(ref_target_masks.unsqueeze(0), size=(lat_h, lat_w), mode='nearest').squeeze() 
-            ref_target_masks = (ref_target_masks > 0) 
-            ref_target_masks = ref_target_masks.float().to(self.device)
-
-            torch_gc()
-
-            @contextmanager
-            def noop_no_sync():
-                yield
-
-            no_sync = getattr(self.model, 'no_sync', noop_no_sync)
-
-            # evaluation mode
-            with torch.no_grad(), no_sync():
-                
-                # prepare timesteps
-                timesteps = list(np.linspace(self.num_timesteps, 1, sampling_steps, dtype=np.float32))
-                timesteps.append(0.)
-                timesteps = [torch.tensor([t], device=self.device) for t in timesteps]
-                if self.use_timestep_transform:
-                    timesteps = [timestep_transform(t, shift=shift, num_timesteps=self.num_timesteps) for t in timesteps]
+                # construct human mask
+                human_masks = []
+                if HUMAN_NUMBER==1:
+                    background_mask = torch.ones([src_h, src_w])
+                    human_mask1 = torch.ones([src_h, src_w])
+                    human_mask2 = torch.ones([src_h, src_w])
+                    human_masks = [human_mask1, human_mask2, background_mask]
+                elif HUMAN_NUMBER==2:
+                    if 'bbox' in input_data:
+                        assert len(input_data['bbox']) == len(input_data['cond_audio']), f"The number of target bbox should be the same with cond_audio"
+                        background_mask = torch.zeros([src_h, src_w])
+                        for _, person_bbox in input_data['bbox'].items():
+                            x_min, y_min, x_max, y_max = person_bbox
+                            human_mask = torch.zeros([src_h, src_w])
+                            human_mask[int(x_min):int(x_max), int(y_min):int(y_max)] = 1
+                            background_mask += human_mask
+                            human_masks.append(human_mask)
+                    else:
+                        x_min, x_max = int(src_h * face_scale), int(src_h * (1 - face_scale))
+                        background_mask = torch.zeros([src_h, src_w])
+                        background_mask = torch.zeros([src_h, src_w])
+                        human_mask1 = torch.zeros([src_h, src_w])
+                        human_mask2 = torch.zeros([src_h, src_w])
+                        lefty_min, lefty_max = int((src_w//2) * face_scale), int((src_w//2) * (1 - face_scale))
+                        righty_min, righty_max = int((src_w//2) * face_scale + (src_w//2)), int((src_w//2) * (1 - face_scale) + (src_w//2))
+                        human_mask1[x_min:x_max, lefty_min:lefty_max] = 1
+                        human_mask2[x_min:x_max, righty_min:righty_max] = 1
+                        background_mask += human_mask1
+                        background_mask += human_mask2
+                        human_masks = [human_mask1, human_mask2]
+                    background_mask = torch.where(background_mask > 0, torch.tensor(0), torch.tensor(1))
+                    human_masks.append(background_mask)
+
+                ref_target_masks = torch.stack(human_masks, dim=0).to(self.device)
+                # resize and centercrop for ref_target_masks 
+                ref_target_masks = resize_and_centercrop(ref_target_masks, (target_h, target_w))
+
+                _, _, _,lat_h, lat_w = y.shape
+                ref_target_masks = F.interpolate(ref_target_masks.unsqueeze(0), size=(lat_h, lat_w), mode='nearest').squeeze() 
+                ref_target_masks = (ref_target_masks > 0) 
+                ref_target_masks = ref_target_masks.float().to(self.device)
+
+                memory.release('stage')
+
+                @contextmanager
+                def noop_no_sync():
+                    yield
+
+                no_sync = getattr(self.model, 'no_sync', noop_no_sync)
+
+                # evaluation mode
+                with torch.no_grad(), no_sync():
                 
-                # sample videos
-                latent = noise
-
-                # prepare condition and uncondition configs
-                arg_c = {
-                    'context': [context],
-                    'clip_fea': clip_context,
-                    'seq_len': max_seq_len,
-                    'y': y,
-                    'audio': audio_embs,
-                    'ref_target_masks': ref_target_masks
-                }
-
-
-                arg_null_text = {
-                    'context': [context_null],
-                    'clip_fea': clip_context,
-                    'seq_len': max_seq_len,
-                    'y': y,
-                    'audio': audio_embs,
-                    'ref_target_masks': ref_target_masks
-                }
-
-                arg_null_audio = {
-                    'context': [context],
-                    'clip_fea': clip_context,
-                    'seq_len': max_seq_len,
-                    'y': y,
-                    'audio': torch.zeros_like(audio_embs)[-1:],
-                    'ref_target_masks': ref_target_masks
-                }
-
-
-                arg_null = {
-                    'context': [context_null],
-                    'clip_fea': clip_context,
-                    'seq_len': max_seq_len,
-                    'y': y,
-                    'audio': torch.zeros_like(audio_embs)[-1:],
-                    'ref_target_masks': ref_target_masks
-                }
-
-                torch_gc()
-                if not self.vram_management:
-                    self.model.to(self.device)
-                else:
-                    self.load_models_to_device(["model"])
+                    # prepare timesteps
+                    sample_solver = getattr(extra_args, 'sample_solver', 'euler')
+                    if sample_solver == 'euler':
+                        sample_scheduler = None
+                        timesteps = list(np.linspace(self.num_timesteps, 1, sampling_steps, dtype=np.float32))
+                        timesteps.append(0.)
+                        timesteps = [torch.tensor([t], device=self.device) for t in timesteps]
+                        if self.use_timestep_transform:
+                            timesteps = [timestep_transform(t, shift=shift, num_timesteps=self.num_timesteps) for t in timesteps]
+                    else:
+                        sample_scheduler, timesteps = self._build_scheduler(
+                            sample_solver, sampling_steps, shift if self.use_timestep_transform else 1.0)
                 
-                # injecting motion frames
-                if not is_first_clip:
-                    latent_motion_frames = latent_motion_frames.to(latent.dtype).to(self.device)
-                    motion_add_noise = torch.randn_like(latent_motion_frames).contiguous()
-                    add_latent = self.add_noise(latent_motion_frames, motion_add_noise, timesteps[0])
-                    _, T_m, _, _ = add_latent.shape
-                    latent[:, :T_m] = add_latent
-
-                # infer with APG
-                # refer https://arxiv.org/abs/2410.02416   
-                if extra_args.use_apg:  
-                    text_momentumbuffer  = MomentumBuffer(extra_args.apg_momentum) 
-                    audio_momentumbuffer = MomentumBuffer(extra_args.apg_momentum) 
-
-
-                progress_wrap = partial(tqdm, total=len(timesteps)-1) if progress else (lambda x: x)
-                for i in progress_wrap(range(len(timesteps)-1)):
-                    timestep = timesteps[i]
-                    latent[:, :cur_motion_frames_latent_num] = latent_motion_frames
-                    latent_model_input = [latent.to(self.device)]
-
-                    # inference with CFG strategy
-                    noise_pred_cond = self.model(
-                    latent_model_input, t=timestep, **arg_c)[0] 
-                    torch_gc()
+                    # sample videos
+                    latent = noise
+
+                    # prepare condition and uncondition configs
+                    arg_c = {
+                        'context': [context],
+                        'clip_fea': clip_context,
+                        'seq_len': max_seq_len,
+                        'y': y,
+                        'audio': audio_embs,
+                        'ref_target_masks': ref_target_masks
+                    }
+
+
+                    arg_null_text = {
+                        'context': [context_null],
+                        'clip_fea': clip_context,
+                        'seq_len': max_seq_len,
+                        'y': y,
+                        'audio': audio_embs,
+                        'ref_target_masks': ref_target_masks
+                    }
+
+                    arg_null_audio = {
+                        'context': [context],
+                        'clip_fea': clip_context,
+                        'seq_len': max_seq_len,
+                        'y': y,
+                        'audio': torch.zeros_like(audio_embs)[-1:],
+                        'ref_target_masks': ref_target_masks
+                    }
+
+
+                    arg_null = {
+                        'context': [context_null],
+                        'clip_fea': clip_context,
+                        'seq_len': max_seq_len,
+                        'y': y,
+                        'audio': torch.zeros_like(audio_embs)[-1:],
+                        'ref_target_masks': ref_target_masks
+                    }
+
+                    memory.release('stage')
+                    if not self.vram_management:
+                        self.model.to(self.device)
+                    else:
+                        self.load_models_to_device(["model"])
 
                     if math.isclose(text_guide_scale, 1.0):
-                        noise_pred_drop_audio = self.model(
-                            latent_model_input, t=timestep, **arg_null_audio)[0]  
-                        torch_gc()
-                    else:
-                        noise_pred_drop_text = self.model(
-                            latent_model_input, t=timestep, **arg_null_text)[0] 
-                        torch_gc()
-                        noise_pred_uncond = self.model(
-                            latent_model_input, t=timestep, **arg_null)[0]  
-                        torch_gc()
-
-                    if extra_args.use_apg:
-                        # correct update direction
-                        if math.isclose(text_guide_scale, 1.0):
-                            diff_uncond_audio  = noise_pred_cond - noise_pred_drop_audio
-                            noise_pred = noise_pred_cond + (audio_guide_scale - 1)* adaptive_projected_guidance(diff_uncond_audio, 
-                                                                                            noise_pred_cond, 
-                                                                                            momentum_buffer=audio_momentumbuffer, 
-                                                                                            norm_threshold=extra_args.apg_norm_threshold)
-                        else:
-                            diff_uncond_text  = noise_pred_cond - noise_pred_drop_text
-                            diff_uncond_audio = noise_pred_drop_text - noise_pred_uncond
-                            noise_pred = noise_pred_cond + (text_guide_scale - 1) * adaptive_projected_guidance(diff_uncond_text, 
-                                                                                                                noise_pred_cond, 
-                                                                                                                momentum_buffer=text_momentumbuffer, 
-                                                                                                                norm_threshold=extra_args.apg_norm_threshold) \
-                                + (audio_guide_scale - 1) * adaptive_projected_guidance(diff_uncond_audio, 
-                                                                                            noise_pred_cond, 
-                                                                                            momentum_buffer=audio_momentumbuffer, 
-                                                                                            norm_threshold=extra_args.apg_norm_threshold)
+                        cfg_branches = [arg_c, arg_null_audio]
                     else:
-                        # vanilla CFG strategy
-                        if math.isclose(text_guide_scale, 1.0):
-                            noise_pred = noise_pred_drop_audio + audio_guide_scale* (noise_pred_cond - noise_pred_drop_audio)  
-                        else:
-                            noise_pred = noise_pred_uncond + text_guide_scale * (
-                                noise_pred_cond - noise_pred_drop_text) + \
-                                audio_guide_scale * (noise_pred_drop_text - noise_pred_uncond)  
-                    noise_pred = -noise_pred  
-
-                    # update latent
-                    dt = timesteps[i] - timesteps[i + 1]
-                    dt = dt / self.num_timesteps
-                    latent = latent + noise_pred * dt[:, None, None, None]
-
+                        cfg_branches = [arg_c, arg_null_text, arg_null]
+                    if batched_cfg:
+                        arg_batched = merge_cfg_args(*cfg_branches)
+                        cfg_branches = [arg_batched]
+
+                    # embed the step-invariant conditions once per clip instead of every step
+                    if not self.use_usp:
+                        for arg in cfg_branches:
+                            arg['cond_cache'] = self.model.prepare_conditioning(
+                                **arg, cache_kv=extra_args.cache_cond_kv)
+                        memory.release('stage')
+
+                    if step_cache is not None:
+                        step_cache.reset(timesteps)
+                        for k, arg in enumerate(cfg_branches):
+                            arg['step_cache'] = step_cache.branch(k)
+                
                     # injecting motion frames
                     if not is_first_clip:
                         latent_motion_frames = latent_motion_frames.to(latent.dtype).to(self.device)
                         motion_add_noise = torch.randn_like(latent_motion_frames).contiguous()
-                        add_latent = self.add_noise(latent_motion_frames, motion_add_noise, timesteps[i+1])
+                        add_latent = self.add_noise(latent_motion_frames, motion_add_noise, timesteps[0])
                         _, T_m, _, _ = add_latent.shape
                         latent[:, :T_m] = add_latent
 
-                    latent[:, :cur_motion_frames_latent_num] = latent_motion_frames
-                    x0 = [latent.to(self.device)] 
-                    del latent_model_input, timestep
+                    # infer with APG
+                    # refer https://arxiv.org/abs/2410.02416   
+                    if extra_args.use_apg:  
+                        text_momentumbuffer  = MomentumBuffer(extra_args.apg_momentum) 
+                        audio_momentumbuffer = MomentumBuffer(extra_args.apg_momentum) 
+
+
+                    def dit_span(branch):
+                        # the schedule is known once the first forward of the clip has run
+                        hit = step_cache is not None and step_cache.schedule is not None and not step_cache.schedule[i]
+                        name = f"dit_forward/{branch}" + (" (teacache hit)" if hit else "")
+                        return tracer.span(name, cat='dit', step=i)
+
+                    progress_wrap = partial(tqdm, total=len(timesteps)-1) if progress else (lambda x: x)
+                    for i in progress_wrap(range(len(timesteps)-1)):
+                        timestep = timesteps[i]
+                        latent[:, :cur_motion_frames_latent_num] = latent_motion_frames
+                        latent_model_input = [latent.to(self.device)]
+
+                        # inference with CFG strategy
+                        with memory.stage('dit_step'):
+                            if batched_cfg:
+                                with dit_span('batched'):
+                                    noise_preds = self.model(
+                                        latent_model_input, t=timestep, **arg_batched)
+                                if math.isclose(text_guide_scale, 1.0):
+                                    noise_pred_cond, noise_pred_drop_audio = noise_preds
+                                else:
+                                    noise_pred_cond, noise_pred_drop_text, noise_pred_uncond = noise_preds
+                                memory.release('step')
+                            else:
+                                with dit_span('cond'):
+                                    noise_pred_cond = self.model(
+                                    latent_model_input, t=timestep, **arg_c)[0] 
+                                memory.release('step')
+
+                                if math.isclose(text_guide_scale, 1.0):
+                                    with dit_span('drop_audio'):
+                                        noise_pred_drop_audio = self.model(
+                                            latent_model_input, t=timestep, **arg_null_audio)[0]  
+                                    memory.release('step')
+                                else:
+                                    with dit_span('drop_text'):
+                                        noise_pred_drop_text = self.model(
+                                            latent_model_input, t=timestep, **arg_null_text)[0] 
+                                    memory.release('step')
+                                    with dit_span('uncond'):
+                                        noise_pred_uncond = self.model(
+                                            latent_model_input, t=timestep, **arg_null)[0]  
+                                    memory.release('step')
+
+                        if extra_args.use_apg:
+                            # correct update direction
+                            if math.isclose(text_guide_scale, 1.0):
+                                diff_uncond_audio  = noise_pred_cond - noise_pred_drop_audio
+                                noise_pred = noise_pred_cond + (audio_guide_scale - 1)* adaptive_projected_guidance(diff_uncond_audio, 
+                                                                                                noise_pred_cond, 
+                                                                                                momentum_buffer=audio_momentumbuffer, 
+                                                                                                norm_threshold=extra_args.apg_norm_threshold)
+                            else:
+                                diff_uncond_text  = noise_pred_cond - noise_pred_drop_text
+                                diff_uncond_audio = noise_pred_drop_text - noise_pred_uncond
+                                noise_pred = noise_pred_cond + (text_guide_scale - 1) * adaptive_projected_guidance(diff_uncond_text, 
+                                                                                                                    noise_pred_cond, 
+                                                                                                                    momentum_buffer=text_momentumbuffer, 
+                                                                                                                    norm_threshold=extra_args.apg_norm_threshold) \
+                                    + (audio_guide_scale - 1) * adaptive_projected_guidance(diff_uncond_audio, 
+                                                                                                noise_pred_cond, 
+                                                                                                momentum_buffer=audio_momentumbuffer, 
+                                                                                                norm_threshold=extra_args.apg_norm_threshold)
+                        else:
+                            # vanilla CFG strategy
+                            if math.isclose(text_guide_scale, 1.0):
+                                noise_pred = noise_pred_drop_audio + audio_guide_scale* (noise_pred_cond - noise_pred_drop_audio)  
+                            else:
+                                noise_pred = noise_pred_uncond + text_guide_scale * (
+                                    noise_pred_cond - noise_pred_drop_text) + \
+                                    audio_guide_scale * (noise_pred_drop_text - noise_pred_uncond)  
+                        # update latent
+                        if sample_scheduler is None:
+                            noise_pred = -noise_pred  
+                            dt = timesteps[i] - timesteps[i + 1]
+                            dt = dt / self.num_timesteps
+                            latent = latent + noise_pred * dt[:, None, None, None]
+                        else:
+                            # the solvers act elementwise, so the motion frames overwritten below
+                            # do not leak into the other frames through the solver history
+                            latent = sample_scheduler.step(
+                                noise_pred.unsqueeze(0),
+                                timesteps[i],
+                                latent.unsqueeze(0),
+                                return_dict=False)[0].squeeze(0).to(latent.dtype)
+
+                        # injecting motion frames
+                        if not is_first_clip:
+                            latent_motion_frames = latent_motion_frames.to(latent.dtype).to(self.device)
+                            motion_add_noise = torch.randn_like(latent_motion_frames).contiguous()
+                            add_latent = self.add_noise(latent_motion_frames, motion_add_noise, timesteps[i+1])
+                            _, T_m, _, _ = add_latent.shape
+                            latent[:, :T_m] = add_latent
+
+                        latent[:, :cur_motion_frames_latent_num] = latent_motion_frames
+                        x0 = [latent.to(self.device)] 
+                        del latent_model_input, timestep
+
+                    for arg in cfg_branches:
+                        arg.pop('cond_cache', None)
+                        arg.pop('step_cache', None)
                 
-                if offload_model: 
-                    if not self.vram_management:
-                        self.model.cpu()
-                torch_gc()
-
-                videos = self.vae.decode(x0)
-            
-            # cache generated samples
-            videos = torch.stack(videos).cpu() # B C T H W
-            # >>> START OF COLOR CORRECTION STEP <<<
-            if color_correction_strength > 0.0 and original_color_reference is not None:
-                videos = match_and_blend_colors(videos, original_color_reference, color_correction_strength)
-            # >>> END OF COLOR CORRECTION STEP <<<
-
-            if is_first_clip:
-                gen_video_list.append(videos)
-            else:
-                gen_video_list.append(videos[:, :, cur_motion_frames_num:])
-
-            # decide whether is done
-            if arrive_last_frame: break
-
-            # update next condition frames
-            is_first_clip = False
-            cur_motion_frames_num = motion_frame
-
-            cond_frame = videos[:, :, -cur_motion_frames_num:].to(torch.float32).to(self.device)
-            audio_start_idx += (frame_num - cur_motion_frames_num)
-            audio_end_idx = audio_start_idx + clip_length
-
-            cond_image = extract_specific_frames(cond_file_path, audio_start_idx)
-            # cond_image = Image.fromarray(cond_image)
-            cond_image = resize_and_centercrop(cond_image, (target_h, target_w))
-            cond_image = cond_image / 255
-            cond_image = (cond_image - 0.5) * 2 # normalization
-            cond_image = cond_image.to(self.device)  # 1 C 1 H W
-
-            # Repeat audio emb
-            if audio_end_idx >= min(max_frames_num, len(full_audio_embs[0])):
-                arrive_last_frame = True
-                miss_lengths = []
-                source_frames = []
-                for human_inx in range(HUMAN_NUMBER):
-                    source_frame = len(full_audio_embs[human_inx])
-                    source_frames.append(source_frame)
-                    if audio_end_idx >= len(full_audio_embs[human_inx]):
-                        miss_length   = audio_end_idx - len(full_audio_embs[human_inx]) + 3 
-                        add_audio_emb = torch.flip(full_audio_embs[human_inx][-1*miss_length:], dims=[0])
-                        full_audio_embs[human_inx] = torch.cat([full_audio_embs[human_inx], add_audio_emb], dim=0)
-                        miss_lengths.append(miss_length)
-                    else:
-                        miss_lengths.append(0)
+                    if offload_model: 
+                        if not self.vram_management:
+                            self.model.cpu()
+                    memory.release('stage')
+
+                    with tracer.span('vae_decode'), memory.stage('vae_decode'):
+                        videos = self.vae.decode(x0)
+                videos = torch.stack(videos) # B C T H W
+
+                # the next clip only needs the motion frames, colour-correct just those here
+                # (the correction is per frame) and leave the full clip to the post-processor
+                if not arrive_last_frame:
+                    cond_frame = postprocessor.correct_colors(videos[:, :, -motion_frame:].to(torch.float32))
+                    cond_frame = cond_frame.to(self.device)
+
+                # cache generated samples
+                if video_writer is None or self.rank == 0:
+                    frame_limit = int(max_frames_num)
+                    if arrive_last_frame and max_frames_num > frame_num and sum(miss_lengths) > 0:
+                        frame_limit = min(frame_limit, source_frames[-1])
+                    postprocessor.submit(
+                        videos,
+                        start=0 if is_first_clip else cur_motion_frames_num,
+                        frame_limit=frame_limit)
+                del videos
+                if progress_callback is not None:
+                    progress_callback(min(audio_end_idx, total_frames), total_frames)
+
+                # decide whether is done
+                if arrive_last_frame: break
+
+                # update next condition frames
+                is_first_clip = False
+                cur_motion_frames_num = motion_frame
+
+                audio_start_idx += (frame_num - cur_motion_frames_num)
+                audio_end_idx = audio_start_idx + clip_length
+
+                with tracer.span('frame_read'):
+                    cond_image = frame_reader.get(audio_start_idx)
+                cond_image = cond_image.to(self.device)  # 1 C 1 H W
+                frame_reader.prefetch(audio_start_idx + clip_stride)
+
+                # Repeat audio emb
+                if audio_end_idx >= min(max_frames_num, embedding_length(full_audio_embs[0], audio_end_idx + 1)):
+                    arrive_last_frame = True
+                    miss_lengths = []
+                    source_frames = []
+                    for human_inx in range(HUMAN_NUMBER):
+                        source_frame = embedding_length(full_audio_embs[human_inx], audio_end_idx + 1)
+                        source_frames.append(source_frame)
+                        if audio_end_idx >= source_frame:
+                            miss_length   = audio_end_idx - source_frame + 3 
+                            add_audio_emb = torch.flip(full_audio_embs[human_inx][-1*miss_length:], dims=[0])
+                            full_audio_embs[human_inx] = torch.cat([full_audio_embs[human_inx][:], add_audio_emb], dim=0)
+                            miss_lengths.append(miss_length)
+                        else:
+                            miss_lengths.append(0)
 
             
-            if max_frames_num <= frame_num: break
+                if max_frames_num <= frame_num: break
             
-            torch_gc()
-            if offload_model:    
-                torch.cuda.synchronize()
+                memory.release('clip')
+                if offload_model:    
+                    torch.cuda.synchronize()
+                if dist.is_initialized():
+                    dist.barrier()
+        
+            gen_video_list = postprocessor.close()
+        finally:
+            frame_reader.close()
+            if postprocessor is not None:
+                postprocessor.abort()
+
+        if video_writer is not None:
             if dist.is_initialized():
                 dist.barrier()
-        
+            del noise, latent
+            memory.release('request')
+            memory.log_stats()
+            self.memory_stats = memory.stats
+            return None
+
         gen_video_samples = torch.cat(gen_video_list, dim=2)[:, :, :int(max_frames_num)] 
         gen_video_samples = gen_video_samples.to(torch.float32)
         if max_frames_num > frame_num and sum(miss_lengths) > 0:
             # split video frames
             # gen_video_samples = gen_video_samples[:, :, :-1*miss_lengths[0]]
-            gen_video_samples = gen_video_samples[:, :, :full_audio_emb.shape[0]]
+            gen_video_samples = gen_video_samples[:, :, :source_frames[-1]]
         
         if dist.is_initialized():
             dist.barrier()
 
         del noise, latent
-        torch_gc()
+        memory.release('request')
+        memory.log_stats()
+        self.memory_stats = memory.stats
 
         return gen_video_samples[0] if self.rank == 0 else None
     
@@ -0,0 +1,107 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+When the InfiniteTalk pipeline hands cached CUDA memory back to the driver.
+
+`torch.cuda.empty_cache()` drops the caching allocator's pool, so the next step pays
+for fresh cudaMallocs again. The pipeline therefore only asks `MemoryPolicy.release`
+at points of a given level, and the policy decides whether that is worth it:
+
+    always    release at every point, down to every DiT forward
+    clip      release between clips and at the end of a request
+    pressure  release wherever reserved memory exceeds `pressure` of the card
+    never     never release, the allocator keeps its pool for the whole process
+
+`MemoryPolicy.stage` records the peak allocated and reserved memory of each stage, so
+a deployment can see from one run which policy still fits its card (`suggest`).
+"""
+import logging
+from contextlib import contextmanager
+
+import torch
+
+GiB = 1024 ** 3
+
+MEMORY_POLICIES = ('always', 'clip', 'pressure', 'never')
+
+# release points, from the most to the least frequent
+RELEASE_LEVELS = ('step', 'stage', 'clip', 'request')
+
+
+class MemoryPolicy:
+    """
+    Args:
+        policy (str): One of `MEMORY_POLICIES`.
+        device (torch.device): The device the pipeline runs on.
+        pressure (float): Share of the card's memory that `pressure` keeps reserved at most.
+    """
+
+    def __init__(self, policy='pressure', device=None, pressure=0.9):
+        assert policy in MEMORY_POLICIES, f"Unknown memory policy {policy}, choose from {MEMORY_POLICIES}."
+        self.policy = policy
+        self.pressure = pressure
+        self.enabled = torch.cuda.is_available()
+        self.device = device
+        self.total = torch.cuda.get_device_properties(device).total_memory if self.enabled else 0
+        self.stats = {}
+        self.num_releases = 0
+
+    def _should_release(self, level):
+        if self.policy == 'always':
+            return True
+        if self.policy == 'clip':
+            return RELEASE_LEVELS.index(level) >= RELEASE_LEVELS.index('clip')
+        if self.policy == 'pressure':
+            # host-side allocator counter, no device sync
+            return torch.cuda.memory_reserved(self.device) > self.pressure * self.total
+        return False
+
+    def release(self, level='stage'):
+        """A point where cached memory may be released, `level` is one of `RELEASE_LEVELS`."""
+        assert level in RELEASE_LEVELS
+        if self.enabled and self._should_release(level):
+            torch.cuda.empty_cache()
+            torch.cuda.ipc_collect()
+            self.num_releases += 1
+
+    @contextmanager
+    def stage(self, name):
+        """Record the peak allocated and reserved memory of the enclosed stage as `name`."""
+        if not self.enabled:
+            yield
+            return
+        torch.cuda.reset_peak_memory_stats(self.device)
+        yield
+        stats = self.stats.setdefault(name, dict(count=0, peak_allocated=0, peak_reserved=0))
+        stats['count'] += 1
+        stats['peak_allocated'] = max(stats['peak_allocated'], torch.cuda.max_memory_allocated(self.device))
+        stats['peak_reserved'] = max(stats['peak_reserved'], torch.cuda.max_memory_reserved(self.device))
+
+    def suggest(self):
+        """
+        The fastest policy the recorded stages fit under: `never` if no stage reserved
+        more than `pressure` of the card, `pressure` if the live tensors did not, else
+        `always`.
+        """
+        if not self.stats:
+            return self.policy
+        limit = self.pressure * self.total
+        if max(s['peak_reserved'] for s in self.stats.values()) <= limit:
+            return 'never'
+        if max(s['peak_allocated'] for s in self.stats.values()) <= limit:
+            return 'pressure'
+        return 'always'
+
+    def format_stats(self):
+        lines = [f"Memory per stage (policy {self.policy}, {self.num_releases} releases, "
+                 f"card {self.total / GiB:.1f} GiB):"]
+        for name, s in self.stats.items():
+            lines.append(f"  {name:<12} x{s['count']:<4} peak allocated {s['peak_allocated'] / GiB:6.2f} GiB, "
+                         f"peak reserved {s['peak_reserved'] / GiB:6.2f} GiB")
+        lines.append(f"  fastest policy that fits: {self.suggest()}")
+        return "\n".join(lines)
+
+    def log_stats(self):
+        if not self.enabled:
+            return
+        for line in self.format_stats().split("\n"):
+            logging.info(line)
@@ -20,7 +20,10 @@ import soundfile as sf
 import torchvision
 import binascii
 import os.path as osp
-from skimage import color
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .tracer import NULL_TRACER
 
 VID_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv")
 ASPECT_RATIO_627 = {
@@ -40,12 +43,6 @@ ASPECT_RATIO_960 = {
 
 
 
-def torch_gc():
-    torch.cuda.empty_cache()
-    torch.cuda.ipc_collect()
-
-
-
 def split_token_counts_and_frame_ids(T, token_frame, world_size, rank):
 
     S = T * token_frame
@@ -97,7 +94,6 @@ def calculate_x_ref_attn_map(visual_q, ref_k, ref_target_masks, mode='mean', att
     x_ref_attn_map_source = x_ref_attn_map_source.to(visual_q.dtype)
 
     for class_idx, ref_target_mask in enumerate(ref_target_masks):
-        torch_gc()
         ref_target_mask = ref_target_mask[None, None, None, ...]
         x_ref_attnmap = x_ref_attn_map_source * ref_target_mask
         x_ref_attnmap = x_ref_attnmap.sum(-1) / ref_target_mask.sum() # B, H, x_seqlens, ref_seqlens --> B, H, x_seqlens
@@ -112,7 +108,6 @@ def calculate_x_ref_attn_map(visual_q, ref_k, ref_target_masks, mode='mean', att
     
     del attn
     del x_ref_attn_map_source
-    torch_gc()
 
     return torch.concat(x_ref_attn_maps, dim=0)
 
@@ -234,7 +229,8 @@ def cache_video(tensor,
         writer.close()
         return cache_file
 
-def save_video_ffmpeg(gen_video_samples, save_path, vocal_audio_list, fps=25, quality=5, high_quality_save=False):
+def save_video_ffmpeg(gen_video_samples, save_path, vocal_audio_list, fps=25, quality=5, high_quality_save=False,
+                      tracer=NULL_TRACER):
     
     def save_video(frames, save_path, fps, quality=9, ffmpeg_params=None):
         writer = imageio.get_writer(
@@ -246,73 +242,265 @@ def save_video_ffmpeg(gen_video_samples, save_path, vocal_audio_list, fps=25, qu
         writer.close()
     save_path_tmp = save_path + "-temp.mp4"
 
-    if high_quality_save:
-        cache_video(
-                    tensor=gen_video_samples.unsqueeze(0),
-                    save_file=save_path_tmp,
-                    fps=fps,
-                    nrow=1,
-                    normalize=True,
-                    value_range=(-1, 1)
-                    )
-    else:
-        video_audio = (gen_video_samples+1)/2 # C T H W
-        video_audio = video_audio.permute(1, 2, 3, 0).cpu().numpy()
-        video_audio = np.clip(video_audio * 255, 0, 255).astype(np.uint8)  # to [0, 255]
-        save_video(video_audio, save_path_tmp, fps=fps, quality=quality)
+    with tracer.span('ffmpeg_encode', frames=gen_video_samples.shape[1]):
+        if high_quality_save:
+            cache_video(
+                        tensor=gen_video_samples.unsqueeze(0),
+                        save_file=save_path_tmp,
+                        fps=fps,
+                        nrow=1,
+                        normalize=True,
+                        value_range=(-1, 1)
+                        )
+        else:
+            video_audio = (gen_video_samples+1)/2 # C T H W
+            video_audio = video_audio.permute(1, 2, 3, 0).cpu().numpy()
+            video_audio = np.clip(video_audio * 255, 0, 255).astype(np.uint8)  # to [0, 255]
+            save_video(video_audio, save_path_tmp, fps=fps, quality=quality)
 
 
     # crop audio according to video length
     _, T, _, _ = gen_video_samples.shape
     duration = T / fps
-    save_path_crop_audio = save_path + "-cropaudio.wav"
-    final_command = [
-        "ffmpeg",
-        "-i",
-        vocal_audio_list[0],
-        "-t",
-        f'{duration}',
-        save_path_crop_audio,
-    ]
-    subprocess.run(final_command, check=True)
-
-    save_path = save_path + ".mp4"
-    if high_quality_save:
+    mux_video_audio(save_path_tmp, vocal_audio_list[0], save_path, duration, high_quality_save=high_quality_save,
+                    tracer=tracer)
+
+
+def mux_video_audio(video_path, audio_path, save_path, duration, high_quality_save=False, copy_video=False,
+                    tracer=NULL_TRACER):
+    """
+    Crop `audio_path` to `duration` seconds and mux it with `video_path` into `save_path`.mp4.
+    Removes the intermediate video and audio files.
+    """
+    with tracer.span('ffmpeg_mux'):
+        save_path_crop_audio = save_path + "-cropaudio.wav"
         final_command = [
             "ffmpeg",
-            "-y",
-            "-i", save_path_tmp,
-            "-i", save_path_crop_audio,
-            "-c:v", "libx264",
-            "-crf", "0",
-            "-preset", "veryslow",
-            "-c:a", "aac", 
-            "-shortest",
-            save_path,
+            "-i",
+            audio_path,
+            "-t",
+            f'{duration}',
+            save_path_crop_audio,
         ]
         subprocess.run(final_command, check=True)
-        os.remove(save_path_tmp)
-        os.remove(save_path_crop_audio)
-    else:
+
+        save_path = save_path + ".mp4"
+        if copy_video:
+            video_codec = ["-c:v", "copy"]
+        elif high_quality_save:
+            video_codec = ["-c:v", "libx264", "-crf", "0", "-preset", "veryslow"]
+        else:
+            video_codec = ["-c:v", "libx264"]
         final_command = [
             "ffmpeg",
             "-y",
-            "-i",
-            save_path_tmp,
-            "-i",
-            save_path_crop_audio,
-            "-c:v",
-            "libx264",
-            "-c:a",
-            "aac",
+            "-i", video_path,
+            "-i", save_path_crop_audio,
+            *video_codec,
+            "-c:a", "aac",
             "-shortest",
             save_path,
         ]
         subprocess.run(final_command, check=True)
-        os.remove(save_path_tmp)
+        os.remove(video_path)
         os.remove(save_path_crop_audio)
 
 
+class StreamingVideoWriter:
+    """
+    Pipes generated clips straight into a long-lived ffmpeg encoder.
+
+    Frames are converted to uint8 and written clip by clip, so host memory is
+    bounded by one clip instead of the whole video. The intermediate video is a
+    fragmented mp4 that can be watched while generation is still running;
+    `mux` adds the audio track once all clips are written.
+
+    Args:
+        save_path (str): Output path without extension, as for `save_video_ffmpeg`.
+        fps (int): Frame rate of the generated video.
+        quality (int): imageio-style quality (0-10) used for the libx264 CRF.
+        high_quality_save (bool): Encode with CRF 10 like `cache_video`.
+        tracer (StageTracer): Records the time spent feeding the encoder and muxing.
+    """
+
+    def __init__(self, save_path, fps=25, quality=5, high_quality_save=False, tracer=NULL_TRACER):
+        self.save_path = save_path
+        self.tracer = tracer
+        self.video_path = save_path + "-temp.mp4"
+        self.fps = fps
+        self.crf = 10 if high_quality_save else int((1 - quality / 10.0) * 51)
+        self.num_frames = 0
+        self.process = None
+
+    def _open(self, height, width):
+        command = [
+            "ffmpeg",
+            "-y",
+            "-loglevel", "error",
+            "-f", "rawvideo",
+            "-pix_fmt", "rgb24",
+            "-s", f"{width}x{height}",
+            "-r", f"{self.fps}",
+            "-i", "-",
+            "-c:v", "libx264",
+            "-crf", f"{self.crf}",
+            "-pix_fmt", "yuv420p",
+            "-movflags", "frag_keyframe+empty_moov",
+            self.video_path,
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frames):
+        """
+        Args:
+            frames (torch.Tensor): Clip of shape (C, T, H, W) in range [-1, 1].
+        """
+        if frames.shape[1] == 0:
+            return
+        _, T, H, W = frames.shape
+        if self.process is None:
+            self._open(H, W)
+        with self.tracer.span('ffmpeg_encode', frames=T):
+            frames = ((frames.float() + 1) / 2 * 255).clamp(0, 255).to(torch.uint8)  # to [0, 255]
+            frames = frames.permute(1, 2, 3, 0).contiguous().cpu().numpy()
+            self.process.stdin.write(frames.tobytes())
+        self.num_frames += T
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        returncode = self.process.wait()
+        self.process = None
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with code {returncode} while writing {self.video_path}")
+
+    def mux(self, audio_path):
+        """
+        Finish the encoder and mux the audio, cropped to the written length.
+        Returns the path of the final mp4.
+        """
+        self.close()
+        duration = self.num_frames / self.fps
+        mux_video_audio(self.video_path, audio_path, self.save_path, duration, copy_video=True, tracer=self.tracer)
+        return self.save_path + ".mp4"
+
+
+class ClipPostprocessor:
+    """
+    Post-processing of decoded clips: device-to-host copy, colour correction and either
+    writing to a `StreamingVideoWriter` or collecting the clips for the caller.
+
+    With `async_mode` the copy is issued on a side CUDA stream and the rest runs on a
+    worker thread, so it overlaps with sampling the next clip instead of stalling it.
+
+    Args:
+        video_writer (StreamingVideoWriter, optional): Writer receiving the clips; if None
+            the clips are returned by `close`.
+        color_reference (torch.Tensor, optional): Reference frame (1, C, 1, H, W) for
+            `match_and_blend_colors`, its Lab statistics are computed once here.
+        color_correction_strength (float): Strength passed to `match_and_blend_colors`.
+        async_mode (bool): Run the post-processing in the background.
+        max_pending (int): Clips allowed in flight before `submit` waits, bounding host memory.
+        tracer (StageTracer): Records the colour correction.
+    """
+
+    def __init__(self, video_writer=None, color_reference=None, color_correction_strength=0.0,
+                 async_mode=False, max_pending=2, tracer=NULL_TRACER):
+        self.video_writer = video_writer
+        self.tracer = tracer
+        self.writer_start_frames = video_writer.num_frames if video_writer is not None else 0
+        self.color_correction_strength = color_correction_strength
+        self.color_stats = None
+        if color_correction_strength > 0.0 and color_reference is not None:
+            self.color_stats = lab_color_stats(color_reference)
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=1) if async_mode else None
+        self.copy_stream = torch.cuda.Stream() if async_mode and torch.cuda.is_available() else None
+        self.pending = deque()
+        self.clips = []
+
+    def submit(self, videos, start=0, frame_limit=None):
+        """
+        Args:
+            videos (torch.Tensor): Decoded clip (B, C, T, H, W) in range [-1, 1].
+            start (int): Frames before this index overlap the previous clip and are dropped.
+            frame_limit (int, optional): Total number of frames the writer may receive.
+        """
+        if self.executor is None:
+            videos = self.correct_colors(videos).cpu()
+            self._collect(self._process(videos, None, False, start, frame_limit))
+            return
+
+        done = None
+        if self.copy_stream is not None and videos.is_cuda:
+            # colour correction and copy are queued on the side stream, next to the sampling
+            self.copy_stream.wait_stream(torch.cuda.current_stream(videos.device))
+            with torch.cuda.stream(self.copy_stream):
+                corrected = self.correct_colors(videos)
+                videos_cpu = torch.empty(corrected.shape, dtype=corrected.dtype, pin_memory=True)
+                videos_cpu.copy_(corrected, non_blocking=True)
+                done = torch.cuda.Event()
+                done.record()
+            videos.record_stream(self.copy_stream)
+            correct = False
+        else:
+            videos_cpu = videos.cpu()
+            correct = True
+
+        while len(self.pending) >= self.max_pending:
+            self._collect(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(self._process, videos_cpu, done, correct, start, frame_limit))
+
+    def correct_colors(self, videos):
+        """
+        Colour-correct `videos` (B, C, T, H, W) on their device against the reference statistics.
+        """
+        if self.color_stats is None:
+            return videos
+        with self.tracer.span('color_correction', frames=videos.shape[2]):
+            return match_and_blend_colors(videos, None, self.color_correction_strength, reference_stats=self.color_stats)
+
+    def _process(self, videos, done, correct, start, frame_limit):
+        if done is not None:
+            done.synchronize()
+        if correct:
+            videos = self.correct_colors(videos)
+        clip_frames = videos[:, :, start:]
+        if self.video_writer is None:
+            return clip_frames
+        num_written = self.video_writer.num_frames - self.writer_start_frames
+        self.video_writer.write(clip_frames[0, :, :max(frame_limit - num_written, 0)])
+        return None
+
+    def _collect(self, clip_frames):
+        if clip_frames is not None:
+            self.clips.append(clip_frames)
+
+    def close(self):
+        """
+        Wait for all submitted clips and return the collected ones in order.
+        """
+        while self.pending:
+            self._collect(self.pending.popleft().result())
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        return self.clips
+
+    def abort(self):
+        """
+        Drop the clips still in flight and join the worker, e.g. when the request failed.
+        A no-op after `close`.
+        """
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
 class MomentumBuffer:
     def __init__(self, momentum: float): 
         self.momentum = momentum 
@@ -358,10 +546,62 @@ def adaptive_projected_guidance(
 
 
 
-def match_and_blend_colors(source_chunk: torch.Tensor, reference_image: torch.Tensor, strength: float) -> torch.Tensor:
+# sRGB (D65) <-> CIE XYZ, the same constants as skimage.color
+_XYZ_FROM_RGB = torch.tensor([[0.412453, 0.357580, 0.180423],
+                              [0.212671, 0.715160, 0.072169],
+                              [0.019334, 0.119193, 0.950227]], dtype=torch.float64)
+_RGB_FROM_XYZ = torch.linalg.inv(_XYZ_FROM_RGB)
+_D65_WHITE = torch.tensor([0.95047, 1., 1.08883], dtype=torch.float64)
+
+
+def _channel_matmul(matrix, x):
+    # apply a 3x3 matrix along dim 1 of x
+    return torch.einsum('ij,bj...->bi...', matrix.to(x), x)
+
+
+def rgb_to_lab(rgb: torch.Tensor) -> torch.Tensor:
+    """
+    Convert sRGB in [0, 1] to CIE Lab (D65) like `skimage.color.rgb2lab`, channels on dim 1.
+    """
+    rgb = torch.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = _channel_matmul(_XYZ_FROM_RGB, rgb)
+    xyz = xyz / _D65_WHITE.to(xyz).view(1, 3, *([1] * (xyz.dim() - 2)))
+    f = torch.where(xyz > 0.008856, xyz.clamp(min=0) ** (1 / 3), 7.787 * xyz + 16 / 116)
+    fx, fy, fz = f.unbind(1)
+    return torch.stack([116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz)], dim=1)
+
+
+def lab_to_rgb(lab: torch.Tensor) -> torch.Tensor:
+    """
+    Convert CIE Lab (D65) to sRGB clipped to [0, 1] like `skimage.color.lab2rgb`, channels on dim 1.
+    """
+    L, a, b = lab.unbind(1)
+    fy = (L + 16) / 116
+    f = torch.stack([fy + a / 500, fy, (fy - b / 200).clamp(min=0)], dim=1)
+    xyz = torch.where(f > 0.2068966, f ** 3, (f - 16 / 116) / 7.787)
+    xyz = xyz * _D65_WHITE.to(xyz).view(1, 3, *([1] * (xyz.dim() - 2)))
+    rgb = _channel_matmul(_RGB_FROM_XYZ, xyz)
+    rgb = torch.where(rgb > 0.0031308, 1.055 * rgb.clamp(min=0.0031308) ** (1 / 2.4) - 0.055, 12.92 * rgb)
+    return rgb.clamp(0, 1)
+
+
+def lab_color_stats(video: torch.Tensor):
+    """
+    Per-frame, per-channel Lab mean and std of a video (B, C, T, H, W) in range [-1, 1],
+    each of shape (B, 3, T, 1, 1).
+    """
+    lab = rgb_to_lab(((video.float() + 1.0) / 2.0).clamp(0.0, 1.0))
+    return lab.mean(dim=(-2, -1), keepdim=True), lab.std(dim=(-2, -1), keepdim=True, unbiased=False)
+
+
+def match_and_blend_colors(source_chunk: torch.Tensor, reference_image: torch.Tensor, strength: float,
+                           reference_stats=None, frames_per_batch=16) -> torch.Tensor:
     """
     Matches the color of a source video chunk to a reference image and blends with the original.
 
+    The Lab conversion and moment matching run batched on the device of `source_chunk`,
+    `frames_per_batch` frames at a time to bound the temporary memory.
+
     Args:
         source_chunk (torch.Tensor): The video chunk to be color-corrected (B, C, T, H, W) in range [-1, 1].
                                      Assumes B=1 (batch size of 1).
@@ -369,14 +609,13 @@ def match_and_blend_colors(source_chunk: torch.Tensor, reference_image: torch.Te
                                         Assumes B=1 and T=1 (single reference frame).
         strength (float): The strength of the color correction (0.0 to 1.0).
                           0.0 means no correction, 1.0 means full correction.
+        reference_stats (tuple, optional): `lab_color_stats(reference_image)`, computed once per
+                                           video instead of on every call.
 
     Returns:
         torch.Tensor: The color-corrected and blended video chunk.
     """
-    # print(f"[match_and_blend_colors] Input source_chunk shape: {source_chunk.shape}, reference_image shape: {reference_image.shape}, strength: {strength}")
-
     if strength == 0.0:
-        # print(f"[match_and_blend_colors] Strength is 0, returning original source_chunk.")
         return source_chunk
 
     if not 0.0 <= strength <= 1.0:
@@ -385,79 +624,26 @@ def match_and_blend_colors(source_chunk: torch.Tensor, reference_image: torch.Te
     device = source_chunk.device
     dtype = source_chunk.dtype
 
-    # Squeeze batch dimension, permute to T, H, W, C for skimage
-    # Source: (1, C, T, H, W) -> (T, H, W, C)
-    source_np = source_chunk.squeeze(0).permute(1, 2, 3, 0).cpu().numpy()
-    # Reference: (1, C, 1, H, W) -> (H, W, C)
-    ref_np = reference_image.squeeze(0).squeeze(1).permute(1, 2, 0).cpu().numpy() # Squeeze T dimension as well
-
-    # Normalize from [-1, 1] to [0, 1] for skimage
-    source_np_01 = (source_np + 1.0) / 2.0
-    ref_np_01 = (ref_np + 1.0) / 2.0
-
-    # Clip to ensure values are strictly in [0, 1] after potential float precision issues
-    source_np_01 = np.clip(source_np_01, 0.0, 1.0)
-    ref_np_01 = np.clip(ref_np_01, 0.0, 1.0)
-
-    # Convert reference to Lab
-    try:
-        ref_lab = color.rgb2lab(ref_np_01)
-    except ValueError as e:
-        # Handle potential errors if image data is not valid for conversion
-        print(f"Warning: Could not convert reference image to Lab: {e}. Skipping color correction for this chunk.")
-        return source_chunk
-
-
-    corrected_frames_np_01 = []
-    for i in range(source_np_01.shape[0]): # Iterate over time (T)
-        source_frame_rgb_01 = source_np_01[i]
-        
-        try:
-            source_lab = color.rgb2lab(source_frame_rgb_01)
-        except ValueError as e:
-            print(f"Warning: Could not convert source frame {i} to Lab: {e}. Using original frame.")
-            corrected_frames_np_01.append(source_frame_rgb_01)
-            continue
-
-        corrected_lab_frame = source_lab.copy()
-
-        # Perform color transfer for L, a, b channels
-        for j in range(3): # L, a, b
-            mean_src, std_src = source_lab[:, :, j].mean(), source_lab[:, :, j].std()
-            mean_ref, std_ref = ref_lab[:, :, j].mean(), ref_lab[:, :, j].std()
-
-            # Avoid division by zero if std_src is 0
-            if std_src == 0:
-                # If source channel has no variation, keep it as is, but shift by reference mean
-                # This case is debatable, could also just copy source or target mean.
-                # Shifting by target mean helps if source is flat but target isn't.
-                corrected_lab_frame[:, :, j] = mean_ref 
-            else:
-                corrected_lab_frame[:, :, j] = (corrected_lab_frame[:, :, j] - mean_src) * (std_ref / std_src) + mean_ref
-        
-        try:
-            fully_corrected_frame_rgb_01 = color.lab2rgb(corrected_lab_frame)
-        except ValueError as e:
-            print(f"Warning: Could not convert corrected frame {i} back to RGB: {e}. Using original frame.")
-            corrected_frames_np_01.append(source_frame_rgb_01)
-            continue
-            
-        # Clip again after lab2rgb as it can go slightly out of [0,1]
-        fully_corrected_frame_rgb_01 = np.clip(fully_corrected_frame_rgb_01, 0.0, 1.0)
-
-        # Blend with original source frame (in [0,1] RGB)
-        blended_frame_rgb_01 = (1 - strength) * source_frame_rgb_01 + strength * fully_corrected_frame_rgb_01
-        corrected_frames_np_01.append(blended_frame_rgb_01)
-
-    corrected_chunk_np_01 = np.stack(corrected_frames_np_01, axis=0)
-
-    # Convert back to [-1, 1]
-    corrected_chunk_np_minus1_1 = (corrected_chunk_np_01 * 2.0) - 1.0
-
-    # Permute back to (C, T, H, W), add batch dim, and convert to original torch.Tensor type and device
-    # (T, H, W, C) -> (C, T, H, W)
-    corrected_chunk_tensor = torch.from_numpy(corrected_chunk_np_minus1_1).permute(3, 0, 1, 2).unsqueeze(0)
-    corrected_chunk_tensor = corrected_chunk_tensor.contiguous() # Ensure contiguous memory layout
-    output_tensor = corrected_chunk_tensor.to(device=device, dtype=dtype)
-    # print(f"[match_and_blend_colors] Output tensor shape: {output_tensor.shape}")
-    return output_tensor
+    if reference_stats is None:
+        reference_stats = lab_color_stats(reference_image.to(device))
+    mean_ref, std_ref = (stat.to(device) for stat in reference_stats)
+
+    corrected_chunks = []
+    for chunk in source_chunk.split(frames_per_batch, dim=2):
+        source_01 = ((chunk.float() + 1.0) / 2.0).clamp(0.0, 1.0)
+        source_lab = rgb_to_lab(source_01)
+        mean_src = source_lab.mean(dim=(-2, -1), keepdim=True)
+        std_src = source_lab.std(dim=(-2, -1), keepdim=True, unbiased=False)
+
+        # a flat source channel is set to the reference mean
+        corrected_lab = torch.where(
+            std_src == 0,
+            mean_ref.expand_as(source_lab),
+            (source_lab - mean_src) * (std_ref / std_src.masked_fill(std_src == 0, 1.0)) + mean_ref)
+        corrected_01 = lab_to_rgb(corrected_lab)
+
+        # Blend with original source frame (in [0,1] RGB) and convert back to [-1, 1]
+        blended_01 = (1 - strength) * source_01 + strength * corrected_01
+        corrected_chunks.append(blended_01 * 2.0 - 1.0)
+
+    return torch.cat(corrected_chunks, dim=2).to(dtype)
@@ -0,0 +1,208 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+TeaCache for the InfiniteTalk DiT.
+
+A `StepCache` belongs to one generation request. It skips the transformer blocks of
+a CFG branch on steps where the timestep modulation has barely moved since the last
+full pass and reuses that branch's last block residual instead.
+
+The modulation only depends on the timestep, so the skip schedule of a clip is fixed
+by its timesteps alone: the first DiT pass of a clip computes it for all steps in one
+batched pass, and the sampling loop never waits on the GPU to take a decision.
+
+The rescaling polynomial maps the relative L1 change of the modulation to the
+relative L1 change of the block residual. It depends on resolution, step count and
+solver; `tools/calibrate_teacache.py` fits it for a setting and stores it in a JSON
+file that `load_coefficients` reads.
+"""
+import json
+import logging
+
+import torch
+import torch.cuda.amp as amp
+
+# fitted for 40 euler steps, keyed by (size, use_ret_steps)
+TEACACHE_COEFFICIENTS = {
+    ('infinitetalk-480', True): [2.57151496e+05, -3.54229917e+04, 1.40286849e+03, -1.35890334e+01, 1.32517977e-01],
+    ('infinitetalk-720', True): [8.10705460e+03, 2.13393892e+03, -3.72934672e+02, 1.66203073e+01, -4.17769401e-02],
+    ('infinitetalk-480', False): [-3.02331670e+02, 2.23948934e+02, -5.25463970e+01, 5.87348440e+00, -2.01973289e-01],
+    ('infinitetalk-720', False): [-114.36346466, 65.26524496, -18.82220707, 4.91518089, -0.23412683],
+}
+
+
+def load_coefficients(size, use_ret_steps=True, sample_steps=40, sample_solver='euler', path=None):
+    """
+    Rescaling coefficients for a setting.
+
+    Looks in the calibration file `path` first: an entry with the same size, ret-steps
+    mode and solver is taken, the one with the closest step count. Falls back to the
+    built-in coefficients of the size.
+    """
+    if path is not None:
+        with open(path) as f:
+            entries = [e for e in json.load(f)
+                       if e['size'] == size and e['use_ret_steps'] == use_ret_steps
+                       and e['sample_solver'] == sample_solver]
+        if entries:
+            entry = min(entries, key=lambda e: abs(e['sample_steps'] - sample_steps))
+            if entry['sample_steps'] != sample_steps:
+                logging.warning(f"TeaCache: no coefficients for {sample_steps} steps in {path}, "
+                                f"using the ones fitted for {entry['sample_steps']}.")
+            return entry['coefficients']
+        logging.warning(f"TeaCache: no coefficients for {size}/{sample_solver} in {path}, using the built-in ones.")
+    assert (size, use_ret_steps) in TEACACHE_COEFFICIENTS, f"No TeaCache coefficients for {size}."
+    return TEACACHE_COEFFICIENTS[(size, use_ret_steps)]
+
+
+def relative_l1(x, prev):
+    """Relative L1 change of `x` against `prev` over all but the first dimension."""
+    return (x - prev).flatten(1).abs().mean(1) / prev.flatten(1).abs().mean(1)
+
+
+class StepCache:
+    """
+    Per-request TeaCache state.
+
+    Args:
+        coefficients (list): Rescaling polynomial, highest power first.
+        thresh (float): Accumulated rescaled distance that forces a full pass.
+        use_ret_steps (bool): Measure the change on the projected modulation `e0`, always
+            compute the first 5 steps. Otherwise measure it on the time embedding `e`,
+            always compute the first and the last step.
+        calibrate (bool): Never skip, record the input and residual distances of every
+            step for fitting new coefficients.
+    """
+
+    def __init__(self, coefficients=None, thresh=0.2, use_ret_steps=True, calibrate=False):
+        assert calibrate or coefficients is not None
+        self.coefficients = coefficients
+        self.thresh = thresh
+        self.use_ret_steps = use_ret_steps
+        self.calibrate = calibrate
+        self.branches = {}
+        self.timesteps = None
+        self.schedule = None
+        self.input_distances = None
+        self.records = []
+
+    def reset(self, timesteps):
+        """
+        Start a new clip.
+
+        Args:
+            timesteps (List[Tensor]): Timesteps of the clip, each of shape [1]. The last
+                one is the end point and is not run through the model.
+        """
+        if self.calibrate and self.input_distances is not None:
+            self.records.extend(self._collect())
+        for branch in self.branches.values():
+            branch.reset()
+        self.timesteps = torch.cat(list(timesteps[:-1]))
+        self.schedule = None
+        self.input_distances = None
+
+    @torch.no_grad()
+    def plan(self, time_modulation):
+        """
+        Compute the skip schedule of the clip, called by the first DiT pass so that the
+        time embedding runs where the model's weights are.
+
+        Args:
+            time_modulation (callable): `WanModel.time_modulation`.
+        """
+        assert self.timesteps is not None, "StepCache.reset must be called once per clip."
+        t = self.timesteps
+        with amp.autocast(dtype=torch.float32):
+            e, e0 = time_modulation(t.to(torch.float32))
+        modulated = e0 if self.use_ret_steps else e
+        distances = relative_l1(modulated[1:], modulated[:-1])
+
+        num_steps = t.numel()
+        if self.use_ret_steps:
+            ret_steps, cutoff_steps = 5, num_steps
+        else:
+            ret_steps, cutoff_steps = 1, num_steps - 1
+
+        if self.calibrate:
+            self.input_distances = distances
+            self.schedule = [True] * num_steps
+            return self.schedule
+
+        # Horner on the device, then one transfer for the whole clip
+        rescaled = torch.zeros_like(distances)
+        for c in self.coefficients:
+            rescaled = rescaled * distances + c
+        rescaled = [0.0] + rescaled.tolist()
+
+        schedule, accumulated = [], 0.0
+        for step in range(num_steps):
+            if step < ret_steps or step >= cutoff_steps:
+                compute = True
+            else:
+                accumulated += rescaled[step]
+                compute = accumulated >= self.thresh
+            if compute:
+                accumulated = 0.0
+            schedule.append(compute)
+        self.schedule = schedule
+        logging.debug(f"TeaCache: {num_steps - sum(schedule)} of {num_steps} steps skipped.")
+        return schedule
+
+    def branch(self, key):
+        """The cache of CFG branch `key`, passed to the DiT forward as `step_cache`."""
+        if key not in self.branches:
+            self.branches[key] = BranchCache(self)
+        return self.branches[key]
+
+    def calibration_pairs(self):
+        """
+        Calibration only: (input distance, residual distance) pairs of every step but the
+        first, of every branch and every clip run so far.
+        """
+        assert self.calibrate
+        return self.records + self._collect()
+
+    def _collect(self):
+        if self.input_distances is None:
+            return []
+        inputs = self.input_distances.tolist()
+        pairs = []
+        for branch in self.branches.values():
+            outputs = torch.cat(branch.distances).tolist() if branch.distances else []
+            pairs.extend(zip(inputs, outputs))
+        return pairs
+
+
+class BranchCache:
+    """Residual and step counter of one CFG branch of a `StepCache`."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.reset()
+
+    def reset(self):
+        self.step = 0
+        self.residual = None
+        self.distances = []
+
+    def run(self, x, forward_blocks, time_modulation):
+        """
+        Run `forward_blocks(x)`, or reuse the last residual if this step is skipped.
+        Every call advances the branch by one step.
+        """
+        schedule = self.cache.schedule
+        if schedule is None:
+            schedule = self.cache.plan(time_modulation)
+        step = self.step
+        self.step += 1
+
+        if not schedule[step] and self.residual is not None:
+            return x + self.residual
+        ori_x = x.clone()
+        x = forward_blocks(x)
+        residual = x - ori_x
+        if self.cache.calibrate and self.residual is not None:
+            # kept on the device, read back once per clip
+            self.distances.append(relative_l1(residual.flatten()[None], self.residual.flatten()[None]))
+        self.residual = residual
+        return x
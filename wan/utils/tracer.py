@@ -0,0 +1,103 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+Opt-in stage timeline of a generation job.
+
+A `StageTracer` is handed down from `generate_infinitetalk.py` through the pipeline to
+the post-processing and the ffmpeg writers. Every stage is recorded as a span with its
+thread, so the async post-processing shows up next to the sampling loop. The result
+is a Chrome trace (chrome://tracing, Perfetto) and a per-stage summary table.
+
+`NULL_TRACER` records nothing and is the default everywhere.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+
+class StageTracer:
+    """
+    Args:
+        enabled (bool): Record spans; a disabled tracer costs one branch per span.
+        sync (bool): Wait for queued CUDA work at span boundaries, so GPU stages get
+            their real duration instead of their launch time. This removes the overlap
+            between host and device, tracing runs are for profiling.
+    """
+
+    def __init__(self, enabled=True, sync=True):
+        self.enabled = enabled
+        self.sync = sync and torch.cuda.is_available()
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.thread_names = {}
+        self.lock = threading.Lock()
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def _add(self, event):
+        tid = threading.get_ident()
+        event.update(pid=self.pid, tid=tid)
+        with self.lock:
+            self.thread_names.setdefault(tid, threading.current_thread().name)
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, cat='stage', **args):
+        """Time the enclosed block as stage `name`, `args` are shown with the span."""
+        if not self.enabled:
+            yield
+            return
+        start = self._now()
+        try:
+            yield
+        finally:
+            self._add(dict(name=name, cat=cat, ph='X', ts=start, dur=self._now() - start, args=args))
+
+    def instant(self, name, cat='event', **args):
+        """Record a point in time, e.g. a cache hit."""
+        if self.enabled:
+            self._add(dict(name=name, cat=cat, ph='i', s='t', ts=self._now(), args=args))
+
+    def summary(self):
+        """Per stage: count, total, mean and max duration in seconds, longest total first."""
+        durations = defaultdict(list)
+        for event in self.events:
+            if event['ph'] == 'X':
+                durations[event['name']].append(event['dur'] / 1e6)
+        rows = [dict(name=name, count=len(d), total=sum(d), mean=sum(d) / len(d), max=max(d))
+                for name, d in durations.items()]
+        return sorted(rows, key=lambda row: row['total'], reverse=True)
+
+    def format_summary(self):
+        rows = self.summary()
+        width = max([len(row['name']) for row in rows] + [5])
+        lines = [f"{'stage':<{width}}  {'count':>6}  {'total s':>9}  {'mean ms':>9}  {'max ms':>9}"]
+        for row in rows:
+            lines.append(f"{row['name']:<{width}}  {row['count']:>6}  {row['total']:>9.2f}  "
+                         f"{row['mean'] * 1e3:>9.1f}  {row['max'] * 1e3:>9.1f}")
+        return "\n".join(lines)
+
+    def log_summary(self):
+        if not self.enabled:
+            return
+        for line in self.format_summary().split("\n"):
+            logging.info(line)
+
+    def save_chrome_trace(self, path):
+        """Write the spans as a Chrome trace event file."""
+        metadata = [dict(name='thread_name', ph='M', pid=self.pid, tid=tid, args=dict(name=name))
+                    for tid, name in self.thread_names.items()]
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=metadata + self.events, displayTimeUnit='ms'), f)
+
+
+NULL_TRACER = StageTracer(enabled=False)
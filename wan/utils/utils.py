@@ -12,6 +12,7 @@ from PIL import Image
 import librosa
 import soundfile as sf
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from decord import VideoReader, cpu
 import gc
 
@@ -151,6 +152,69 @@ def extract_specific_frames(video_path, frame_id):
         frame = Image.open(video_path).convert("RGB")
     return frame
 
+class CondFrameReader:
+    """
+    Persistent random-access reader for the conditioning video (or image).
+
+    Opens the file once, decodes and transforms frames on a background thread
+    so the next clip's condition frame can be prefetched while the DiT samples
+    the current one.
+
+    Args:
+        video_path (str): Video or image path.
+        transform (callable, optional): Applied to the PIL frame on the worker
+            thread, e.g. resize, crop and normalisation.
+    """
+
+    def __init__(self, video_path, transform=None):
+        self.video_path = video_path
+        self.transform = transform
+        self.vr = None
+        self.image = None
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def _read(self, frame_id):
+        if is_video(self.video_path):
+            if self.vr is None:
+                self.vr = VideoReader(self.video_path, ctx=cpu(0))
+            if frame_id < len(self.vr):
+                frame = self.vr[frame_id].asnumpy()  # RGB
+            else:
+                frame = self.vr[-1].asnumpy()
+            frame = Image.fromarray(frame)
+        else:
+            if self.image is None:
+                self.image = Image.open(self.video_path).convert("RGB")
+            frame = self.image
+        if self.transform is not None:
+            frame = self.transform(frame)
+        return frame
+
+    def prefetch(self, frame_id):
+        """Start decoding `frame_id` in the background."""
+        if frame_id not in self.pending:
+            self.pending[frame_id] = self.executor.submit(self._read, frame_id)
+
+    def get(self, frame_id):
+        """Return the (transformed) frame, waiting for a pending prefetch if there is one."""
+        self.prefetch(frame_id)
+        return self.pending.pop(frame_id).result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pending.clear()
+        self.vr = None
+        self.image = None
+        gc.collect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 def get_video_codec(video_path):
     result = subprocess.run(
         ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
@@ -0,0 +1,163 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+Memory-budget aware placement of the InfiniteTalk models on one GPU.
+
+`plan_placement` estimates the weight footprint of every model and the activation
+peaks of the DiT, the VAE decode and CLIP for a target resolution and clip length,
+then picks `offload_model`, `t5_cpu` and `num_persistent_param_in_dit` so that the
+hot per-step DiT modules stay resident and the rest is streamed.
+
+The activation numbers are coarse upper bounds, not measurements.
+"""
+import logging
+
+import torch
+from easydict import EasyDict
+
+from src.utils import init_weights_on_device
+
+from ..modules.multitalk_model import WanModel
+from .multitalk_utils import ASPECT_RATIO_627, ASPECT_RATIO_960
+
+GiB = 1024 ** 3
+
+# weights that are not part of the DiT, taken from the released checkpoints
+T5_BYTES = 11.4e9     # umt5-xxl encoder, bf16
+CLIP_BYTES = 2.4e9    # open-clip xlm-roberta-large vit-huge-14, fp16
+VAE_BYTES = 0.51e9    # Wan2.1 VAE, fp32
+
+# top-level DiT modules, the ones run on every sampling step first
+DIT_MODULE_ORDER = [
+    'patch_embedding', 'time_embedding', 'time_projection', 'head', 'blocks',
+    'text_embedding', 'img_emb', 'audio_proj',
+]
+
+
+def _bucket_area(size):
+    buckets = ASPECT_RATIO_627 if size == 'infinitetalk-480' else ASPECT_RATIO_960
+    return max(h * w for (h, w), _ in buckets.values())
+
+
+def count_dit_params(wan_config):
+    """
+    Returns (params per DiT block, params outside the blocks) without allocating weights.
+    """
+    config = {**wan_config, 'num_layers': 1, 'weight_init': False}
+    with init_weights_on_device(device=torch.device("meta")):
+        model = WanModel(**config)
+    block = sum(p.numel() for p in model.blocks[0].parameters())
+    total = sum(p.numel() for p in model.parameters())
+    return block, total - block
+
+
+def estimate_activations(wan_config, size, frame_num, num_branches=1, multi_person=True, vae_tile_size=None):
+    """
+    Peak activation bytes of one DiT forward, one VAE decode and one CLIP forward.
+    """
+    area = _bucket_area(size)
+    lat_t = (frame_num - 1) // 4 + 1
+    tokens = lat_t * area // (8 * 8 * 2 * 2)
+    dim, ffn_dim, num_heads = wan_config['dim'], wan_config['ffn_dim'], wan_config['num_heads']
+
+    # fp32 residual, bf16 q/k/v/out and norms, ffn hidden with its activation
+    dit = num_branches * tokens * (16 * dim + 4 * ffn_dim)
+    if multi_person:
+        # fp32 speaker attention map over the reference frame, half of the heads at a time
+        dit += num_branches * tokens * (area // (8 * 8 * 2 * 2)) * (num_heads // 2) * 4
+
+    # fp32 decoder at full (or tile) resolution: 4 new + 2 cached frames, 96 channels,
+    # ~4 live tensors, plus the decoded clip
+    vae_area = area if vae_tile_size is None else min(area, (vae_tile_size * 8) ** 2)
+    vae = 6 * vae_area * 96 * 4 * 4 + 3 * frame_num * area * 4
+    clip = 0.5 * GiB
+    return EasyDict(dit=dit, vae=vae, clip=clip)
+
+
+def plan_placement(wan_config, size, frame_num, budget=None, device=0, quant=None,
+                   num_branches=1, multi_person=True, prefetch_offload=False, vae_tile_size=None):
+    """
+    Choose a placement for a VRAM budget.
+
+    Args:
+        wan_config (dict): DiT config, i.e. the checkpoint's config.json.
+        size (str): `infinitetalk-480` or `infinitetalk-720`.
+        frame_num (int): Frames per clip.
+        budget (float, optional): Budget in GiB. Defaults to the free memory of `device`.
+        quant (str, optional): Quantization type, int8/fp8 DiT weights take one byte.
+        num_branches (int): CFG branches per DiT forward, 3 with batched CFG.
+        multi_person (bool): Reserve memory for the speaker attention map.
+        prefetch_offload (bool): Reserve the two block slots of the prefetcher.
+        vae_tile_size (int, optional): Tile size of a tiled VAE, in latent pixels.
+
+    Returns:
+        EasyDict with `offload_model`, `t5_cpu`, `num_persistent_param_in_dit`,
+        `module_order` and the estimates the decision is based on.
+    """
+    if budget is None:
+        budget_bytes = torch.cuda.mem_get_info(device)[0]
+    else:
+        budget_bytes = budget * GiB
+    margin = 1.5 * GiB + 0.05 * budget_bytes
+
+    block_params, other_params = count_dit_params(wan_config)
+    num_layers = wan_config['num_layers']
+    dit_params = block_params * num_layers + other_params
+    bytes_per_param = 1 if quant is not None else 2
+    dit_bytes = dit_params * bytes_per_param
+
+    act = estimate_activations(wan_config, size, frame_num, num_branches, multi_person, vae_tile_size)
+    reserve = max(act.dit, act.vae, act.clip)
+    if prefetch_offload:
+        staging = 2 * block_params * bytes_per_param
+    else:
+        # one streamed linear layer at a time
+        staging = 2 * wan_config['dim'] * wan_config['ffn_dim'] * bytes_per_param
+
+    plan = EasyDict(
+        budget=budget_bytes,
+        margin=margin,
+        dit_bytes=dit_bytes,
+        activations=act,
+        module_order=DIT_MODULE_ORDER,
+        warning=None,
+    )
+
+    if dit_bytes + VAE_BYTES + CLIP_BYTES + T5_BYTES + reserve + margin <= budget_bytes:
+        plan.update(offload_model=False, t5_cpu=False, num_persistent_param_in_dit=None)
+        return plan
+
+    # T5 and CLIP only visit the GPU while they run
+    plan.offload_model = True
+    plan.t5_cpu = T5_BYTES + 1 * GiB + margin > budget_bytes
+    available = budget_bytes - margin - reserve - VAE_BYTES - CLIP_BYTES - staging
+    persistent = int(max(available, 0) // bytes_per_param)
+    plan.num_persistent_param_in_dit = min(persistent, dit_params)
+    if available < 0:
+        plan.warning = (
+            f"the activation peak alone needs {(reserve + margin + VAE_BYTES + CLIP_BYTES) / GiB:.1f} GiB, "
+            f"reduce --frame_num or the resolution")
+    return plan
+
+
+def format_plan(plan):
+    act = plan.activations
+    if plan.num_persistent_param_in_dit is None:
+        dit = "fully resident"
+    else:
+        dit = (f"{plan.num_persistent_param_in_dit / 1e9:.2f}B params resident, rest streamed "
+               f"(order: {', '.join(plan.module_order)})")
+    lines = [
+        f"VRAM plan for a budget of {plan.budget / GiB:.1f} GiB (margin {plan.margin / GiB:.1f} GiB):",
+        f"  DiT weights       {plan.dit_bytes / GiB:6.1f} GiB -> {dit}",
+        f"  peak activations  DiT {act.dit / GiB:.1f} GiB, VAE decode {act.vae / GiB:.1f} GiB, CLIP {act.clip / GiB:.1f} GiB",
+        f"  offload_model={plan.offload_model} t5_cpu={plan.t5_cpu} "
+        f"num_persistent_param_in_dit={plan.num_persistent_param_in_dit}",
+    ]
+    return "\n".join(lines)
+
+
+def log_plan(plan):
+    for line in format_plan(plan).split("\n"):
+        logging.info(line)
+    if plan.warning is not None:
+        logging.warning(f"VRAM plan: {plan.warning}")